@@ -1,9 +1,36 @@
 import os
 import csv
+import time
+import logging
 import numpy
 from __main__ import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
 from Utils.mixins import ModuleWidgetMixin
+from Utils.pathsearch import asPathArray, buildPathIndex, computeNearestPaths, computeCandidatePaths
+from Utils.templatemesh import (createTubeMesh, createLineMesh, computeGlyphArrays, selectLevelOfDetail,
+                                countTriangles, LEVELS_OF_DETAIL, LOD_AUTO, LOD_HIGH, LOD_LINES, LOD_GLYPHS,
+                                TUBE_SIDES)
+from Utils.geometrycache import GeometryCache, hashFile
+from Utils.scheduler import RecomputeScheduler
+from Utils.templateconfig import (loadTemplateFile, loadFiducialConfig, getHoleLabels, getHoleGrid, computePathTilts,
+                                  transformTemplatePaths)
+from Utils.markerdetection import detectMarkers, computeRegion
+from Utils.registration import registerCorrespondingPoints, registerPointSets, computeRegistrationError
+from Utils.reachabilitymap import ReachabilityMap
+from Utils.obstacles import ObstacleMap, computeNearestClearPaths, resolveBlockedPaths
+from Utils.sliceintersections import intersectSegmentsWithPlane
+from Utils.templatelibrary import TemplateLibrary, summarizeEvaluation, EVALUATION_COLUMNS
+from Utils.livetracking import LatencyMonitor, TransformReplay
+from Utils.targettable import TargetResults, TargetTableModel
+from Utils.workers import BackgroundWorker
+from Utils.instrumentation import instrumentation, timed, STATISTICS_COLUMNS
+
+# Diagnostics are off unless the application configured this logger, e.g. with
+# logging.getLogger('NeedleGuideTemplate').setLevel(logging.DEBUG), before or after loading the module
+logger = logging.getLogger('NeedleGuideTemplate')
+if logger.level == logging.NOTSET:
+  logger.setLevel(logging.WARNING)
 
 #
 # NeedleGuideTemplate
@@ -41,26 +68,57 @@ class NeedleGuideTemplateWidget(ScriptedLoadableModuleWidget, ModuleWidgetMixin)
   """
 
   DEFAULT_TEMPLATE_CONFIG_FILE_NAME = "Config/ProstateTemplate.csv"
+  TEMPLATE_LIBRARY_DIRECTORY_NAME = "Config"
+  MAX_TABLE_REFRESH_RATE = 30.0  # Maximum number of table updates per second while targets are being dragged
+  BACKGROUND_TABLE_UPDATE_SIZE = 1000  # Table updates of more rows are computed in the background
+  LATENCY_LABEL_UPDATE_INTERVAL = 0.5  # Seconds between updates of the live tracking latency display
 
   def __init__(self, parent=None):
     ScriptedLoadableModuleWidget.__init__(self, parent)
     self.modulePath = os.path.dirname(slicer.util.modulePath(self.moduleName))
     self.defaultTemplateFile = os.path.join(self.modulePath, self.DEFAULT_TEMPLATE_CONFIG_FILE_NAME)
+    self.templateLibrary = TemplateLibrary(os.path.join(self.modulePath, self.TEMPLATE_LIBRARY_DIRECTORY_NAME))
 
   def cleanup(self):
-    slicer.mrmlScene.Clear(0)
+    # Called before the module is reloaded: everything this widget and its logic registered with the scene, the
+    # views and the event loop is released, so repeated reloads do not accumulate observers, nodes or windows
+    self.tableScheduler.cancel()
+    self.worker.shutdown()
+    for progressIndicator in self.progressIndicators.values():
+      progressIndicator.close()
+    self.progressIndicators = {}
+    self.setTargetFiducialsNode(None)
+    if self.ex is not None:
+      self.ex.close()
+      self.ex.deleteLater()
+      self.ex = None
+    self.logic.worker = None
+    self.logic.pathsUpdatedCallback = None
+    self.logic.liveTrackingCallback = None
+    self.logic.cleanup()
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
 
     self.logic = NeedleGuideTemplateLogic()
+    self.worker = BackgroundWorker()
+    self.worker.addProgressListener(self.onBackgroundTaskProgress)
+    self.logic.worker = self.worker
+    self.progressIndicators = {}
+    self.tableScheduler = RecomputeScheduler(self.updateTable, self.MAX_TABLE_REFRESH_RATE)
+    self.logic.pathsUpdatedCallback = self.onPathsUpdated
+    self.logic.liveTrackingCallback = self.onLiveTrackingFrame
     self.setupMainSection()
+    self.setupTemplateLibrarySection()
+    self.setupRegistrationSection()
     self.setupProjectionSection()
+    self.setupPerformanceSection()
 
     self.setupConnections()
     self.onFiducialsSelected()
 
-    self.mainCollapsibleButton.setEnabled(self.logic.loadTemplateConfigFile(self.defaultTemplateFile))
+    self.templateFile = None  ## Configuration file of the loaded template
+    self.loadTemplate(self.defaultTemplateFile)
     self.updateTable()
     self.layout.addStretch(1)
 
@@ -83,38 +141,258 @@ class NeedleGuideTemplateWidget(ScriptedLoadableModuleWidget, ModuleWidgetMixin)
     self.showTrajectoriesCheckBox.setToolTip("Show 3D model of the fiducial")
     mainFormLayout.addRow("Show Trajectories:", self.showTrajectoriesCheckBox)
 
+    self.levelOfDetailComboBox = qt.QComboBox()
+    self.levelOfDetailComboBox.addItems(list(LEVELS_OF_DETAIL))
+    self.levelOfDetailComboBox.setToolTip("Level of detail of the 3D models: tubes with many or few sides, lines, "
+                                          "or instanced glyphs. 'auto' chooses by the number of holes.")
+    mainFormLayout.addRow("Level of Detail:", self.levelOfDetailComboBox)
+
     self.transformSelector = self.createComboBox(nodeTypes=["vtkMRMLLinearTransformNode", ""], noneEnabled=False,
                                                  selectNodeUponCreation=True, showChildNodeTypes=False)
 
     mainFormLayout.addRow("Input Transform: ", self.transformSelector)
 
+    self.liveTrackingCheckBox = qt.QCheckBox()
+    self.liveTrackingCheckBox.checked = 0
+    self.liveTrackingCheckBox.setToolTip("Update paths, targets and projection for every streamed transform "
+                                         "(e.g. OpenIGTLink), skipping transforms that are already outdated")
+    self.latencyLabel = qt.QLabel()
+    self.latencyLabelUpdateTime = 0.0
+    liveTrackingLayout = qt.QHBoxLayout()
+    liveTrackingLayout.addWidget(self.liveTrackingCheckBox)
+    liveTrackingLayout.addWidget(self.latencyLabel, 1)
+    mainFormLayout.addRow("Live Tracking:", liveTrackingLayout)
+
     self.inputVolumeSelector = self.createComboBox(nodeTypes=["vtkMRMLScalarVolumeNode", ""], noneEnabled=False,
                                                    selectNodeUponCreation=True, showChildNodeTypes=False)
 
     mainFormLayout.addRow("Input Volume: ", self.inputVolumeSelector)
 
+    self.showReachabilityCheckBox = qt.QCheckBox()
+    self.showReachabilityCheckBox.checked = 0
+    self.showReachabilityCheckBox.setToolTip("Precompute the nearest hole for every voxel of the input volume and "
+                                             "show the reachable region as label map")
+    mainFormLayout.addRow("Show Reachability:", self.showReachabilityCheckBox)
+
     self.targetFiducialsSelector = self.createComboBox(nodeTypes=["vtkMRMLMarkupsFiducialNode", ""], noneEnabled=False,
                                                        selectNodeUponCreation=True, showChildNodeTypes=False,
                                                        addEnabled=True, removeEnabled=True, showHidden=False,
                                                        toolTip="Select Markups for targets")
     mainFormLayout.addRow("Targets: ", self.targetFiducialsSelector)
 
+    self.obstacleLabelMapSelector = self.createComboBox(nodeTypes=["vtkMRMLLabelMapVolumeNode", ""],
+                                                        noneEnabled=True, selectNodeUponCreation=False,
+                                                        showChildNodeTypes=False,
+                                                        toolTip="Select a label map of structures needle paths "
+                                                                "must not cross")
+    mainFormLayout.addRow("Obstacles: ", self.obstacleLabelMapSelector)
+
     self.targetFiducialsNode = None
+    self.tag = None  ## Observer of targetFiducialsNode
+    self.targetResults = TargetResults()  ## Results of every target, in the order of the control points
+    self.resetTableCache()
 
     #
     # Target List Table
     #
-    self.table = qt.QTableWidget(1, 4)
+    filterLayout = qt.QHBoxLayout()
+    self.tableFilterLineEdit = qt.QLineEdit()
+    self.tableFilterLineEdit.setToolTip("Only list targets whose name contains this text")
+    self.inRangeOnlyCheckBox = qt.QCheckBox("In range only")
+    self.inRangeOnlyCheckBox.setToolTip("Only list targets that can be reached through the template")
+    filterLayout.addWidget(qt.QLabel("Filter:"))
+    filterLayout.addWidget(self.tableFilterLineEdit, 1)
+    filterLayout.addWidget(self.inRangeOnlyCheckBox)
+
+    # The view only asks the model for the cells it shows; sorting and filtering permute an index array
+    self.tableModel = TargetTableModel(self.targetResults)
+    self.table = qt.QTableView()
+    self.table.setModel(self.tableModel)
     self.table.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
     self.table.setSelectionMode(qt.QAbstractItemView.SingleSelection)
     # self.table.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
-    self.headers = ["Name", "Hole", "Depth (mm)", "Position (RAS)"]
-    self.table.setHorizontalHeaderLabels(self.headers)
     self.table.horizontalHeader().setStretchLastSection(True)
+    self.table.horizontalHeader().setSortIndicator(-1, qt.Qt.AscendingOrder)
+    self.table.setSortingEnabled(True)
+
+    #
+    # Alternative holes of the selected target
+    #
+    alternativesFormLayout = qt.QFormLayout()
+    self.alternativesSpinBox = qt.QSpinBox()
+    self.alternativesSpinBox.setRange(0, 20)
+    self.alternativesSpinBox.value = 5
+    self.alternativesSpinBox.setToolTip("Number of alternative holes listed for the selected target (0: none)")
+    alternativesFormLayout.addRow("Alternatives:", self.alternativesSpinBox)
+    self.alternativeHeaders = ["Rank", "Hole", "Distance (mm)", "Depth (mm)", "Path"]
+    self.alternativesTable = qt.QTableWidget(0, len(self.alternativeHeaders))
+    self.alternativesTable.setHorizontalHeaderLabels(self.alternativeHeaders)
+    self.alternativesTable.horizontalHeader().setStretchLastSection(True)
+    self.alternativesTable.hide()
 
     mainLayout = qt.QVBoxLayout(self.mainCollapsibleButton)
     mainLayout.addWidget(mainFormFrame)
+    mainLayout.addLayout(filterLayout)
     mainLayout.addWidget(self.table)
+    mainLayout.addLayout(alternativesFormLayout)
+    mainLayout.addWidget(self.alternativesTable)
+
+  def setupTemplateLibrarySection(self):
+    libraryCollapsibleButton = ctk.ctkCollapsibleButton()
+    libraryCollapsibleButton.text = "Template Library"
+    libraryCollapsibleButton.collapsed = True
+    self.layout.addWidget(libraryCollapsibleButton)
+    libraryLayout = qt.QVBoxLayout(libraryCollapsibleButton)
+
+    libraryFormLayout = qt.QFormLayout()
+    self.templateComboBox = qt.QComboBox()
+    self.templateComboBox.setToolTip("Template configurations found in %s" % self.templateLibrary.directory)
+    libraryFormLayout.addRow("Template:", self.templateComboBox)
+    libraryLayout.addLayout(libraryFormLayout)
+
+    self.evaluateTemplatesButton = qt.QPushButton("Evaluate Templates")
+    self.evaluateTemplatesButton.toolTip = "Compare the coverage of the current targets by every template"
+    libraryLayout.addWidget(self.evaluateTemplatesButton)
+
+    self.evaluationTable = qt.QTableWidget(0, len(EVALUATION_COLUMNS))
+    self.evaluationTable.setHorizontalHeaderLabels(EVALUATION_COLUMNS)
+    self.evaluationTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.evaluationTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.evaluationTable.horizontalHeader().setStretchLastSection(True)
+    self.evaluationTable.setToolTip("Double-click a template to use it")
+    libraryLayout.addWidget(self.evaluationTable)
+    self.evaluationPaths = []  ## Template file of every row of the evaluation table
+
+  def updateTemplateComboBox(self):
+    # Lists the library templates by file name; the loaded template is selected
+    self.templateComboBox.blockSignals(True)
+    self.templateComboBox.clear()
+    for path in self.templateLibrary.getPaths():
+      self.templateComboBox.addItem(os.path.basename(path), path)
+    self.templateComboBox.setCurrentIndex(self.templateComboBox.findData(self.templateFile))
+    self.templateComboBox.blockSignals(False)
+
+  def loadTemplate(self, path):
+    self.templateFile = path
+    loaded = self.logic.loadTemplateConfigFile(path)
+    self.mainCollapsibleButton.setEnabled(loaded)
+    self.logic.setTemplateVisibility(self.showTemplateCheckBox.checked)
+    self.logic.setNeedlePathVisibility(self.showTrajectoriesCheckBox.checked)
+    if self.ex is not None:
+      self.ex.setTemplate(self.logic.templateIndex)
+    self.updateTemplateComboBox()
+    return loaded
+
+  def onTemplateSelected(self, index):
+    path = self.templateComboBox.itemData(index)
+    if path and path != self.templateFile:
+      self.loadTemplate(path)
+
+  def onEvaluateTemplates(self):
+    if not self.targetFiducialsNode:
+      return
+    positions = numpy.zeros((self.targetFiducialsNode.GetNumberOfFiducials(), 3))
+    for i in range(len(positions)):
+      pos = [0.0, 0.0, 0.0]
+      self.targetFiducialsNode.GetNthFiducialPosition(i, pos)
+      positions[i] = pos
+    self.logic.transformScheduler.flush()
+    matrix = self.logic.appliedMatrix
+    with instrumentation.span('widget.evaluateTemplates'):
+      rows = summarizeEvaluation(self.templateLibrary.evaluate(positions, matrix))
+
+    self.evaluationTable.setRowCount(len(rows))
+    self.evaluationPaths = [path for (path, row) in rows]
+    for (i, (path, row)) in enumerate(rows):
+      texts = [row[0], str(row[1]), '%d/%d' % (row[2], len(positions)), '%.1f' % row[3], '%.3f' % row[4]]
+      for (column, text) in enumerate(texts):
+        self.evaluationTable.setItem(i, column, qt.QTableWidgetItem(text))
+
+  def onEvaluationTableDoubleClicked(self, row, column):
+    if 0 <= row < len(self.evaluationPaths):
+      self.loadTemplate(self.evaluationPaths[row])
+
+  def setupRegistrationSection(self):
+    registrationCollapsibleButton = ctk.ctkCollapsibleButton()
+    registrationCollapsibleButton.text = "Registration"
+    registrationCollapsibleButton.collapsed = True
+    self.layout.addWidget(registrationCollapsibleButton)
+    registrationLayout = qt.QFormLayout(registrationCollapsibleButton)
+
+    self.markerFiducialsSelector = self.createComboBox(nodeTypes=["vtkMRMLMarkupsFiducialNode", ""],
+                                                       noneEnabled=True, selectNodeUponCreation=False,
+                                                       showChildNodeTypes=False,
+                                                       toolTip="Select Markups with the template markers found in "
+                                                               "the image")
+    registrationLayout.addRow("Markers: ", self.markerFiducialsSelector)
+
+    self.correspondencesCheckBox = qt.QCheckBox()
+    self.correspondencesCheckBox.checked = 1
+    self.correspondencesCheckBox.setToolTip("Markers are placed in the order of the template markers. Otherwise "
+                                            "they are matched by ICP, starting from the current template position.")
+    registrationLayout.addRow("Known Correspondences:", self.correspondencesCheckBox)
+
+    self.markerThresholdSpinBox = qt.QDoubleSpinBox()
+    self.markerThresholdSpinBox.setRange(-100000.0, 100000.0)
+    self.markerThresholdSpinBox.value = 500.0
+    self.markerThresholdSpinBox.setToolTip("Lowest intensity of marker voxels in the input volume")
+    registrationLayout.addRow("Marker Threshold:", self.markerThresholdSpinBox)
+
+    self.nearTemplateCheckBox = qt.QCheckBox()
+    self.nearTemplateCheckBox.checked = 1
+    self.nearTemplateCheckBox.setToolTip("Search markers only around the current template position")
+    registrationLayout.addRow("Search Near Template:", self.nearTemplateCheckBox)
+
+    self.detectMarkersButton = qt.QPushButton("Detect Markers")
+    self.detectMarkersButton.toolTip = "Find the template markers in the input volume"
+    registrationLayout.addRow(self.detectMarkersButton)
+
+    self.registerButton = qt.QPushButton("Register Template")
+    self.registerButton.toolTip = "Compute the input transform from the template markers"
+    registrationLayout.addRow(self.registerButton)
+    self.registrationResultLabel = qt.QLabel()
+    registrationLayout.addRow(self.registrationResultLabel)
+
+  def onDetectMarkers(self):
+    volumeNode = self.inputVolumeSelector.currentNode()
+    if volumeNode is None:
+      self.registrationResultLabel.text = 'Select an input volume'
+      return
+    markersNode = self.markerFiducialsSelector.currentNode()
+    if markersNode is None:
+      markersNode = slicer.vtkMRMLMarkupsFiducialNode()
+      markersNode.SetName('TemplateMarkers')
+      slicer.mrmlScene.AddNode(markersNode)
+      markersNode.CreateDefaultDisplayNodes()
+      self.markerFiducialsSelector.setCurrentNode(markersNode)
+    start = time.time()
+    try:
+      points = self.logic.detectTemplateMarkers(volumeNode, self.markerThresholdSpinBox.value, markersNode=markersNode,
+                                                nearTemplate=self.nearTemplateCheckBox.checked)
+    except ValueError as e:
+      self.registrationResultLabel.text = 'Detection failed: %s' % e
+      return
+    self.registrationResultLabel.text = '%d markers found, template has %d (%.1f ms)' % (
+      points.shape[0], self.logic.fiducialConfig.shape[0], 1000.0 * (time.time() - start))
+
+  def onRegisterTemplate(self):
+    markersNode = self.markerFiducialsSelector.currentNode()
+    transformNode = self.transformSelector.currentNode()
+    if markersNode is None or transformNode is None:
+      self.registrationResultLabel.text = 'Select markers and an input transform'
+      return
+    points = numpy.zeros((markersNode.GetNumberOfFiducials(), 3))
+    pos = [0.0, 0.0, 0.0]
+    for i in range(points.shape[0]):
+      markersNode.GetNthFiducialPosition(i, pos)
+      points[i] = pos
+    start = time.time()
+    error = self.logic.registerTemplate(points, transformNode, self.correspondencesCheckBox.checked)
+    if error is None:
+      self.registrationResultLabel.text = 'Registration failed: the template has %d markers, %d were given' % (
+        self.logic.fiducialConfig.shape[0], points.shape[0])
+    else:
+      self.registrationResultLabel.text = 'RMS error %.2f mm (%.1f ms)' % (error, 1000.0 * (time.time() - start))
 
   def setupProjectionSection(self):
     projectionCollapsibleButton = ctk.ctkCollapsibleButton()
@@ -126,15 +404,61 @@ class NeedleGuideTemplateWidget(ScriptedLoadableModuleWidget, ModuleWidgetMixin)
     self.openWindowButton.toolTip = "Run the algorithm."
     self.openWindowButton.enabled = True
     projectionLayout.addWidget(self.openWindowButton)
+    self.ex = None  ## ProjectionWindow, created when it is opened for the first time
+
+  def setupPerformanceSection(self):
+    performanceCollapsibleButton = ctk.ctkCollapsibleButton()
+    performanceCollapsibleButton.text = "Performance"
+    performanceCollapsibleButton.collapsed = True
+    self.layout.addWidget(performanceCollapsibleButton)
+    performanceLayout = qt.QVBoxLayout(performanceCollapsibleButton)
+
+    self.statisticsTable = qt.QTableWidget(0, len(STATISTICS_COLUMNS))
+    self.statisticsTable.setHorizontalHeaderLabels(STATISTICS_COLUMNS)
+    self.statisticsTable.horizontalHeader().setStretchLastSection(True)
+    performanceLayout.addWidget(self.statisticsTable)
+
+    buttonLayout = qt.QHBoxLayout()
+    self.refreshStatisticsButton = qt.QPushButton("Refresh")
+    self.refreshStatisticsButton.toolTip = "Show the current event counters and timings"
+    self.resetStatisticsButton = qt.QPushButton("Reset")
+    self.resetStatisticsButton.toolTip = "Clear all event counters and timings"
+    self.exportStatisticsButton = qt.QPushButton("Export CSV")
+    self.exportStatisticsButton.toolTip = "Save the event counters and timings as CSV file"
+    buttonLayout.addWidget(self.refreshStatisticsButton)
+    buttonLayout.addWidget(self.resetStatisticsButton)
+    buttonLayout.addWidget(self.exportStatisticsButton)
+    performanceLayout.addLayout(buttonLayout)
+
+    self.measureRenderingButton = qt.QPushButton("Measure Rendering")
+    self.measureRenderingButton.toolTip = "Render the 3D views at every level of detail and report the frame times"
+    performanceLayout.addWidget(self.measureRenderingButton)
+    self.renderingReportLabel = qt.QLabel()
+    performanceLayout.addWidget(self.renderingReportLabel)
 
   def setupConnections(self):
     self.showTemplateCheckBox.connect('toggled(bool)', self.onShowTemplate)
     self.showTrajectoriesCheckBox.connect('toggled(bool)', self.onShowTrajectories)
+    self.showReachabilityCheckBox.connect('toggled(bool)', self.onShowReachability)
     self.targetFiducialsSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onFiducialsSelected)
-    self.table.connect('cellClicked(int, int)', self.onTableSelected)
+    self.table.connect('clicked(QModelIndex)', self.onTableClicked)
+    self.tableFilterLineEdit.connect('textChanged(QString)', self.onTableFilterChanged)
+    self.inRangeOnlyCheckBox.connect('toggled(bool)', self.onTableFilterChanged)
     self.openWindowButton.connect('clicked(bool)', self.onOpenWindowButton)
     self.inputVolumeSelector.connect('currentNodeChanged(bool)', self.onInputVolumeSelected)
     self.transformSelector.connect('currentNodeChanged(bool)', self.onTransformNodeSelected)
+    self.liveTrackingCheckBox.connect('toggled(bool)', self.onLiveTrackingToggled)
+    self.obstacleLabelMapSelector.connect('currentNodeChanged(bool)', self.onObstacleLabelMapSelected)
+    self.refreshStatisticsButton.connect('clicked(bool)', self.updateStatisticsTable)
+    self.resetStatisticsButton.connect('clicked(bool)', self.onResetStatistics)
+    self.exportStatisticsButton.connect('clicked(bool)', self.onExportStatistics)
+    self.levelOfDetailComboBox.connect('currentIndexChanged(QString)', self.onLevelOfDetailChanged)
+    self.measureRenderingButton.connect('clicked(bool)', self.onMeasureRendering)
+    self.templateComboBox.connect('currentIndexChanged(int)', self.onTemplateSelected)
+    self.evaluateTemplatesButton.connect('clicked(bool)', self.onEvaluateTemplates)
+    self.evaluationTable.connect('cellDoubleClicked(int, int)', self.onEvaluationTableDoubleClicked)
+    self.detectMarkersButton.connect('clicked(bool)', self.onDetectMarkers)
+    self.registerButton.connect('clicked(bool)', self.onRegisterTemplate)
 
   def onInputVolumeSelected(self):
     volume = self.inputVolumeSelector.currentNode()
@@ -143,67 +467,177 @@ class NeedleGuideTemplateWidget(ScriptedLoadableModuleWidget, ModuleWidgetMixin)
         widget = self.layoutManager.sliceWidget(viewName)
         compositeNode = widget.mrmlSliceCompositeNode()
         compositeNode.SetBackgroundVolumeID(volume.GetID())
+    if self.showReachabilityCheckBox.checked:
+      self.onShowReachability()
 
   def onTransformNodeSelected(self):
     transform = self.transformSelector.currentNode()
     if transform:
       self.logic.setTransform(transform)
 
+  def onLiveTrackingToggled(self, enabled):
+    self.logic.setLiveTracking(enabled)
+    self.latencyLabel.text = ''
+    self.latencyLabelUpdateTime = 0.0
+
+  def onPathsUpdated(self):
+    if self.logic.liveTracking:
+      # Targets and projection are refreshed within the transform update instead of a separate rate limited pass
+      self.tableScheduler.cancel()
+      self.updateTable()
+      if self.worker.isPending('table'):
+        # Large tables are searched in the background; the frame ends when applyTableRows has written them
+        self.logic.deferLiveTrackingFrame()
+    else:
+      self.tableScheduler.schedule()
+
+  def onLiveTrackingFrame(self):
+    now = time.time()
+    if now - self.latencyLabelUpdateTime < self.LATENCY_LABEL_UPDATE_INTERVAL:
+      return
+    self.latencyLabelUpdateTime = now
+    monitor = self.logic.latencyMonitor
+    (mean, maximum) = monitor.getSummary()
+    self.latencyLabel.text = 'latency %.1f ms (max %.1f ms), %d frames, %d dropped' % (
+      mean, maximum, monitor.processedFrames, monitor.droppedFrames)
+
+  def onObstacleLabelMapSelected(self):
+    self.logic.setObstacleLabelMap(self.obstacleLabelMapSelector.currentNode())
+
+  @timed('widget.updateTable')
   def updateTable(self):
 
-    print "updateTable() is called"
+    logger.debug('updateTable() is called')
     if not self.targetFiducialsNode:
-      self.table.clear()
-      self.table.setHorizontalHeaderLabels(self.headers)
+      self.resetTableCache()
+      self.tableModel.refresh()
+      self.updateProjectionTargets()
     else:
       
-      self.tableData = []
+      # Paths of a pending transform update must be current before the rows are diffed
+      self.logic.transformScheduler.flush()
       nOfControlPoints = self.targetFiducialsNode.GetNumberOfFiducials()
 
-      if self.table.rowCount != nOfControlPoints:
-        self.table.setRowCount(nOfControlPoints)
-
+      positions = numpy.zeros((nOfControlPoints, 3))
+      labels = []
       for i in range(nOfControlPoints):
-
-        label = self.targetFiducialsNode.GetNthFiducialLabel(i)
         pos = [0.0, 0.0, 0.0]
-
-        self.targetFiducialsNode.GetNthFiducialPosition(i,pos)
-        (indexX, indexY, depth, inRange) = self.logic.computeNearestPath(pos)
-
-        posstr = '(%.3f, %.3f, %.3f)' % (pos[0], pos[1], pos[2])
-        cellLabel = qt.QTableWidgetItem(label)
-        cellIndex = qt.QTableWidgetItem('(%s, %s)' % (indexX, indexY))
-        if inRange:
-          cellDepth = qt.QTableWidgetItem('%.3f' % depth)
-        else:
-          cellDepth = qt.QTableWidgetItem('(%.3f)' % depth)
-        cellPosition = qt.QTableWidgetItem(posstr)
-        row = [cellLabel, cellIndex, cellDepth, cellPosition]
-
-        self.table.setItem(i, 0, row[0])
-        self.table.setItem(i, 1, row[1])
-        self.table.setItem(i, 2, row[2])
-        self.table.setItem(i, 3, row[3])
-
-        self.tableData.append(row)
+        self.targetFiducialsNode.GetNthFiducialPosition(i, pos)
+        positions[i] = pos
+        labels.append(self.targetFiducialsNode.GetNthFiducialLabel(i))
+
+      if self.targetResults.size != nOfControlPoints:
+        self.targetResults.resize(nOfControlPoints)
+        self.tableModel.refresh()
+
+      # Only rows whose control point moved or was renamed are recomputed and rewritten
+      changedRows = self.getChangedTableRows(positions, labels)
+      pathVersion = self.logic.pathVersion
+      search = self.logic.createPathSearch()
+      # A pending background update is outdated by this edit; its rows are part of changedRows again
+      self.worker.cancel('table')
+      if len(changedRows) > self.BACKGROUND_TABLE_UPDATE_SIZE:
+        targets = positions[changedRows]
+        self.worker.submit('table', lambda task: search(targets),
+                           lambda result: self.applyTableRows(changedRows, positions, labels, pathVersion, result),
+                           title="Updating targets...")
+      else:
+        self.applyTableRows(changedRows, positions, labels, pathVersion, search(positions[changedRows]))
         
     self.table.show()
 
-  def onFiducialsSelected(self):
-    # Remove observer if previous node exists
-    if self.targetFiducialsNode and self.tag:
-      self.targetFiducialsNode.RemoveObserver(self.tag)
+  def applyTableRows(self, changedRows, positions, labels, pathVersion, result):
+    (indices, angles, depths, inRanges, blocked) = result
+    holes = self.logic.getHoleIndices(indices)
+    # Columns of all changed rows are written at once; the view formats the visible cells when it repaints
+    self.targetResults.update(changedRows, label=[labels[i] for i in changedRows], hole=indices,
+                              holeX=[hole[0] for hole in holes], holeY=[hole[1] for hole in holes],
+                              tilt=self.logic.getPathTilts(indices, angles), depth=depths, inRange=inRanges,
+                              blocked=blocked, position=positions[changedRows])
+    self.tableModel.showPath = self.logic.obstacleMap is not None
+    self.tableModel.refresh(changedRows)
+
+    self.tablePositions = positions
+    self.tableLabels = labels
+    self.tablePathVersion = pathVersion
+    self.updateProjectionTargets()
+    self.logic.completeLiveTrackingFrame()
+
+  def getProjectionTargets(self):
+    # Returns (index_x, index_y, inRange) of every target for the projection window
+    rows = self.targetResults.rows
+    return list(zip(rows['holeX'], rows['holeY'], rows['inRange']))
+
+  def updateProjectionTargets(self):
+    if self.ex is not None:
+      self.ex.setTargets(self.getProjectionTargets())
+      # The crosshair follows the hole of the selected target when the paths move
+      row = self.tableModel.getTargetRow(self.table.currentIndex().row())
+      if row >= 0:
+        record = self.targetResults.records[row]
+        self.ex.setSelection(record['holeX'], record['holeY'])
+
+  def onTableFilterChanged(self):
+    self.tableModel.setFilter(self.tableFilterLineEdit.text, self.inRangeOnlyCheckBox.checked)
+
+  def resetTableCache(self):
+    self.targetResults.resize(0)
+    self.tablePositions = None  ## Positions the table rows were computed for
+    self.tableLabels = []
+    self.tablePathVersion = None  ## logic.pathVersion the table rows were computed with
+
+  def getChangedTableRows(self, positions, labels):
+    nRows = len(positions)
+    if self.tablePositions is None or self.tablePathVersion != self.logic.pathVersion:
+      return numpy.arange(nRows)
+    nCached = min(nRows, len(self.tablePositions))
+    changed = numpy.any(positions[:nCached] != self.tablePositions[:nCached], axis=1)
+    changed |= numpy.array([labels[i] != self.tableLabels[i] for i in range(nCached)], dtype=bool)
+    return numpy.concatenate([numpy.nonzero(changed)[0], numpy.arange(nCached, nRows)])
 
-    # Update selected node, add observer, and update control points
-    if self.targetFiducialsSelector.currentNode():
-      self.targetFiducialsNode = self.targetFiducialsSelector.currentNode()
-      self.tag = self.targetFiducialsNode.AddObserver('ModifiedEvent', self.onFiducialsUpdated)
+  def onFiducialsSelected(self):
+    self.setTargetFiducialsNode(self.targetFiducialsSelector.currentNode())
+    self.resetTableCache()
     self.updateTable()
 
+  def setTargetFiducialsNode(self, node):
+    # Moves the observer from the previous targets node (if any) to node (None: no targets)
+    if self.targetFiducialsNode is not None and self.tag is not None:
+      self.targetFiducialsNode.RemoveObserver(self.tag)
+    self.tag = None
+    self.targetFiducialsNode = node
+    if node is not None:
+      self.tag = node.AddObserver('ModifiedEvent', self.onFiducialsUpdated)
+
   def onFiducialsUpdated(self,caller,event):
+    instrumentation.count('event.fiducialsModified')
     if caller.IsA('vtkMRMLMarkupsFiducialNode') and event == 'ModifiedEvent':
-      self.updateTable()
+      self.tableScheduler.schedule()
+
+  def updateStatisticsTable(self):
+    rows = instrumentation.getRows()
+    self.statisticsTable.setRowCount(len(rows))
+    for (i, row) in enumerate(rows):
+      texts = [row[0], str(row[1])] + ['%.3f' % value for value in row[2:]]
+      for (column, text) in enumerate(texts):
+        self.statisticsTable.setItem(i, column, qt.QTableWidgetItem(text))
+
+  def onResetStatistics(self):
+    instrumentation.reset()
+    self.updateStatisticsTable()
+
+  def onExportStatistics(self):
+    path = qt.QFileDialog.getSaveFileName(None, "Export Statistics", "", "CSV files (*.csv)")
+    if path:
+      instrumentation.exportCSV(path)
+
+  def onLevelOfDetailChanged(self, levelOfDetail):
+    self.logic.setLevelOfDetail(levelOfDetail)
+
+  def onMeasureRendering(self):
+    results = self.logic.measureLevelsOfDetail()
+    self.renderingReportLabel.text = '\n'.join('%s: %d triangles, %.1f ms/frame' % result for result in results)
+    self.updateStatisticsTable()
 
   def onReload(self, moduleName="NeedleGuideTemplate"):
     # Generic reload method for any scripted module.
@@ -212,39 +646,88 @@ class NeedleGuideTemplateWidget(ScriptedLoadableModuleWidget, ModuleWidgetMixin)
     globals()[moduleName] = slicer.util.reloadScriptedModule(moduleName)
 
   def onShowTemplate(self):
-    print "onShowTemplate(self)"
+    logger.debug('onShowTemplate(self)')
     self.logic.setTemplateVisibility(self.showTemplateCheckBox.checked)
 
   def onShowTrajectories(self):
-    print "onTrajectories(self)"
+    logger.debug('onTrajectories(self)')
     self.logic.setNeedlePathVisibility(self.showTrajectoriesCheckBox.checked)
 
+  def onShowReachability(self):
+    logger.debug('onShowReachability(self)')
+    volume = self.inputVolumeSelector.currentNode() if self.showReachabilityCheckBox.checked else None
+    self.logic.setReachabilityVolume(volume)
+    labelNodeID = self.logic.reachabilityLabelNodeID if volume else None
+    for viewName in ["Red", "Green", "Yellow"]:
+      compositeNode = self.layoutManager.sliceWidget(viewName).mrmlSliceCompositeNode()
+      compositeNode.SetLabelVolumeID(labelNodeID)
+
+  def onBackgroundTaskProgress(self, task):
+    if task.title is None:
+      return
+    progressIndicator = self.progressIndicators.get(task)
+    if task.finished or task.cancelled:
+      if progressIndicator is not None:
+        progressIndicator.close()
+        del self.progressIndicators[task]
+      return
+    if progressIndicator is None:
+      progressIndicator = self.makeProgressIndicator(100)
+      progressIndicator.modal = False
+      progressIndicator.labelText = task.title
+      progressIndicator.connect('canceled()', lambda key=task.key: self.worker.cancel(key))
+      self.progressIndicators[task] = progressIndicator
+    progressIndicator.setValue(int(task.progress * 100))
+
   def onOpenWindowButton(self):
-    print "onOpenWindowButton(self) is called!!!"
-    self.ex = ProjectionWindow()
+    logger.debug('onOpenWindowButton(self) is called')
+    if self.ex is None:
+      self.ex = ProjectionWindow()
+      self.ex.setTemplate(self.logic.templateIndex)
+      self.ex.setTargets(self.getProjectionTargets())
     self.ex.show()
+    self.ex.raise_()
+
+  def onTableClicked(self, index):
+    row = self.tableModel.getTargetRow(index.row())
+    if row >= 0:
+      self.onTableSelected(row, index.column())
 
+  @timed('widget.onTableSelected')
   def onTableSelected(self, row, column):
-    print "onTableSelected(%d, %d)" % (row, column)
+    logger.debug('onTableSelected(%d, %d)', row, column)
     pos = [0.0, 0.0, 0.0]
     self.targetFiducialsNode.GetNthFiducialPosition(row,pos)
-    (indexX, indexY, depth, inRange) = self.logic.computeNearestPath(pos)
-
-    print "index = " 
-    print indexX
-    print indexY
-
-    d = 20
-    Letters={'A': .5,'B': 1.5,'C': 2.5,'D': 3.5,'E': 4.5,'F': 5.5,'G': 6.5,'H': 7.5,'I': 8.5,'J':9.5,'K':10.5,'L':11.5,'M':12.5,'N':13.5}
-    Numbers={'-7' : .5,'-6' : 1.5,'-5' : 2.5,'-4' : 3.5,'-3' : 4.5,'-2' : 5.5,'-1' : 6.5, '0' : 7.5, '1' : 8.5, '2' : 9.5, '3' : 10.5, '4' : 11.5, '5' : 12.5, '6' : 13.5, '7' : 14.5}
-
-    ConvertedL = Letters[indexX]
-    ConvertedN = Numbers[indexY]
-    x = ConvertedL * d + 50
-    y = ConvertedN * d
-
-    self.ex.setXY(x, y)		
-    self.ex.repaint()
+    (indices, depths, inRange) = self.logic.computeNearestPaths([pos])
+    (indexX, indexY) = self.logic.getHoleIndex(indices[0])
+    self.logic.setSelectedHole(indices[0])
+
+    logger.debug('index = (%s, %s)', indexX, indexY)
+
+    if self.ex is not None:
+      self.ex.setSelection(indexX, indexY)
+
+    self.updateAlternativesTable(pos)
+
+  def updateAlternativesTable(self, pos):
+    count = self.alternativesSpinBox.value
+    if count == 0:
+      self.alternativesTable.hide()
+      return
+    candidates = self.logic.computeCandidatePath(pos, count)
+    self.alternativesTable.setRowCount(len(candidates))
+    for (rank, (indexX, indexY, tilt, depth, inRange, distance, blocked)) in enumerate(candidates):
+      holestr = '(%s, %s)' % (indexX, indexY)
+      if tilt > 0:
+        holestr += ' %.1f deg' % tilt
+      depthstr = '%.3f' % depth if inRange else '(%.3f)' % depth
+      if self.logic.obstacleMap is None:
+        pathstr = ''
+      else:
+        pathstr = 'blocked' if blocked else 'clear'
+      for (column, text) in enumerate([str(rank + 1), holestr, '%.3f' % distance, depthstr, pathstr]):
+        self.alternativesTable.setItem(rank, column, qt.QTableWidgetItem(text))
+    self.alternativesTable.show()
 
 
 #
@@ -261,52 +744,150 @@ class NeedleGuideTemplateLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  GEOMETRY_CACHE_DIRECTORY_NAME = "NeedleGuideTemplate/GeometryCache"
+  MAX_TRANSFORM_UPDATE_RATE = 30.0  # Maximum number of needle path updates per second while the template is moved
+  MAX_REACHABILITY_UPDATE_RATE = 1.0  # Maximum number of reachability map updates per second
+  SLICE_VIEW_NAMES = ("Red", "Green", "Yellow")  # Slice views showing the needle path intersections
+  MARKER_SEARCH_MARGIN = 30.0  # Distance in mm around the template within which markers are searched
+  MIN_MARKER_VOLUME = 5.0  # Smallest volume in mm^3 of a detected marker; smaller components are noise
+  MAX_MARKER_VOLUME = 2000.0  # Largest volume in mm^3 of a detected marker
+
   def __init__(self, parent=None):
     ScriptedLoadableModuleLogic.__init__(self, parent)
 
-    self.fiducialName = ''
-    self.fiducialConfig = []
+    self.fiducialName = []  ## Labels of the fiducial markers of the template
+    self.fiducialConfig = numpy.zeros((0, 3))  ## Marker positions in template coordinates, M x 3
     self.templateName = ''
     self.templateConfig = []
     self.templateIndex = []
     self.templateMaxDepth = []
+    self.templateDirections = None  ## Additional allowed directions of every hole of angulated templates
     self.templateModelNodeID = ''
     self.needlePathModelNodeID = ''
-    self.templatePathOrigins = []  ## Origins of needle paths
-    self.templatePathVectors = []  ## Normal vectors of needle paths 
-    self.pathOrigins = []  ## Origins of needle paths (after transformation by parent transform node)
-    self.pathVectors = []  ## Normal vectors of needle paths (after transformation by parent transform node)
+    self.tempModelNode = None
+    self.pathModelNode = None
+    self.modelNodetag = None  ## Observer of the transform of tempModelNode
+    self.selectedPathModelNodeID = ''  ## High detail model of the paths of the selected hole
+    self.selectedHole = -1
+    self.levelOfDetail = LOD_AUTO  ## Requested level of detail of the template and needle path models
+    self.appliedLevelOfDetail = None  ## Level of detail of the current models (LOD_AUTO resolved)
+    self.glyphActors = {}  ## Model name -> actor rendering the model as instanced glyphs (LOD_GLYPHS only)
+    self.sliceIntersectionNodeIDs = {}  ## Slice view name -> markups node of the needle path intersections
+    self.sliceIntersectionMatrices = {}  ## Slice view name -> sliceToRAS the intersections were computed for
+    self.sliceObserverTags = []  ## (slice node, observer tag) while the intersections are shown
+    self.templatePathOrigins = numpy.zeros((0, 4))  ## Origins of needle paths in homogeneous coordinates (w=1), H x 4
+    self.templatePathVectors = numpy.zeros((0, 4))  ## Normal vectors of needle paths in homogeneous coordinates (w=0), H x 4
+    self.templatePathMaxDepths = numpy.zeros(0)  ## Maximum depth of every needle path
+    self.templatePathHoles = numpy.zeros(0, dtype=numpy.intp)  ## Hole of every needle path
+    self.templatePathAngles = numpy.zeros(0, dtype=numpy.intp)  ## Direction of every needle path within its hole (0: nominal)
+    self.templatePathStarts = numpy.zeros(0, dtype=numpy.intp)  ## Index of the nominal needle path of every hole
+    self.templatePathTilts = numpy.zeros(0)  ## Angle in degrees between every needle path and its nominal path
+    self.appliedMatrix = None  ## World matrix pathOrigins/pathVectors were computed with
+    self.pathOrigins = asPathArray([])  ## Origins of needle paths (after transformation by parent transform node), H x 3
+    self.pathVectors = asPathArray([])  ## Normal vectors of needle paths (after transformation by parent transform node), H x 3
+    self.pathIndex = None  ## Spatial index over pathOrigins/pathVectors (None if brute force search is used)
+    self.pathVersion = 0  ## Incremented whenever the needle paths change
+    self.pathsUpdatedCallback = None  ## Called after the needle paths changed
+    self.transformScheduler = RecomputeScheduler(self.processTransformUpdate, self.MAX_TRANSFORM_UPDATE_RATE)
+    self.liveTracking = False  ## Process every streamed transform immediately, dropping all but the latest
+    self.latencyMonitor = LatencyMonitor()  ## Latency of transform updates in live tracking mode
+    self.liveTrackingFrameDeferred = False  ## The current transform update continues in the background
+    self.liveTrackingCallback = None  ## Called after every processed transform update in live tracking mode
+    self.transformReplay = None  ## TransformReplay created by createTransformReplay (None if there is none)
+    self.reachabilityVolumeNode = None  ## Volume whose grid the reachability map covers (None if disabled)
+    self.reachabilityMap = None  ## ReachabilityMap of the current needle paths (None if disabled or outdated)
+    self.reachabilityLabelNodeID = ''  ## Label map of the in-range voxels
+    self.reachabilityHoleNodeID = ''  ## Scalar volume of the nearest hole index of every voxel
+    self.reachabilityDepthNodeID = ''  ## Scalar volume of the insertion depth of every voxel
+    self.reachabilityScheduler = RecomputeScheduler(self.updateReachabilityMap, self.MAX_REACHABILITY_UPDATE_RATE)
+    self.obstacleMap = None  ## ObstacleMap of the critical structures needle paths must avoid (None if disabled)
+    self.worker = None  ## BackgroundWorker running heavy computations (None runs them synchronously)
+    self.templateConfigHash = ''  ## Content hash of the loaded template configuration file
+    self.geometryCache = GeometryCache(os.path.join(slicer.app.temporaryPath, self.GEOMETRY_CACHE_DIRECTORY_NAME))
 
+  def cleanup(self):
+    # Removes the observers, nodes and actors the logic added to the scene and the views and stops its timers.
+    # The logic stays usable: the nodes are created again when the next template is loaded.
+    if self.transformReplay is not None:
+      self.transformReplay.stop()
+      self.transformReplay = None
+    self.transformScheduler.cancel()
+    self.reachabilityScheduler.cancel()
+    self.cancelTask('templateModel')
+    self.cancelTask('reachabilityMap')
+    self.setSliceIntersectionVisibility(False)
+    self.removeGlyphActors()
+    if self.tempModelNode is not None and self.modelNodetag is not None:
+      self.tempModelNode.RemoveObserver(self.modelNodetag)
+    self.modelNodetag = None
+    self.tempModelNode = None
+    self.pathModelNode = None
+
+    nodeIDs = [self.templateModelNodeID, self.needlePathModelNodeID, self.selectedPathModelNodeID,
+               self.reachabilityLabelNodeID, self.reachabilityHoleNodeID, self.reachabilityDepthNodeID]
+    for nodeID in nodeIDs + list(self.sliceIntersectionNodeIDs.values()):
+      self.removeNode(nodeID)
+    self.templateModelNodeID = ''
+    self.needlePathModelNodeID = ''
+    self.selectedPathModelNodeID = ''
+    self.reachabilityLabelNodeID = ''
+    self.reachabilityHoleNodeID = ''
+    self.reachabilityDepthNodeID = ''
+    self.sliceIntersectionNodeIDs = {}
+    self.reachabilityVolumeNode = None
+    self.reachabilityMap = None
+    self.obstacleMap = None
+    self.appliedMatrix = None
+
+  @staticmethod
+  def removeNode(nodeID):
+    # Removes a node and its display nodes from the scene (nothing happens if it no longer exists)
+    node = slicer.mrmlScene.GetNodeByID(nodeID) if nodeID else None
+    if node is None:
+      return
+    if node.IsA('vtkMRMLDisplayableNode'):
+      displayNodes = [node.GetNthDisplayNode(i) for i in range(node.GetNumberOfDisplayNodes())]
+      for displayNode in displayNodes:
+        if displayNode is not None:
+          slicer.mrmlScene.RemoveNode(displayNode)
+    slicer.mrmlScene.RemoveNode(node)
+
+  @timed('logic.loadTemplateConfigFile')
   def loadTemplateConfigFile(self, path):
     self.templateIndex = []
     self.templateConfig = []
+    self.templateConfigHash = ''
+    self.selectedHole = -1
+    self.fiducialName = []
+    self.fiducialConfig = numpy.zeros((0, 3))
     
-    header = False
-    reader = csv.reader(open(path, 'rb'))
     try:
-      for row in reader:
-        if header:
-          self.templateIndex.append(row[0:2])
-          self.templateConfig.append([float(row[2]), float(row[3]), float(row[4]),
-                                      float(row[5]), float(row[6]), float(row[7]),
-                                      float(row[8])])
-        else:
-          self.templateName = row[0]
-          header = True
-    except csv.Error as e:
-      print('file %s, line %d: %s' % (path, reader.line_num, e))
+      # Binary templates (.npy) are memory mapped; templateIndex, templateConfig and the template path origins,
+      # vectors and depths are views of the file
+      (name, index, config, directions, paths) = loadTemplateFile(path)
+      (self.fiducialName, self.fiducialConfig) = loadFiducialConfig(path)
+    except (csv.Error, ValueError, IOError) as e:
+      logger.error('file %s, %s', path, e)
       return False
 
+    (self.templateName, self.templateIndex, self.templateConfig, self.templateDirections) = (name, index, config,
+                                                                                             directions)
+    (self.templatePathOrigins, self.templatePathVectors, self.templatePathMaxDepths, self.templatePathHoles,
+     self.templatePathAngles) = paths
+    self.templatePathStarts = numpy.nonzero(self.templatePathAngles == 0)[0]
+    self.templatePathTilts = computePathTilts(self.templatePathVectors, self.templatePathHoles, self.templatePathAngles)
+
+    self.templateConfigHash = hashFile(path)
     self.createTemplateModel()
     self.setTemplateVisibility(0)
     self.setNeedlePathVisibility(0)
     self.updateTemplateVectors()
     return True
     
+  @timed('logic.createTemplateModel')
   def createTemplateModel(self):
     
-    self.templatePathVectors = []
-    self.templatePathOrigins = []
+    self.appliedMatrix = None
 
     self.tempModelNode = slicer.mrmlScene.GetNodeByID(self.templateModelNodeID)
     if self.tempModelNode is None:
@@ -333,61 +914,238 @@ class NeedleGuideTemplateLogic(ScriptedLoadableModuleLogic):
       slicer.mrmlScene.AddNode(dnode)
       self.pathModelNode.SetAndObserveDisplayNodeID(dnode.GetID())
       
-    pathModelAppend = vtk.vtkAppendPolyData()
-    tempModelAppend = vtk.vtkAppendPolyData()
-    
-    for row in self.templateConfig:
-
-      p1 = numpy.array(row[0:3])
-      p2 = numpy.array(row[3:6])
-      tempLineSource = vtk.vtkLineSource()
-      tempLineSource.SetPoint1(p1)
-      tempLineSource.SetPoint2(p2)
- 
-      tempTubeFilter = vtk.vtkTubeFilter()
-      tempTubeFilter.SetInputConnection(tempLineSource.GetOutputPort())
-      tempTubeFilter.SetRadius(1.0)
-      tempTubeFilter.SetNumberOfSides(18)
-      tempTubeFilter.CappingOn()
-      tempTubeFilter.Update()
-
-      pathLineSource = vtk.vtkLineSource()
-      v = p2-p1
-      nl = numpy.linalg.norm(v)
-      n = v/nl  # normal vector
-      l = row[6]
-      p3 = p1 + l * n
-      pathLineSource.SetPoint1(p1)
-      pathLineSource.SetPoint2(p3)
-
-      self.templatePathOrigins.append([row[0], row[1], row[2], 1.0])
-      self.templatePathVectors.append([n[0], n[1], n[2], 1.0])
-      self.templateMaxDepth.append(row[6])
- 
-      pathTubeFilter = vtk.vtkTubeFilter()
-      pathTubeFilter.SetInputConnection(pathLineSource.GetOutputPort())
-      pathTubeFilter.SetRadius(0.8)
-      pathTubeFilter.SetNumberOfSides(18)
-      pathTubeFilter.CappingOn()
-      pathTubeFilter.Update()
-
-      if vtk.VTK_MAJOR_VERSION <= 5:
-        tempModelAppend.AddInput(tempTubeFilter.GetOutput())
-        pathModelAppend.AddInput(pathTubeFilter.GetOutput())
-      else:
-        tempModelAppend.AddInputData(tempTubeFilter.GetOutput())
-        pathModelAppend.AddInputData(pathTubeFilter.GetOutput())
-
-      tempModelAppend.Update()
-      self.tempModelNode.SetAndObservePolyData(tempModelAppend.GetOutput())
-      pathModelAppend.Update()
-      self.pathModelNode.SetAndObservePolyData(pathModelAppend.GetOutput())
+    config = numpy.asarray(self.templateConfig, dtype=numpy.float64).reshape(-1, 7)
+    self.templateMaxDepth = config[:, 6].tolist()
+    p1 = config[:, 0:3]
+    p2 = config[:, 3:6]
+    # Angulated holes show the fan of all allowed needle paths
+    p3 = self.templatePathOrigins[:, 0:3] + self.templatePathMaxDepths[:, numpy.newaxis] * self.templatePathVectors[:, 0:3]
+    p4 = self.templatePathOrigins[:, 0:3]
+
+    # Meshes of all holes are generated at once and each model is assigned its polydata exactly once
+    configHash = self.templateConfigHash
+    level = selectLevelOfDetail(self.levelOfDetail, len(config) + len(self.templatePathOrigins))
+    models = [(self.tempModelNode, 'template', p1, p2, 1.0), (self.pathModelNode, 'path', p4, p3, 0.8)]
+
+    def createMeshes(task):
+      if level == LOD_LINES:
+        return [createLineMesh(start, end) for (node, name, start, end, radius) in models]
+      if level == LOD_GLYPHS:
+        return [computeGlyphArrays(start, end, radius) for (node, name, start, end, radius) in models]
+      return [self.getTubeMesh(name, start, end, radius, TUBE_SIDES[level], configHash)
+              for (node, name, start, end, radius) in models]
+
+    def setMeshes(meshes):
+      self.removeGlyphActors()
+      for ((node, name, start, end, radius), mesh) in zip(models, meshes):
+        if level == LOD_LINES:
+          node.SetAndObservePolyData(self.createLinePolyData(*mesh))
+        elif level == LOD_GLYPHS:
+          # The model keeps an empty mesh; it still carries the transform and visibility of the glyphs
+          node.SetAndObservePolyData(vtk.vtkPolyData())
+          self.glyphActors[name] = self.createGlyphActor(*mesh)
+        else:
+          node.SetAndObservePolyData(self.createPolyData(*mesh))
+      self.appliedLevelOfDetail = level
+      self.updateGlyphActors()
+
+    self.runTask('templateModel', createMeshes, setMeshes, "Building template model...")
+    if self.selectedPathModelNodeID:
+      self.setSelectedHole(self.selectedHole)
+
+  def setLevelOfDetail(self, levelOfDetail):
+    # Rebuilds the template and needle path models at one of LEVELS_OF_DETAIL
+    self.levelOfDetail = levelOfDetail
+    if self.templateModelNodeID:
+      self.createTemplateModel()
+
+  def countTriangles(self, levelOfDetail=None):
+    # Returns the number of triangles of the template and needle path models at the given or the applied level
+    if levelOfDetail is None:
+      levelOfDetail = self.appliedLevelOfDetail
+    numberOfTubes = len(self.templateConfig) + len(self.templatePathOrigins)
+    return countTriangles(selectLevelOfDetail(levelOfDetail, numberOfTubes), numberOfTubes)
+
+  def measureLevelsOfDetail(self, numberOfFrames=20):
+    # Renders the 3D views numberOfFrames times at every level of detail
+    #  [(level, triangles, milliseconds per frame), ...] = measureLevelsOfDetail()
+    # The models are rebuilt synchronously and the previous level of detail is restored afterwards.
+
+    (previousLevel, worker) = (self.levelOfDetail, self.worker)
+    renderWindows = [renderer.GetRenderWindow() for renderer in self.getThreeDRenderers()]
+    results = []
+    self.cancelTask('templateModel')
+    self.worker = None
+    try:
+      for level in LEVELS_OF_DETAIL[1:]:
+        self.setLevelOfDetail(level)
+        start = time.time()
+        for i in range(numberOfFrames):
+          for renderWindow in renderWindows:
+            renderWindow.Render()
+        seconds = (time.time() - start) / numberOfFrames
+        instrumentation.addTime('render.' + level, seconds)
+        results.append((level, self.countTriangles(level), seconds * 1000.0))
+    finally:
+      self.worker = worker
+      self.setLevelOfDetail(previousLevel)
+    return results
+
+  def setSelectedHole(self, index):
+    # Shows the needle paths of hole index as high detail tubes whatever the level of detail is (-1 hides them)
+    self.selectedHole = index
+    node = slicer.mrmlScene.GetNodeByID(self.selectedPathModelNodeID) if self.selectedPathModelNodeID else None
+    if node is None:
+      node = slicer.vtkMRMLModelNode()
+      node.SetName('NeedleGuideSelectedPath')
+      slicer.mrmlScene.AddNode(node)
+      self.selectedPathModelNodeID = node.GetID()
+      dnode = slicer.vtkMRMLModelDisplayNode()
+      dnode.SetColor(1.0, 1.0, 0.0)
+      # The selected paths are shown and hidden with the other trajectories
+      dnode.SetVisibility(self.getModelVisibilityByID(self.needlePathModelNodeID))
+      slicer.mrmlScene.AddNode(dnode)
+      node.SetAndObserveDisplayNodeID(dnode.GetID())
+      if self.pathModelNode:
+        node.SetAndObserveTransformNodeID(self.pathModelNode.GetTransformNodeID())
+
+    paths = numpy.nonzero(self.templatePathHoles == index)[0]
+    starts = self.templatePathOrigins[paths, 0:3]
+    ends = starts + self.templatePathMaxDepths[paths, numpy.newaxis] * self.templatePathVectors[paths, 0:3]
+    node.SetAndObservePolyData(self.createPolyData(*createTubeMesh(starts, ends, 0.8, TUBE_SIDES[LOD_HIGH])))
+
+  @staticmethod
+  def getThreeDRenderers():
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None:
+      return []
+    return [layoutManager.threeDWidget(i).threeDView().renderWindow().GetRenderers().GetFirstRenderer()
+            for i in range(layoutManager.threeDViewCount)]
+
+  def createGlyphActor(self, centers, directions, scales):
+    # Renders one cylinder per segment with a single vtkGlyph3DMapper, which instances the cylinder on the GPU
+    points = vtk.vtkPolyData()
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(centers, deep=True))
+    points.SetPoints(vtkPoints)
+    for (name, array) in (('Directions', directions), ('Scales', scales)):
+      vtkArray = numpy_support.numpy_to_vtk(array, deep=True)
+      vtkArray.SetName(name)
+      points.GetPointData().AddArray(vtkArray)
+
+    # vtkCylinderSource is aligned with the y axis and glyphs are oriented along their x axis
+    cylinder = vtk.vtkCylinderSource()
+    cylinder.SetResolution(TUBE_SIDES[LOD_GLYPHS])
+    rotation = vtk.vtkTransform()
+    rotation.RotateZ(-90.0)
+    source = vtk.vtkTransformPolyDataFilter()
+    source.SetTransform(rotation)
+    source.SetInputConnection(cylinder.GetOutputPort())
+
+    mapper = vtk.vtkGlyph3DMapper()
+    if vtk.VTK_MAJOR_VERSION <= 5:
+      mapper.SetInput(points)
+    else:
+      mapper.SetInputData(points)
+    mapper.SetSourceConnection(source.GetOutputPort())
+    mapper.SetOrientationArray('Directions')
+    mapper.SetOrientationModeToDirection()
+    mapper.SetScaleArray('Scales')
+    mapper.SetScaleModeToScaleByVectorComponents()
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    for renderer in self.getThreeDRenderers():
+      renderer.AddActor(actor)
+    return actor
+
+  def removeGlyphActors(self):
+    for actor in self.glyphActors.values():
+      for renderer in self.getThreeDRenderers():
+        renderer.RemoveActor(actor)
+    self.glyphActors = {}
+
+  def updateGlyphActors(self):
+    # Glyph actors are not part of the scene; they follow the visibility and transform of their model nodes
+    for (name, nodeID) in (('template', self.templateModelNodeID), ('path', self.needlePathModelNodeID)):
+      actor = self.glyphActors.get(name)
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      if actor is None or node is None:
+        continue
+      dnode = node.GetDisplayNode()
+      actor.SetVisibility(dnode is not None and dnode.GetVisibility())
+      matrix = vtk.vtkMatrix4x4()
+      tnode = node.GetParentTransformNode()
+      if tnode is not None:
+        tnode.GetMatrixTransformToWorld(matrix)
+      actor.SetUserMatrix(matrix)
+
+  def runTask(self, key, function, onDone, title=None):
+    # Runs function(task) on the background worker and onDone(result) on the main thread once it finishes.
+    # Without a worker both run immediately and task is None.
+    if self.worker is None:
+      onDone(function(None))
+    else:
+      self.worker.submit(key, function, onDone, title=title)
+
+  def cancelTask(self, key):
+    if self.worker is not None:
+      self.worker.cancel(key)
+
+  def getTubeMesh(self, name, startPoints, endPoints, radius, numberOfSides, configHash=None):
+    # Returns the tube mesh from the geometry cache if the same configuration file was loaded before
+    if configHash is None:
+      configHash = self.templateConfigHash
+    if not configHash or self.geometryCache is None:
+      return createTubeMesh(startPoints, endPoints, radius, numberOfSides)
+    key = self.geometryCache.makeKey(configHash, name, radius, numberOfSides)
+    mesh = self.geometryCache.load(key)
+    if mesh is None:
+      mesh = createTubeMesh(startPoints, endPoints, radius, numberOfSides)
+      self.geometryCache.store(key, mesh)
+    return mesh
+
+  @classmethod
+  def createPolyData(cls, points, normals, polys, numberOfCells):
+    polyData = cls.createMeshPolyData(points, polys, numberOfCells, 'polys')
+    vtkNormals = numpy_support.numpy_to_vtk(normals, deep=True)
+    vtkNormals.SetName('TubeNormals')
+    polyData.GetPointData().SetNormals(vtkNormals)
+    return polyData
+
+  @classmethod
+  def createLinePolyData(cls, points, lines, numberOfCells):
+    return cls.createMeshPolyData(points, lines, numberOfCells, 'lines')
+
+  @staticmethod
+  def createMeshPolyData(points, cells, numberOfCells, cellType):
+    # Imports N x 3 points and cells in the legacy (count, ids...) layout as the polys or lines of a vtkPolyData
+    polyData = vtk.vtkPolyData()
+
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    polyData.SetPoints(vtkPoints)
+
+    idType = numpy.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else numpy.int32
+    cellArray = vtk.vtkCellArray()
+    legacyCells = numpy_support.numpy_to_vtkIdTypeArray(cells.astype(idType), deep=True)
+    if hasattr(cellArray, 'ImportLegacyFormat'):
+      cellArray.ImportLegacyFormat(legacyCells)
+    else:
+      cellArray.SetCells(numberOfCells, legacyCells)
+    if cellType == 'lines':
+      polyData.SetLines(cellArray)
+    else:
+      polyData.SetPolys(cellArray)
+    return polyData
 
   def setTransform(self, transform):
     if self.pathModelNode:
       self.pathModelNode.SetAndObserveTransformNodeID(transform.GetID())
     if self.tempModelNode:
       self.tempModelNode.SetAndObserveTransformNodeID(transform.GetID())
+    selectedNode = slicer.mrmlScene.GetNodeByID(self.selectedPathModelNodeID) if self.selectedPathModelNodeID else None
+    if selectedNode:
+      selectedNode.SetAndObserveTransformNodeID(transform.GetID())
 
   def setModelVisibilityByID(self, id, visible):
 
@@ -397,6 +1155,12 @@ class NeedleGuideTemplateLogic(ScriptedLoadableModuleLogic):
       if dnode is not None:
         dnode.SetVisibility(visible)
 
+  def getModelVisibilityByID(self, id):
+
+    mnode = slicer.mrmlScene.GetNodeByID(id) if id else None
+    dnode = mnode.GetDisplayNode() if mnode is not None else None
+    return bool(dnode is not None and dnode.GetVisibility())
+
   def setModelSliceIntersectionVisibilityByID(self, id, visible):
 
     mnode = slicer.mrmlScene.GetNodeByID(id)
@@ -407,18 +1171,239 @@ class NeedleGuideTemplateLogic(ScriptedLoadableModuleLogic):
         
   def setTemplateVisibility(self, visibility):
     self.setModelVisibilityByID(self.templateModelNodeID, visibility)
+    self.updateGlyphActors()
 
   def setNeedlePathVisibility(self, visibility):
     self.setModelVisibilityByID(self.needlePathModelNodeID, visibility)
-    self.setModelSliceIntersectionVisibilityByID(self.needlePathModelNodeID, visibility)
+    self.setModelVisibilityByID(self.selectedPathModelNodeID, visibility)
+    # Cutting every tube against the slice planes is slow; the path intersections are computed analytically instead
+    self.setModelSliceIntersectionVisibilityByID(self.needlePathModelNodeID, False)
+    self.setSliceIntersectionVisibility(visibility)
+    self.updateGlyphActors()
+
+  def setSliceIntersectionVisibility(self, visibility):
+    # Shows a labeled marker where each needle path crosses the Red, Green and Yellow slice planes
+    for (sliceNode, tag) in self.sliceObserverTags:
+      sliceNode.RemoveObserver(tag)
+    self.sliceObserverTags = []
+    self.sliceIntersectionMatrices = {}
+    for nodeID in self.sliceIntersectionNodeIDs.values():
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      if node is not None:
+        node.SetDisplayVisibility(visibility)
+    if not visibility:
+      return
+
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None:
+      return
+    for name in self.SLICE_VIEW_NAMES:
+      sliceWidget = layoutManager.sliceWidget(name)
+      if sliceWidget is None:
+        continue
+      sliceNode = sliceWidget.mrmlSliceNode()
+      tag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                  lambda caller, event, name=name: self.updateSliceIntersections(name, caller))
+      self.sliceObserverTags.append((sliceNode, tag))
+    self.updateSliceIntersections()
+
+  @timed('logic.updateSliceIntersections')
+  def updateSliceIntersections(self, viewName=None, sliceNode=None):
+    # Updates the intersections of one slice view, or of all observed views if viewName is None.
+    # A view is only recomputed if its slice plane moved or the needle paths changed since its last update.
+
+    # Pending transform updates come first; they reset the cached planes and update all views themselves
+    self.transformScheduler.flush()
+    if viewName is None:
+      for (node, tag) in self.sliceObserverTags:
+        self.updateSliceIntersections(node.GetLayoutName(), node)
+      return
+    matrix = self.arrayFromVTKMatrix(sliceNode.GetSliceToRAS())
+    previous = self.sliceIntersectionMatrices.get(viewName)
+    if previous is not None and numpy.array_equal(previous, matrix):
+      return
+    self.sliceIntersectionMatrices[viewName] = matrix
+
+    ends = self.pathOrigins + self.templatePathMaxDepths[:, numpy.newaxis] * self.pathVectors
+    (paths, points) = intersectSegmentsWithPlane(self.pathOrigins, ends, matrix)
+    labels = ['%s%s' % self.getHoleIndex(self.templatePathHoles[path]) for path in paths]
+    node = self.getSliceIntersectionNode(viewName, sliceNode)
+    self.setMarkups(node, points, labels)
+
+  def getSliceIntersectionNode(self, viewName, sliceNode):
+    nodeID = self.sliceIntersectionNodeIDs.get(viewName)
+    node = slicer.mrmlScene.GetNodeByID(nodeID) if nodeID else None
+    if node is None:
+      node = slicer.vtkMRMLMarkupsFiducialNode()
+      node.SetName('NeedleGuidePathIntersections' + viewName)
+      node.SetLocked(True)
+      # Derived from the paths: neither offered in node selectors (e.g. as targets) nor saved with the scene
+      node.SetHideFromEditors(1)
+      node.SetSaveWithScene(0)
+      slicer.mrmlScene.AddNode(node)
+      node.CreateDefaultDisplayNodes()
+      dnode = node.GetDisplayNode()
+      dnode.SetHideFromEditors(1)
+      dnode.SetSaveWithScene(0)
+      dnode.SetGlyphScale(1.5)
+      dnode.SetTextScale(1.5)
+      # Each view only shows the crossings of its own plane
+      dnode.AddViewNodeID(sliceNode.GetID())
+      self.sliceIntersectionNodeIDs[viewName] = node.GetID()
+    return node
+
+  @staticmethod
+  def setMarkups(node, points, labels):
+    # Moves the existing control points instead of recreating them, in a single modified event
+    wasModifying = node.StartModify()
+    for i in range(node.GetNumberOfFiducials() - 1, len(points) - 1, -1):
+      node.RemoveMarkup(i)
+    nExisting = node.GetNumberOfFiducials()
+    for (i, (point, label)) in enumerate(zip(points, labels)):
+      if i < nExisting:
+        node.SetNthFiducialPosition(i, point[0], point[1], point[2])
+        if node.GetNthFiducialLabel(i) != label:
+          node.SetNthFiducialLabel(i, label)
+      else:
+        node.AddFiducial(point[0], point[1], point[2], label)
+    node.EndModify(wasModifying)
 
     #def onFiducialsUpdated(self,caller,event):
   def onTemplateTransformUpdated(self,caller,event):
-    print 'onTemplateTransformUpdated()'
+    logger.debug('onTemplateTransformUpdated()')
+    instrumentation.count('event.templateTransformModified')
+    if self.liveTracking:
+      self.latencyMonitor.frameReceived()
+    self.transformScheduler.schedule()
+
+  def setLiveTracking(self, enabled):
+    # In live tracking mode transform updates are processed on the next pass of the event loop instead of at
+    # MAX_TRANSFORM_UPDATE_RATE. Transforms that arrive in the meantime are merged, so only the latest one is used.
+    self.liveTracking = enabled
+    self.transformScheduler.setMaximumRate(0 if enabled else self.MAX_TRANSFORM_UPDATE_RATE)
+    self.latencyMonitor.reset()
+    self.liveTrackingFrameDeferred = False
+
+  def processTransformUpdate(self):
+    # Applies the latest template transform. pathsUpdatedCallback runs as part of this call, so in live tracking
+    # mode the measured latency covers the update of everything that depends on the needle paths. Updates that
+    # pathsUpdatedCallback hands to a background task end with completeLiveTrackingFrame instead.
+    self.liveTrackingFrameDeferred = False
     self.updateTemplateVectors()
-
+    if self.liveTracking and not self.liveTrackingFrameDeferred:
+      self.finishLiveTrackingFrame()
+
+  def deferLiveTrackingFrame(self):
+    # Called by pathsUpdatedCallback when the current transform update continues in a background task
+    self.liveTrackingFrameDeferred = self.liveTracking
+
+  def completeLiveTrackingFrame(self):
+    # Ends the transform update deferred by deferLiveTrackingFrame once its background task has been applied.
+    # Nothing happens if no update was deferred.
+    if self.liveTrackingFrameDeferred:
+      self.liveTrackingFrameDeferred = False
+      self.finishLiveTrackingFrame()
+
+  def finishLiveTrackingFrame(self):
+    latency = self.latencyMonitor.frameProcessed()
+    if latency is not None:
+      instrumentation.addTime('liveTracking.latency', latency)
+    if self.liveTrackingCallback:
+      self.liveTrackingCallback()
+
+  def createTransformReplay(self, transformNode, matrices, rate=60.0):
+    # Returns a TransformReplay streaming matrices into transformNode, a stand-in for a tracker connection.
+    # A previously created replay is stopped.
+    def setMatrix(matrix):
+      transformNode.SetMatrixTransformToParent(self.vtkMatrixFromArray(matrix))
+    if self.transformReplay is not None:
+      self.transformReplay.stop()
+    self.transformReplay = TransformReplay(setMatrix, matrices, rate)
+    return self.transformReplay
+
+  @timed('logic.detectTemplateMarkers')
+  def detectTemplateMarkers(self, volumeNode, lower, upper=None, markersNode=None, nearTemplate=True):
+    # Finds the template markers in volumeNode as connected components of voxels with lower <= value (<= upper)
+    # and returns their RAS centroids, largest first. With nearTemplate only the region within
+    # MARKER_SEARCH_MARGIN of the markers (or holes, if the template has no markers) at the current template
+    # position is searched. The points are written into markersNode if given.
+
+    imageData = volumeNode.GetImageData()
+    if imageData is None:
+      return numpy.zeros((0, 3))
+    (nI, nJ, nK) = imageData.GetDimensions()
+    array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(nK, nJ, nI)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    matrix = self.arrayFromVTKMatrix(ijkToRAS)
+    tnode = volumeNode.GetParentTransformNode()
+    if tnode is not None:
+      toWorld = vtk.vtkMatrix4x4()
+      tnode.GetMatrixTransformToWorld(toWorld)
+      matrix = self.arrayFromVTKMatrix(toWorld).dot(matrix)
+
+    region = None
+    if nearTemplate:
+      points = self.fiducialConfig if self.fiducialConfig.shape[0] else self.templatePathOrigins[:, 0:3]
+      if points.shape[0]:
+        templateToWorld = self.appliedMatrix if self.appliedMatrix is not None else numpy.identity(4)
+        points = points.dot(templateToWorld[0:3, 0:3].T) + templateToWorld[0:3, 3]
+        region = computeRegion(matrix, (nI, nJ, nK), points, self.MARKER_SEARCH_MARGIN)
+
+    (points, volumes) = detectMarkers(array, matrix, lower, upper, self.MIN_MARKER_VOLUME, self.MAX_MARKER_VOLUME,
+                                      region)
+    if markersNode is not None:
+      self.setMarkups(markersNode, points, ['M%d' % (i + 1) for i in range(points.shape[0])])
+    return points
+
+  @timed('logic.registerTemplate')
+  def registerTemplate(self, markerPoints, transformNode, correspondences=True, maxDistance=None):
+    # Computes the template transform from the RAS positions of the template markers found in an image and writes
+    # it into transformNode. With known correspondences markerPoints[i] is fiducialConfig[i] and the transform is
+    # solved in closed form; otherwise markerPoints may be in any order and contain spurious points, and the
+    # transform is found by ICP starting from the current template pose. Pairs further apart than maxDistance (mm)
+    # are ignored by ICP. Returns the RMS error in mm, or None if the registration fails (too few markers or marker
+    # points, or fewer than 3 markers within maxDistance of a marker point); transformNode is then left unchanged.
+
+    markerPoints = asPathArray(markerPoints)
+    nMarkers = self.fiducialConfig.shape[0]
+    if nMarkers < 3 or markerPoints.shape[0] < 3:
+      logger.error('registration needs at least 3 template markers and marker points')
+      return None
+
+    # The registration maps template to world coordinates; the node holds it relative to its own parent
+    parentToWorld = numpy.identity(4)
+    parent = transformNode.GetParentTransformNode()
+    if parent is not None:
+      matrix = vtk.vtkMatrix4x4()
+      parent.GetMatrixTransformToWorld(matrix)
+      parentToWorld = self.arrayFromVTKMatrix(matrix)
+
+    if correspondences:
+      if markerPoints.shape[0] != nMarkers:
+        logger.error('%d marker points given for %d template markers', markerPoints.shape[0], nMarkers)
+        return None
+      templateToWorld = registerCorrespondingPoints(self.fiducialConfig, markerPoints)
+      error = computeRegistrationError(self.fiducialConfig, markerPoints, templateToWorld)
+    else:
+      matrix = vtk.vtkMatrix4x4()
+      transformNode.GetMatrixTransformToParent(matrix)
+      initial = parentToWorld.dot(self.arrayFromVTKMatrix(matrix))
+      try:
+        (templateToWorld, error, iterations) = registerPointSets(self.fiducialConfig, markerPoints, initial,
+                                                                 maxDistance)
+      except ValueError as e:
+        logger.error('registration failed: %s', e)
+        return None
+      instrumentation.count('registration.iterations', iterations)
+
+    transformNode.SetMatrixTransformToParent(
+      self.vtkMatrixFromArray(numpy.linalg.inv(parentToWorld).dot(templateToWorld)))
+    return error
+
+  @timed('logic.updateTemplateVectors')
   def updateTemplateVectors(self):
-    print 'updateTemplateVectors()'
+    logger.debug('updateTemplateVectors()')
 
     mnode = slicer.mrmlScene.GetNodeByID(self.templateModelNodeID)
     if mnode is None:
@@ -431,60 +1416,269 @@ class NeedleGuideTemplateLogic(ScriptedLoadableModuleLogic):
     else:
       trans.Identity()
 
-    # Calculate offset
-    zero = [0.0, 0.0, 0.0, 1.0]
-    offset = []
-    offset = trans.MultiplyDoublePoint(zero)
-    
-    self.pathOrigins = []
-    self.pathVectors = []
-
-    i = 0
-    for orig in self.templatePathOrigins:
-      torig = trans.MultiplyDoublePoint(orig)
-      self.pathOrigins.append(numpy.array(torig[0:3]))
-      vec = self.templatePathVectors[i]
-      tvec = trans.MultiplyDoublePoint(vec)
-      self.pathVectors.append(numpy.array([tvec[0]-offset[0], tvec[1]-offset[1], tvec[2]-offset[2]]))
-      i += 1
+    matrix = self.arrayFromVTKMatrix(trans)
+    if self.appliedMatrix is not None and numpy.array_equal(matrix, self.appliedMatrix):
+      return
+    self.appliedMatrix = matrix
+    if self.glyphActors:
+      self.updateGlyphActors()
+
+    # Origins are transformed as points and vectors as directions (w=0), then re-normalized
+    (self.pathOrigins, self.pathVectors) = transformTemplatePaths(self.templatePathOrigins, self.templatePathVectors,
+                                                                  matrix)
+    self.pathIndex = buildPathIndex(self.pathOrigins, self.pathVectors, self.templatePathMaxDepths)
+    self.pathVersion += 1
+    if self.sliceObserverTags:
+      self.sliceIntersectionMatrices = {}
+      self.updateSliceIntersections()
+    if self.reachabilityVolumeNode is not None:
+      # The map only depends on the paths, so it is recomputed after real transform changes only
+      self.reachabilityMap = None
+      self.cancelTask('reachabilityMap')
+      self.reachabilityScheduler.schedule()
+    if self.pathsUpdatedCallback:
+      self.pathsUpdatedCallback()
+
+  @staticmethod
+  def arrayFromVTKMatrix(vtkMatrix):
+    return numpy.array([[vtkMatrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+  @staticmethod
+  def vtkMatrixFromArray(array):
+    vtkMatrix = vtk.vtkMatrix4x4()
+    for i in range(4):
+      for j in range(4):
+        vtkMatrix.SetElement(i, j, array[i][j])
+    return vtkMatrix
+
+  def setReachabilityVolume(self, volumeNode):
+    # Enables the reachability map over the grid of volumeNode, or disables it if volumeNode is None
+    self.reachabilityVolumeNode = volumeNode
+    self.reachabilityMap = None
+    self.reachabilityScheduler.cancel()
+    self.cancelTask('reachabilityMap')
+    if volumeNode is not None:
+      self.updateReachabilityMap()
+
+  @timed('logic.updateReachabilityMap')
+  def updateReachabilityMap(self):
+    volumeNode = self.reachabilityVolumeNode
+    if volumeNode is None or volumeNode.GetImageData() is None:
+      return
+    # Pending transform updates are applied first; they would otherwise schedule another recomputation
+    self.transformScheduler.flush()
+    self.reachabilityScheduler.cancel()
+
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    matrix = self.arrayFromVTKMatrix(ijkToRAS)
+    tnode = volumeNode.GetParentTransformNode()
+    if tnode is not None:
+      toWorld = vtk.vtkMatrix4x4()
+      tnode.GetMatrixTransformToWorld(toWorld)
+      matrix = self.arrayFromVTKMatrix(toWorld).dot(matrix)
+
+    dimensions = volumeNode.GetImageData().GetDimensions()
+    search = self.createPathSearch(precomputeClearDepths=True)
+
+    def searchHoles(targets):
+      (indices, angles, depths, inRange, blocked) = search(targets)
+      return indices, depths, inRange & ~blocked
+
+    def computeMap(task):
+      return ReachabilityMap.compute(matrix, dimensions, searchHoles, progress=task.setProgress if task else None)
+
+    self.runTask('reachabilityMap', computeMap, self.setReachabilityMap, "Computing reachability map...")
+
+  def setReachabilityMap(self, reachabilityMap):
+    self.reachabilityMap = reachabilityMap
+    matrix = reachabilityMap.ijkToRAS
+    self.reachabilityLabelNodeID = self.updateReachabilityVolumeNode(self.reachabilityLabelNodeID,
+                                                                     'NeedleGuideReachability',
+                                                                     self.reachabilityMap.inRange, matrix, True)
+    self.reachabilityHoleNodeID = self.updateReachabilityVolumeNode(self.reachabilityHoleNodeID,
+                                                                    'NeedleGuideNearestHole',
+                                                                    self.reachabilityMap.holes, matrix, False)
+    self.reachabilityDepthNodeID = self.updateReachabilityVolumeNode(self.reachabilityDepthNodeID,
+                                                                     'NeedleGuideInsertionDepth',
+                                                                     self.reachabilityMap.depths, matrix, False)
+
+  def updateReachabilityVolumeNode(self, nodeID, name, array, ijkToRAS, labelMap):
+    # Creates or updates a volume node with the (K, J, I) array in world coordinates and returns its ID.
+    # The image data shares the memory of the array (the VTK array keeps a reference to it) instead of copying it.
+    node = slicer.mrmlScene.GetNodeByID(nodeID) if nodeID else None
+    if node is None:
+      if labelMap and hasattr(slicer, 'vtkMRMLLabelMapVolumeNode'):
+        node = slicer.vtkMRMLLabelMapVolumeNode()
+      else:
+        node = slicer.vtkMRMLScalarVolumeNode()
+        if labelMap:
+          node.LabelMapOn()
+      node.SetName(name)
+      slicer.mrmlScene.AddNode(node)
+      node.CreateDefaultDisplayNodes()
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.ravel(), deep=False))
+    node.SetIJKToRASMatrix(self.vtkMatrixFromArray(ijkToRAS))
+    node.SetAndObserveImageData(imageData)
+    return node.GetID()
+
+  def lookupReachability(self, targets):
+    # O(1) lookup of the nearest hole for an N x 3 array of targets in the precomputed reachability map
+    #  (indices, depths, inRange, inside) = lookupReachability(targets)
+    # Returns None if the map is disabled or outdated; inside is False for targets outside of the volume
+
+    if self.reachabilityMap is None:
+      return None
+    return self.reachabilityMap.lookup(targets)
 
   def computeNearestPath(self, pos):
     # Identify the nearest path and return the index for self.templateConfig[] and depth
     #  (index_x, index_y, depth, inRange) = computeNearestPath()
 
-    p = numpy.array(pos)
-
-    minMag2 = numpy.Inf
-    minDepth = 0.0
-    minIndex = -1
-
-    ## TODO: Can following loop can be described by matrix calculation?
-    i = 0
-    for orig in self.pathOrigins:
-      vec = self.pathVectors[i]
-      op = p - orig
-      aproj = numpy.inner(op, vec)
-      perp = op-aproj*vec
-      mag2 = numpy.vdot(perp,perp) # magnitude^2
-      if mag2 < minMag2:
-        minMag2 = mag2
-        minIndex = i
-        minDepth = aproj
-      i += 1
-
-    indexX = '--'
-    indexY = '--'
-    inRange = False
-
-    if minIndex >= 0:
-      indexX = self.templateIndex[minIndex][0]
-      indexY = self.templateIndex[minIndex][1]
-      if 0 < minDepth < self.templateMaxDepth[minIndex]:
-        inRange = True
-
-    return indexX, indexY, minDepth, inRange
-      
-    
+    (indices, depths, inRange) = self.computeNearestPaths([pos])
+    (indexX, indexY) = self.getHoleIndex(indices[0])
+    return indexX, indexY, depths[0], bool(inRange[0])
+
+  def getHoleIndex(self, index):
+    # Returns the (index_x, index_y) label of the hole or ('--', '--') if index is negative
+    return getHoleLabels(self.templateIndex, index)
+
+  def getHoleIndices(self, indices):
+    # Returns the (index_x, index_y) labels of several holes, looking up every distinct hole once
+    (holes, inverse) = numpy.unique(numpy.asarray(indices, dtype=numpy.intp), return_inverse=True)
+    labels = [self.getHoleIndex(index) for index in holes]
+    return [labels[i] for i in inverse.reshape(-1)]
+
+  def getPathTilt(self, index, angle):
+    # Returns the angle in degrees between the given direction of a hole and its nominal direction
+    return float(self.templatePathTilts[self.templatePathStarts[index] + angle])
+
+  def getPathTilts(self, indices, angles):
+    # Returns getPathTilt of every (index, angle) pair; nominal directions and missing holes (-1) have no tilt
+    indices = numpy.asarray(indices, dtype=numpy.intp)
+    angles = numpy.asarray(angles, dtype=numpy.intp)
+    tilts = numpy.zeros(indices.shape)
+    found = indices >= 0
+    tilts[found] = self.templatePathTilts[self.templatePathStarts[indices[found]] + angles[found]]
+    return tilts
+
+  def computeNearestPaths(self, targets):
+    # Identify the nearest paths for an N x 3 array of targets at once
+    #  (indices, depths, inRange) = computeNearestPaths(targets)
+    # indices refer to self.templateConfig[] and are -1 if no template is loaded
+
+    (indices, angles, depths, inRange) = self.computeNearestPathsAndAngles(targets)
+    return indices, depths, inRange
+
+  def computeCandidatePath(self, pos, count=5):
+    # Ranks the count best holes/directions for a single target
+    #  [(index_x, index_y, tilt, depth, inRange, distance, blocked), ...] = computeCandidatePath(pos)
+
+    (indices, angles, depths, inRange, distances, blocked) = self.computeCandidatePaths([pos], count)
+    candidates = []
+    for n in range(count):
+      if indices[0][n] < 0:
+        break
+      (indexX, indexY) = self.getHoleIndex(indices[0][n])
+      tilt = self.getPathTilt(indices[0][n], angles[0][n])
+      candidates.append((indexX, indexY, tilt, depths[0][n], bool(inRange[0][n]), distances[0][n],
+                         bool(blocked[0][n])))
+    return candidates
+
+  @timed('logic.computeCandidatePaths')
+  def computeCandidatePaths(self, targets, count=5):
+    # Ranks the count best holes/directions for an N x 3 array of targets at once
+    #  (indices, angles, depths, inRange, distances, blocked) = computeCandidatePaths(targets, count)
+    # All arrays are N x count, best first: by distance between target and path, then paths in depth range first.
+    # Columns beyond the number of paths have index -1. blocked is only set if an obstacle map is selected.
+
+    self.transformScheduler.flush()
+    (paths, depths, inRange, distances) = computeCandidatePaths(self.pathOrigins, self.pathVectors,
+                                                                self.templatePathMaxDepths, targets, count)
+    found = paths >= 0
+    indices = numpy.full(paths.shape, -1, dtype=numpy.intp)
+    angles = numpy.full(paths.shape, -1, dtype=numpy.intp)
+    indices[found] = self.templatePathHoles[paths[found]]
+    angles[found] = self.templatePathAngles[paths[found]]
+    blocked = numpy.zeros(paths.shape, dtype=bool)
+    if self.obstacleMap is not None:
+      blocked[found] = self.obstacleMap.isBlocked(self.pathOrigins[paths[found]], self.pathVectors[paths[found]],
+                                                  depths[found])
+    return indices, angles, depths, inRange, distances, blocked
+
+  def setObstacleLabelMap(self, labelMapNode, labels=None):
+    # Makes the hole search skip paths crossing the given labels (all non-zero labels if None) of labelMapNode.
+    # None disables the obstacle check.
+
+    if labelMapNode is None or labelMapNode.GetImageData() is None:
+      self.obstacleMap = None
+    else:
+      imageData = labelMapNode.GetImageData()
+      (nI, nJ, nK) = imageData.GetDimensions()
+      array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(nK, nJ, nI)
+      rasToIJK = vtk.vtkMatrix4x4()
+      labelMapNode.GetRASToIJKMatrix(rasToIJK)
+      matrix = self.arrayFromVTKMatrix(rasToIJK)
+      tnode = labelMapNode.GetParentTransformNode()
+      if tnode is not None:
+        fromWorld = vtk.vtkMatrix4x4()
+        tnode.GetMatrixTransformFromWorld(fromWorld)
+        matrix = matrix.dot(self.arrayFromVTKMatrix(fromWorld))
+      self.obstacleMap = ObstacleMap(array, matrix, labels, step=min(labelMapNode.GetSpacing()))
+    self.pathVersion += 1
+    if self.reachabilityVolumeNode is not None:
+      self.reachabilityMap = None
+      self.cancelTask('reachabilityMap')
+      self.reachabilityScheduler.schedule()
+    if self.pathsUpdatedCallback:
+      self.pathsUpdatedCallback()
+
+  @timed('logic.computeNearestPaths')
+  def computeNearestPathsAndAngles(self, targets):
+    # Identify the nearest hole and direction among all allowed directions of all holes at once
+    #  (indices, angles, depths, inRange) = computeNearestPathsAndAngles(targets)
+    # angles index the directions of each hole (0: nominal direction) and are -1 if no template is loaded
+
+    return self.createPathSearch()(targets)[0:4]
+
+  def createPathSearch(self, precomputeClearDepths=False):
+    # Returns search(targets) -> (indices, angles, depths, inRange, blocked) over the current needle paths.
+    # With an obstacle map the nearest clear path is chosen; blocked is True where every path crosses an obstacle.
+    # Only targets whose nearest path is blocked are searched again. precomputeClearDepths suits searches over many
+    # targets (the reachability map): the first search call finds the depth up to which every path is clear, and
+    # targets above it skip the obstacle check. The function keeps using these paths after later transform changes
+    # and may run in worker threads.
+
+    self.transformScheduler.flush()
+    (pathIndex, origins, vectors) = (self.pathIndex, self.pathOrigins, self.pathVectors)
+    (maxDepths, holes, angleIndices) = (self.templatePathMaxDepths, self.templatePathHoles, self.templatePathAngles)
+    obstacleMap = self.obstacleMap
+    clearDepths = []
+
+    def search(targets):
+      if pathIndex is not None:
+        (paths, depths, inRange) = pathIndex.computeNearestPaths(targets)
+      else:
+        (paths, depths, inRange) = computeNearestPaths(origins, vectors, maxDepths, targets)
+      if obstacleMap is not None:
+        if precomputeClearDepths and not clearDepths:
+          clearDepths.append(obstacleMap.computeClearDepths(origins, vectors))
+        (paths, depths, inRange, blocked) = resolveBlockedPaths(origins, vectors, maxDepths, targets, paths, depths,
+                                                                obstacleMap, clearDepths[0] if clearDepths else None)
+      else:
+        blocked = numpy.zeros(paths.shape, dtype=bool)
+      found = paths >= 0
+      indices = numpy.full(paths.shape, -1, dtype=numpy.intp)
+      angles = numpy.full(paths.shape, -1, dtype=numpy.intp)
+      indices[found] = holes[paths[found]]
+      angles[found] = angleIndices[paths[found]]
+      return indices, angles, depths, inRange, blocked
+    return search
+
+
 class NeedleGuideTemplateTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted Uses.
@@ -502,116 +1696,1069 @@ class NeedleGuideTemplateTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_NeedleGuideTemplate1()
+    self.setUp()
+    self.test_NearestPathIndex()
+    self.setUp()
+    self.test_GeometryCache()
+    self.setUp()
+    self.test_BatchPlanning()
+    self.setUp()
+    self.test_BinaryTemplate()
+    self.setUp()
+    self.test_AngulatedTemplate()
+    self.setUp()
+    self.test_ReachabilityMap()
+    self.setUp()
+    self.test_ObstacleCheck()
+    self.setUp()
+    self.test_CandidatePaths()
+    self.setUp()
+    self.test_ProjectionWindow()
+    self.setUp()
+    self.test_LevelOfDetail()
+    self.setUp()
+    self.test_SliceIntersections()
+    self.setUp()
+    self.test_TemplateLibrary()
+    self.setUp()
+    self.test_LiveTracking()
+    self.setUp()
+    self.test_Registration()
+    self.setUp()
+    self.test_MarkerDetection()
+    self.setUp()
+    self.test_TargetTable()
+    self.setUp()
+    self.test_LongSession()
 
   def test_NeedleGuideTemplate1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests sould exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """ The logic must load the bundled template, reject invalid files and find the hole and depth of a target.
     """
 
     self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        print('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        print('Loading %s...\n' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading\n')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
     logic = NeedleGuideTemplateLogic()
-    #TODO: implement test
-    # self.assertTrue( logic.hasImageData(volumeNode) )
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertFalse(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/Missing.csv')))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    self.assertEqual(len(logic.templateConfig), 210)
+
+    # Hole A -7 enters at (35, 25, 30) along +S and reaches 150 mm deep
+    (indexX, indexY, depth, inRange) = logic.computeNearestPath([35.0, 25.0, 70.0])
+    self.assertEqual((indexX, indexY, inRange), ('A', '-7', True))
+    self.assertAlmostEqual(depth, 40.0)
+    (indexX, indexY, depth, inRange) = logic.computeNearestPath([35.0, 25.0, 190.0])
+    self.assertEqual((indexX, indexY, inRange), ('A', '-7', False))
+    self.assertAlmostEqual(depth, 160.0)
+    (indexX, indexY, depth, inRange) = logic.computeNearestPath([35.0, 25.0, 20.0])
+    self.assertEqual((indexX, indexY, inRange), ('A', '-7', False))
+    self.assertAlmostEqual(depth, -10.0)
+    self.delayDisplay('Test passed!')
+
+  def test_NearestPathIndex(self):
+    """ The spatial index must identify exactly the same holes and depths as the brute force search.
+    """
+
+    self.delayDisplay("Starting the nearest path index test")
+    from Utils.pathsearch import GridPathIndex, TreePathIndex
+
+    def assertSameResults(index, origins, vectors, maxDepths, targets):
+      expected = computeNearestPaths(origins, vectors, maxDepths, targets)
+      for (actual, reference) in zip(index.computeNearestPaths(targets), expected):
+        self.assertTrue(numpy.array_equal(actual, reference))
+
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    self.assertTrue(isinstance(logic.pathIndex, GridPathIndex))
+
+    # Random targets plus targets exactly on and halfway between holes, where ties have to be broken identically
+    random = numpy.random.RandomState(0)
+    origins = logic.pathOrigins
+    targets = numpy.vstack([random.uniform(-100, 100, (2000, 3)), origins, origins + [2.5, 0.0, 10.0],
+                            origins + [2.5, 2.5, -10.0]])
+    assertSameResults(logic.pathIndex, origins, logic.pathVectors, logic.templatePathMaxDepths, targets)
+
+    # Non-parallel paths of a dense synthetic template are served by the KD-tree
+    grid = numpy.mgrid[0:60, 0:60].reshape(2, -1).T * 2.0
+    origins = numpy.column_stack([grid, numpy.zeros(len(grid))])
+    vectors = numpy.array([0.0, 0.0, 1.0]) + random.normal(0.0, 0.02, origins.shape)
+    vectors /= numpy.sqrt(numpy.sum(vectors * vectors, axis=1))[:, numpy.newaxis]
+    maxDepths = numpy.full(len(origins), 100.0)
+    index = buildPathIndex(origins, vectors, maxDepths)
+    self.assertTrue(isinstance(index, TreePathIndex))
+    targets = numpy.column_stack([random.uniform(-10, 130, (2000, 2)), random.uniform(-20, 120, 2000)])
+    assertSameResults(index, origins, vectors, maxDepths, targets)
+    self.delayDisplay('Test passed!')
+
+  def test_GeometryCache(self):
+    """ Cached meshes must match freshly generated ones and be invalidated by changes of the configuration file.
+    """
+
+    self.delayDisplay("Starting the geometry cache test")
+    import shutil, tempfile
+    from Utils.geometrycache import GeometryCache
+
+    directory = tempfile.mkdtemp()
+    try:
+      modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+      configPath = os.path.join(directory, 'Template.csv')
+      shutil.copy(os.path.join(modulePath, 'Config/ProstateTemplate.csv'), configPath)
+
+      logic = NeedleGuideTemplateLogic()
+      logic.geometryCache = GeometryCache(os.path.join(directory, 'Cache'))
+      self.assertTrue(logic.loadTemplateConfigFile(configPath))
+      key = logic.geometryCache.makeKey(logic.templateConfigHash, 'template', 1.0, 18)
+      cached = logic.geometryCache.load(key)
+      self.assertTrue(cached is not None)
+      config = numpy.array(logic.templateConfig)
+      for (actual, expected) in zip(cached, createTubeMesh(config[:, 0:3], config[:, 3:6], 1.0, 18)):
+        self.assertTrue(numpy.array_equal(actual, expected))
+
+      # Appending a hole changes the content hash, so the old entries are not used
+      with open(configPath, 'a') as f:
+        f.write('Z,99,0.0,0.0,0.0,0.0,0.0,-1.0,100.0\n')
+      self.assertTrue(logic.loadTemplateConfigFile(configPath))
+      self.assertNotEqual(key, logic.geometryCache.makeKey(logic.templateConfigHash, 'template', 1.0, 18))
+      self.assertEqual(logic.tempModelNode.GetPolyData().GetNumberOfPoints(), 4 * 18 * len(logic.templateConfig))
+
+      # Eviction keeps the cache within its size limit
+      logic.geometryCache.maxSize = 0
+      logic.geometryCache.evict()
+      self.assertEqual(len(os.listdir(logic.geometryCache.directory)), 0)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
     self.delayDisplay('Test passed!')
 
+  def test_BatchPlanning(self):
+    """ The headless batch planner must identify the same holes and depths as the module logic.
+    """
+
+    self.delayDisplay("Starting the batch planning test")
+    import shutil, tempfile
+    from Utils.batchplanning import runBatch
+
+    directory = tempfile.mkdtemp()
+    try:
+      modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+      templatePath = os.path.join(modulePath, 'Config/ProstateTemplate.csv')
+      matrix = numpy.array([[0.0, -1.0, 0.0, 5.0], [1.0, 0.0, 0.0, -3.0], [0.0, 0.0, 1.0, 10.0], [0, 0, 0, 1]])
+      transformPath = os.path.join(directory, 'transform.txt')
+      numpy.savetxt(transformPath, matrix)
+      targets = numpy.random.RandomState(0).uniform(-60, 60, (50, 3))
+      targetsPath = os.path.join(directory, 'targets.csv')
+      numpy.savetxt(targetsPath, targets, delimiter=',', fmt='T,%.6f,%.6f,%.6f')
+      outputPath = os.path.join(directory, 'results.csv')
+      self.assertEqual(runBatch([(templatePath, transformPath, targetsPath)] * 2, outputPath, processes=1), (100, []))
+
+      logic = NeedleGuideTemplateLogic()
+      self.assertTrue(logic.loadTemplateConfigFile(templatePath))
+      transformNode = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(transformNode)
+      transformNode.SetMatrixTransformToParent(NeedleGuideTemplateLogic.vtkMatrixFromArray(matrix))
+      logic.setTransform(transformNode)
+      logic.updateTemplateVectors()
+      (indices, depths, inRange) = logic.computeNearestPaths(numpy.round(targets, 6))
+
+      with open(outputPath, 'r') as f:
+        rows = list(csv.DictReader(f))
+      for (i, row) in enumerate(rows[:50]):
+        self.assertEqual((row['holeX'], row['holeY']), logic.getHoleIndex(indices[i]))
+        self.assertEqual(row['depth'], '%.3f' % depths[i])
+        self.assertEqual(row['inRange'], str(int(inRange[i])))
+
+      # A case that cannot be read is reported without stopping the others
+      jobs = [(templatePath, transformPath, targetsPath), (os.path.join(directory, 'missing.csv'), None, targetsPath),
+              (templatePath, transformPath, targetsPath)]
+      self.assertEqual(runBatch(jobs, outputPath, processes=1), (100, [1]))
+      with open(outputPath, 'r') as f:
+        rows = list(csv.DictReader(f))
+      self.assertEqual(len(rows), 101)
+      self.assertEqual(rows[50]['job'], '1')
+      self.assertTrue(rows[50]['error'])
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+
+  def test_BinaryTemplate(self):
+    """ A template converted to the binary format must load as views of the file and plan like the CSV template.
+    """
+
+    self.delayDisplay("Starting the binary template test")
+    import shutil, tempfile
+    from Utils.templateconfig import convertTemplateConfigFile
+
+    directory = tempfile.mkdtemp()
+    try:
+      modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+      csvPath = os.path.join(modulePath, 'Config/ProstateTemplate.csv')
+      binaryPath = os.path.join(directory, 'ProstateTemplate.npy')
+      convertTemplateConfigFile(csvPath, binaryPath)
+
+      csvLogic = NeedleGuideTemplateLogic()
+      self.assertTrue(csvLogic.loadTemplateConfigFile(csvPath))
+      binaryLogic = NeedleGuideTemplateLogic()
+      self.assertTrue(binaryLogic.loadTemplateConfigFile(binaryPath))
+      self.assertTrue(isinstance(binaryLogic.templateConfig, numpy.memmap) or
+                      isinstance(binaryLogic.templateConfig.base, numpy.memmap))
+      self.assertTrue(numpy.array_equal(binaryLogic.templateConfig, numpy.array(csvLogic.templateConfig)))
+      # The template paths are views of the same mapped records
+      for name in ('templatePathOrigins', 'templatePathVectors', 'templatePathMaxDepths'):
+        self.assertTrue(numpy.may_share_memory(getattr(binaryLogic, name), binaryLogic.templateConfig))
+        self.assertTrue(numpy.array_equal(getattr(binaryLogic, name), getattr(csvLogic, name)))
+
+      targets = numpy.random.RandomState(0).uniform(-60, 60, (200, 3))
+      for (actual, expected) in zip(binaryLogic.computeNearestPaths(targets), csvLogic.computeNearestPaths(targets)):
+        self.assertTrue(numpy.array_equal(actual, expected))
+      for i in range(len(csvLogic.templateIndex)):
+        self.assertEqual(binaryLogic.getHoleIndex(i), csvLogic.getHoleIndex(i))
+      del binaryLogic
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+
+  def test_AngulatedTemplate(self):
+    """ Targets on a tilted path of an angulated hole must be assigned to that hole and direction.
+    """
+
+    self.delayDisplay("Starting the angulated template test")
+    import shutil, tempfile
+
+    directory = tempfile.mkdtemp()
+    try:
+      # 3 x 3 holes along -z, each allowing tilts of 10 degrees towards +x and -y
+      (s, c) = (numpy.sin(numpy.radians(10.0)), numpy.cos(numpy.radians(10.0)))
+      configPath = os.path.join(directory, 'Angulated.csv')
+      with open(configPath, 'w') as f:
+        f.write('"Angulated"\n')
+        for (x, y) in [(x, y) for y in (0, 10, 20) for x in (0, 10, 20)]:
+          f.write('"%d",%d,%d,%d,0,%d,%d,-10,80,%f,0,%f,0,%f,%f\n' % (x, y, x, y, x, y, s, -c, -s, -c))
+
+      logic = NeedleGuideTemplateLogic()
+      self.assertTrue(logic.loadTemplateConfigFile(configPath))
+      self.assertEqual(len(logic.templatePathHoles), 27)
+
+      hole = 4
+      origin = numpy.array(logic.templateConfig[hole][0:3])
+      targets = numpy.array([origin + 50.0 * numpy.array([0, 0, -1]), origin + 50.0 * numpy.array([s, 0, -c]),
+                             origin + 50.0 * numpy.array([0, -s, -c])])
+      (indices, angles, depths, inRange) = logic.computeNearestPathsAndAngles(targets)
+      self.assertEqual(list(indices), [hole] * 3)
+      self.assertEqual(list(angles), [0, 1, 2])
+      self.assertTrue(numpy.allclose(depths, 50.0))
+      self.assertTrue(inRange.all())
+      self.assertAlmostEqual(logic.getPathTilt(hole, 1), 10.0)
+
+      # Every hole x direction pair is a candidate, as in a brute force search over the expanded paths
+      random = numpy.random.RandomState(0)
+      targets = numpy.column_stack([random.uniform(-10, 30, (500, 2)), random.uniform(-100, 0, 500)])
+      expected = computeNearestPaths(logic.pathOrigins, logic.pathVectors, logic.templatePathMaxDepths, targets)
+      (indices, angles, depths, inRange) = logic.computeNearestPathsAndAngles(targets)
+      self.assertTrue(numpy.array_equal(indices, logic.templatePathHoles[expected[0]]))
+      self.assertTrue(numpy.array_equal(angles, logic.templatePathAngles[expected[0]]))
+      self.assertTrue(numpy.array_equal(depths, expected[1]))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+
+  def test_ReachabilityMap(self):
+    """ Lookups in the reachability map must match the nearest path search at the voxel positions.
+    """
+
+    self.delayDisplay("Starting the reachability map test")
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(30, 25, 20)
+    if vtk.VTK_MAJOR_VERSION <= 5:
+      imageData.SetScalarTypeToShort()
+      imageData.AllocateScalars()
+    else:
+      imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    volumeNode.SetOrigin(-60.0, -50.0, 0.0)
+    volumeNode.SetSpacing(4.0, 4.0, 8.0)
+    slicer.mrmlScene.AddNode(volumeNode)
+
+    logic.setReachabilityVolume(volumeNode)
+    self.assertEqual(logic.reachabilityMap.holes.shape, (20, 25, 30))
+
+    # Small chunks must give the same map
+    chunked = ReachabilityMap.compute(logic.reachabilityMap.ijkToRAS, (30, 25, 20), logic.computeNearestPaths,
+                                      chunkSize=1000)
+    self.assertTrue(numpy.array_equal(chunked.holes, logic.reachabilityMap.holes))
+    self.assertTrue(numpy.array_equal(chunked.depths, logic.reachabilityMap.depths))
+
+    ijk = numpy.array([[0, 0, 0], [29, 24, 19], [10, 5, 7], [17, 20, 3]])
+    positions = numpy.column_stack([-60.0 + 4.0 * ijk[:, 0], -50.0 + 4.0 * ijk[:, 1], 8.0 * ijk[:, 2]])
+    (indices, depths, inRange, inside) = logic.lookupReachability(positions)
+    expected = logic.computeNearestPaths(positions)
+    self.assertTrue(inside.all())
+    self.assertTrue(numpy.array_equal(indices, expected[0]))
+    self.assertTrue(numpy.allclose(depths, expected[1], atol=1e-3))
+    self.assertTrue(numpy.array_equal(inRange, expected[2]))
+    self.assertFalse(logic.lookupReachability([[1000.0, 0.0, 0.0]])[3][0])
+
+    # A real transform change invalidates the map
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    logic.setTransform(transformNode)
+    transformMatrix = vtk.vtkMatrix4x4()
+    transformMatrix.SetElement(0, 3, 5.0)
+    transformNode.SetMatrixTransformToParent(transformMatrix)
+    logic.updateTemplateVectors()
+    self.assertTrue(logic.reachabilityMap is None)
+    logic.updateReachabilityMap()
+    self.assertTrue(logic.reachabilityMap is not None)
+    self.delayDisplay('Test passed!')
+
+  def test_ObstacleCheck(self):
+    """ Blocked paths must be skipped in favor of the nearest clear path.
+    """
+
+    self.delayDisplay("Starting the obstacle check test")
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+
+    random = numpy.random.RandomState(15)
+    targets = random.uniform(-40.0, 40.0, (50, 3)) + logic.pathOrigins.mean(axis=0) + 60.0 * logic.pathVectors[0]
+    (nearest, depths, inRange) = logic.computeNearestPaths(targets)
+
+    # A 1 mm grid covering the template with a small obstacle on the path of the first target
+    rasToIJK = numpy.eye(4)
+    rasToIJK[0:3, 3] = 100.0
+    labels = numpy.zeros((300, 200, 200), dtype=numpy.uint8)
+    obstacleMap = ObstacleMap(labels, rasToIJK)
+    path = logic.templatePathStarts[nearest[0]]
+    point = logic.pathOrigins[path] + 0.5 * depths[0] * logic.pathVectors[path]
+    (i, j, k) = numpy.rint(point + 100.0).astype(int)
+    labels[k - 1:k + 2, j - 1:j + 2, i - 1:i + 2] = 3
+    self.assertTrue(obstacleMap.isBlocked(logic.pathOrigins[[path]], logic.pathVectors[[path]], depths[[0]])[0])
+    self.assertFalse(ObstacleMap(labels, rasToIJK, obstacleLabels=[1, 2]).isBlocked(
+      logic.pathOrigins[[path]], logic.pathVectors[[path]], depths[[0]])[0])
+
+    logic.obstacleMap = obstacleMap
+    logic.pathVersion += 1
+    (indices, angles, depths2, inRange2, blocked) = logic.createPathSearch()(targets)
+    self.assertNotEqual(indices[0], nearest[0])
+    self.assertFalse(blocked.any())
+    self.assertFalse(obstacleMap.isBlocked(logic.pathOrigins[logic.templatePathStarts[indices]],
+                                           logic.pathVectors[logic.templatePathStarts[indices]], depths2).any())
+    # Targets whose nearest path is clear are not affected
+    clear = ~obstacleMap.isBlocked(logic.pathOrigins[logic.templatePathStarts[nearest]],
+                                   logic.pathVectors[logic.templatePathStarts[nearest]], depths)
+    self.assertTrue(numpy.array_equal(indices[clear], nearest[clear]))
+
+    # Searching again only where the nearest path is blocked, with or without clear depths, must give the result of
+    # the clear path search over all targets, also for targets around the obstacle
+    allTargets = numpy.concatenate([targets, point + random.uniform(-8.0, 8.0, (300, 3))])
+    expected = computeNearestClearPaths(logic.pathOrigins, logic.pathVectors, logic.templatePathMaxDepths, allTargets,
+                                        obstacleMap)
+    self.assertTrue(numpy.any(expected[0] != computeNearestPaths(logic.pathOrigins, logic.pathVectors,
+                                                                logic.templatePathMaxDepths, allTargets)[0]))
+    for search in [logic.createPathSearch(), logic.createPathSearch(precomputeClearDepths=True)]:
+      (indices, angles, depths2, inRange2, blocked) = search(allTargets)
+      self.assertTrue(numpy.array_equal(indices, logic.templatePathHoles[expected[0]]))
+      self.assertTrue(numpy.array_equal(depths2, expected[1]))
+      self.assertTrue(numpy.array_equal(inRange2, expected[2]))
+      self.assertTrue(numpy.array_equal(blocked, expected[3]))
+    clearDepths = obstacleMap.computeClearDepths(logic.pathOrigins, logic.pathVectors)
+    self.assertTrue(numpy.isfinite(clearDepths[path]) and not numpy.isfinite(clearDepths).all())
+    below = numpy.isfinite(clearDepths) & (clearDepths > 0)
+    self.assertFalse(obstacleMap.isBlocked(logic.pathOrigins[below], logic.pathVectors[below],
+                                           clearDepths[below] - 1e-6).any())
+
+    # Targets without any clear path keep their nearest path and are flagged
+    labels[:] = 1
+    (indices, angles, depths2, inRange2, blocked) = logic.createPathSearch()(targets)
+    self.assertTrue(blocked.all())
+    self.assertTrue(numpy.array_equal(indices, nearest))
+    self.delayDisplay('Test passed!')
+
+  def test_CandidatePaths(self):
+    """ The ranked candidates must match a full sort of all paths.
+    """
+
+    self.delayDisplay("Starting the candidate paths test")
+    random = numpy.random.RandomState(16)
+    origins = random.uniform(-50.0, 50.0, (3000, 3))
+    vectors = random.normal(size=(3000, 3)) * 0.1 + [0.0, 0.0, 1.0]
+    vectors /= numpy.sqrt(numpy.sum(vectors * vectors, axis=1))[:, numpy.newaxis]
+    maxDepths = random.uniform(20.0, 120.0, 3000)
+    targets = random.uniform(-50.0, 50.0, (300, 3)) + [0.0, 0.0, 80.0]
+
+    (indices, depths, inRange, distances) = computeCandidatePaths(origins, vectors, maxDepths, targets, 5,
+                                                                  chunkSize=1 << 16)
+    self.assertEqual(indices.shape, (300, 5))
+    for n in range(targets.shape[0]):
+      op = targets[n] - origins
+      aproj = numpy.sum(op * vectors, axis=1)
+      mag2 = numpy.sum((op - aproj[:, numpy.newaxis] * vectors) ** 2, axis=1)
+      valid = (aproj > 0) & (aproj < maxDepths)
+      expected = numpy.lexsort((numpy.arange(3000), ~valid, mag2))[0:5]
+      self.assertTrue(numpy.array_equal(indices[n], expected))
+      self.assertTrue(numpy.allclose(distances[n], numpy.sqrt(mag2[expected])))
+      self.assertTrue(numpy.array_equal(inRange[n], valid[expected]))
+    self.assertTrue(numpy.array_equal(indices[:, 0], computeNearestPaths(origins, vectors, maxDepths, targets)[0]))
+
+    # Fewer paths than requested candidates
+    (indices, depths, inRange, distances) = computeCandidatePaths(origins[0:3], vectors[0:3], maxDepths[0:3],
+                                                                  targets, 5)
+    self.assertTrue((indices[:, 3:] == -1).all())
+    self.assertTrue(numpy.array_equal(numpy.sort(indices[:, 0:3], axis=1), numpy.tile([0, 1, 2], (300, 1))))
+
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    candidates = logic.computeCandidatePath([1.0, 2.0, 80.0], 4)
+    self.assertEqual(len(candidates), 4)
+    self.assertEqual(candidates[0][0:2], logic.computeNearestPath([1.0, 2.0, 80.0])[0:2])
+    self.assertTrue(all(a[5] <= b[5] for (a, b) in zip(candidates, candidates[1:])))
+    self.delayDisplay('Test passed!')
+
+  def test_ProjectionWindow(self):
+    """ The projection grid must be derived from the template index.
+    """
+
+    self.delayDisplay("Starting the projection window test")
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    (labelsX, labelsY) = getHoleGrid(logic.templateIndex)
+    self.assertEqual(labelsX[0:3], ['A', 'B', 'C'])
+    self.assertEqual(len(labelsX) * len(labelsY), len(logic.templateIndex))
+
+    window = ProjectionWindow()
+    window.setTemplate(logic.templateIndex)
+    window.show()
+    slicer.app.processEvents()
+    # The default size reproduces the layout of the previous hard-coded grid
+    self.assertEqual(window.getCellSize(), 20.0)
+    self.assertEqual(window.getHoleCenter('A', '-7'), (10.0, 60.0))
+    self.assertEqual(window.getHoleCenter('N', '7'), (290.0, 320.0))
+    self.assertTrue(window.getHoleCenter('--', '--') is None)
+
+    window.setTargets([('A', '-7', True), ('--', '--', False), ('C', '0', False)])
+    window.setSelection('C', '0')
+    slicer.app.processEvents()
+    self.assertTrue(window.gridPixmap is not None)
+    pixmap = window.gridPixmap
+    window.setTargets([('A', '-6', True)])
+    slicer.app.processEvents()
+    self.assertTrue(window.gridPixmap is pixmap)
+    window.resize(400, 400)
+    slicer.app.processEvents()
+    self.assertTrue(window.gridPixmap is not pixmap)
+    window.close()
+    self.delayDisplay('Test passed!')
+
+  def test_LevelOfDetail(self):
+    """ Every level of detail must produce the expected geometry for all holes.
+    """
+
+    self.delayDisplay("Starting the level of detail test")
+    self.assertEqual(selectLevelOfDetail(LOD_AUTO, 210), LOD_HIGH)
+    self.assertEqual(selectLevelOfDetail(LOD_AUTO, 100000), LOD_LINES)
+    self.assertEqual(selectLevelOfDetail(LOD_GLYPHS, 100000), LOD_GLYPHS)
+
+    (centers, directions, scales) = computeGlyphArrays([[0.0, 0.0, 0.0]], [[0.0, 0.0, 10.0]], 0.8)
+    self.assertTrue(numpy.allclose(centers, [[0.0, 0.0, 5.0]]))
+    self.assertTrue(numpy.allclose(directions, [[0.0, 0.0, 1.0]]))
+    self.assertTrue(numpy.allclose(scales, [[10.0, 1.6, 1.6]]))
+
+    logic = NeedleGuideTemplateLogic()
+    logic.geometryCache = None
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    nPaths = len(logic.templatePathOrigins)
+    pathModel = slicer.mrmlScene.GetNodeByID(logic.needlePathModelNodeID)
+    self.assertEqual(logic.appliedLevelOfDetail, LOD_HIGH)
+    self.assertEqual(pathModel.GetPolyData().GetNumberOfPolys(), nPaths * (18 + 2))
+
+    logic.setLevelOfDetail('low')
+    self.assertEqual(pathModel.GetPolyData().GetNumberOfPolys(), nPaths * (6 + 2))
+    self.assertTrue(logic.countTriangles() < logic.countTriangles(LOD_HIGH))
+
+    logic.setLevelOfDetail(LOD_LINES)
+    self.assertEqual(pathModel.GetPolyData().GetNumberOfLines(), nPaths)
+    self.assertEqual(pathModel.GetPolyData().GetNumberOfPolys(), 0)
+    self.assertEqual(logic.countTriangles(), 0)
+
+    logic.setLevelOfDetail(LOD_GLYPHS)
+    self.assertEqual(pathModel.GetPolyData().GetNumberOfPoints(), 0)
+    self.assertEqual(sorted(logic.glyphActors.keys()), ['path', 'template'])
+    logic.setNeedlePathVisibility(1)
+    self.assertTrue(logic.glyphActors['path'].GetVisibility())
+    logic.setLevelOfDetail(LOD_AUTO)
+    self.assertEqual(logic.glyphActors, {})
+
+    # The selected hole keeps its high detail tubes and is shown and hidden with the trajectories
+    logic.setLevelOfDetail(LOD_LINES)
+    logic.setNeedlePathVisibility(0)
+    logic.setSelectedHole(5)
+    selectedModel = slicer.mrmlScene.GetNodeByID(logic.selectedPathModelNodeID)
+    self.assertEqual(selectedModel.GetPolyData().GetNumberOfPolys(), 18 + 2)
+    self.assertFalse(selectedModel.GetDisplayNode().GetVisibility())
+    logic.setNeedlePathVisibility(1)
+    self.assertTrue(selectedModel.GetDisplayNode().GetVisibility())
+    logic.setSelectedHole(6)
+    self.assertTrue(selectedModel.GetDisplayNode().GetVisibility())
+    self.delayDisplay('Test passed!')
+
+  def test_SliceIntersections(self):
+    """ Needle path markers must lie on the slice plane and follow slice offset changes.
+    """
+
+    self.delayDisplay("Starting the slice intersection test")
+    sliceToRAS = numpy.eye(4)
+    sliceToRAS[0:3, 2] = numpy.array([0.0, 1.0, 1.0]) / numpy.sqrt(2.0)
+    sliceToRAS[0:3, 3] = [0.0, 0.0, 50.0]
+    starts = numpy.array([[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [10.0, 0.0, 60.0]])
+    ends = numpy.array([[0.0, 0.0, 100.0], [0.0, 0.0, 10.0], [10.0, 0.0, 200.0]])
+    (indices, points) = intersectSegmentsWithPlane(starts, ends, sliceToRAS)
+    self.assertEqual(indices.tolist(), [0])
+    self.assertTrue(numpy.allclose(points, [[0.0, 0.0, 50.0]]))
+
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    logic.setNeedlePathVisibility(1)
+    redNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceNode()
+    redNode.SetOrientationToAxial()
+    redNode.SetSliceOffset(80.0)
+    markups = slicer.mrmlScene.GetNodeByID(logic.sliceIntersectionNodeIDs['Red'])
+    self.assertEqual(markups.GetNumberOfFiducials(), len(logic.templatePathOrigins))
+    pos = [0.0, 0.0, 0.0]
+    markups.GetNthFiducialPosition(0, pos)
+    self.assertAlmostEqual(pos[2], 80.0)
+    self.assertEqual(markups.GetNthFiducialLabel(0), '%s%s' % logic.getHoleIndex(0))
+
+    # The markers are not offered as targets or template markers
+    selector = slicer.qMRMLNodeComboBox()
+    selector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+    selector.setMRMLScene(slicer.mrmlScene)
+    offered = [selector.nodeFromIndex(i).GetID() for i in range(selector.nodeCount())]
+    for nodeID in logic.sliceIntersectionNodeIDs.values():
+      self.assertFalse(nodeID in offered)
+    self.assertFalse(markups.GetSaveWithScene())
+
+    # Beyond the maximum depth of all paths nothing is shown
+    redNode.SetSliceOffset(500.0)
+    self.assertEqual(markups.GetNumberOfFiducials(), 0)
+    logic.setNeedlePathVisibility(0)
+    self.assertEqual(logic.sliceObserverTags, [])
+    self.delayDisplay('Test passed!')
+
+  def test_TemplateLibrary(self):
+    """ The batched library evaluation must agree with the nearest path search of each template.
+    """
+
+    import shutil
+    import tempfile
+    self.delayDisplay("Starting the template library test")
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    directory = tempfile.mkdtemp()
+    try:
+      shutil.copy(os.path.join(modulePath, 'Config/ProstateTemplate.csv'), directory)
+      # A shifted copy of the template with a shorter reach
+      with open(os.path.join(modulePath, 'Config/ProstateTemplate.csv')) as source:
+        lines = source.read().splitlines()
+      with open(os.path.join(directory, 'Shifted.csv'), 'w') as f:
+        f.write('"Shifted"\n')
+        for line in lines[1:]:
+          values = line.split(',')
+          values[2] = '%.1f' % (float(values[2]) + 2.5)
+          values[5] = '%.1f' % (float(values[5]) + 2.5)
+          values[8] = '60'
+          f.write(','.join(values) + '\n')
+      with open(os.path.join(directory, 'Broken.csv'), 'w') as f:
+        f.write('"Broken"\n"A",1,x\n')
+
+      library = TemplateLibrary(directory)
+      self.assertEqual(len(library.getPaths()), 3)
+      self.assertEqual(library.templates, {})
+      targets = numpy.random.RandomState(20).uniform(-30.0, 30.0, (100, 3)) + [0.0, 0.0, 90.0]
+      results = library.evaluate(targets)
+      self.assertEqual(len(results), 2)
+      cached = library.getTemplate(os.path.join(directory, 'Shifted.csv'))
+      self.assertTrue(library.getTemplate(os.path.join(directory, 'Shifted.csv')) is cached)
+
+      for (template, inRange, lateralErrors) in results:
+        logic = NeedleGuideTemplateLogic()
+        self.assertTrue(logic.loadTemplateConfigFile(template.path))
+        (indices, depths, expectedInRange) = logic.computeNearestPaths(targets)
+        self.assertTrue(numpy.array_equal(inRange, expectedInRange))
+        paths = logic.templatePathStarts[indices]
+        (op, vectors) = (targets - logic.pathOrigins[paths], logic.pathVectors[paths])
+        perpendicular = op - numpy.sum(op * vectors, axis=1)[:, numpy.newaxis] * vectors
+        self.assertTrue(numpy.allclose(lateralErrors, numpy.sqrt(numpy.sum(perpendicular ** 2, axis=1))))
+
+      rows = summarizeEvaluation(results)
+      self.assertEqual(rows[0][1][0], 'Prostate Biopsy Tmpleate')
+      self.assertTrue(rows[0][1][3] >= rows[1][1][3])
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_LiveTracking(self):
+    """ Only the latest of several streamed transforms must be processed, and its latency recorded.
+    """
+
+    self.delayDisplay("Starting the live tracking test")
+    monitor = LatencyMonitor()
+    monitor.frameReceived(now=1.0)
+    monitor.frameReceived(now=1.02)
+    self.assertAlmostEqual(monitor.frameProcessed(now=1.05), 0.05)
+    self.assertTrue(monitor.frameProcessed(now=1.1) is None)
+    self.assertEqual((monitor.processedFrames, monitor.droppedFrames), (1, 1))
+
+    logic = NeedleGuideTemplateLogic()
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    self.assertTrue(logic.loadTemplateConfigFile(os.path.join(modulePath, 'Config/ProstateTemplate.csv')))
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    logic.setTransform(transformNode)
+    logic.transformScheduler.flush()
+    updates = []
+    logic.pathsUpdatedCallback = lambda: updates.append(logic.pathOrigins.copy())
+    logic.setLiveTracking(True)
+
+    matrices = [numpy.identity(4) for i in range(3)]
+    for (i, matrix) in enumerate(matrices):
+      matrix[0, 3] = 10.0 * (i + 1)
+    replay = logic.createTransformReplay(transformNode, matrices, rate=1000.0)
+    for i in range(3):
+      replay.step()
+    logic.transformScheduler.flush()
+    self.assertEqual(len(updates), 1)
+    self.assertTrue(numpy.allclose(updates[0][:, 0], logic.templatePathOrigins[:, 0] + 30.0))
+    self.assertEqual((logic.latencyMonitor.processedFrames, logic.latencyMonitor.droppedFrames), (1, 2))
+    self.assertTrue(logic.latencyMonitor.getSummary()[0] >= 0.0)
+
+    # An update continued in the background ends its frame once the background result has been applied
+    logic.pathsUpdatedCallback = logic.deferLiveTrackingFrame
+    replay.step()
+    logic.transformScheduler.flush()
+    self.assertEqual(logic.latencyMonitor.processedFrames, 1)
+    logic.completeLiveTrackingFrame()
+    self.assertEqual((logic.latencyMonitor.processedFrames, logic.latencyMonitor.droppedFrames), (2, 2))
+    logic.completeLiveTrackingFrame()
+    self.assertEqual(logic.latencyMonitor.processedFrames, 2)
+
+    logic.setLiveTracking(False)
+    self.assertEqual(logic.transformScheduler.maxRate, logic.MAX_TRANSFORM_UPDATE_RATE)
+    self.delayDisplay('Test passed!')
+
+  def test_Registration(self):
+    """ The template markers must be registered to known marker positions with and without correspondences.
+    """
+
+    import shutil
+    import tempfile
+    self.delayDisplay("Starting the registration test")
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    markers = numpy.array([[-50.0, -50.0, 0.0], [50.0, -45.0, 0.0], [45.0, 50.0, 5.0], [-40.0, 40.0, 10.0],
+                           [0.0, 0.0, 20.0]])
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'Markers.csv')
+      shutil.copy(os.path.join(modulePath, 'Config/ProstateTemplate.csv'), path)
+      with open(path, 'a') as f:
+        for (i, marker) in enumerate(markers):
+          f.write('"FIDUCIAL","M%d",%.1f,%.1f,%.1f\n' % ((i,) + tuple(marker)))
+      logic = NeedleGuideTemplateLogic()
+      self.assertTrue(logic.loadTemplateConfigFile(path))
+    finally:
+      shutil.rmtree(directory)
+    self.assertEqual(logic.fiducialName, ['M0', 'M1', 'M2', 'M3', 'M4'])
+    self.assertTrue(numpy.allclose(logic.fiducialConfig, markers))
+
+    (c, s) = (numpy.cos(numpy.radians(10.0)), numpy.sin(numpy.radians(10.0)))
+    expected = numpy.array([[c, -s, 0.0, 12.0], [s, c, 0.0, -7.0], [0.0, 0.0, 1.0, 30.0], [0.0, 0.0, 0.0, 1.0]])
+    points = markers.dot(expected[0:3, 0:3].T) + expected[0:3, 3]
+
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    self.assertTrue(logic.registerTemplate(points, transformNode) < 1e-6)
+    matrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToParent(matrix)
+    self.assertTrue(numpy.allclose(logic.arrayFromVTKMatrix(matrix), expected))
+
+    # Shuffled markers and a spurious point, starting from a pose a few mm off
+    initial = expected.copy()
+    initial[0:3, 3] += [3.0, -2.0, 2.0]
+    transformNode.SetMatrixTransformToParent(logic.vtkMatrixFromArray(initial))
+    shuffled = numpy.vstack([points[[3, 0, 4, 2, 1]], [[200.0, 200.0, 200.0]]])
+    self.assertTrue(logic.registerTemplate(shuffled, transformNode, correspondences=False, maxDistance=20.0) < 1e-3)
+    transformNode.GetMatrixTransformToParent(matrix)
+    self.assertTrue(numpy.allclose(logic.arrayFromVTKMatrix(matrix), expected, atol=1e-3))
+    self.assertTrue(logic.registerTemplate(points[0:2], transformNode) is None)
+
+    # Markers far from every marker point must fail without touching the transform
+    self.assertTrue(logic.registerTemplate(points + 100.0, transformNode, correspondences=False,
+                                           maxDistance=20.0) is None)
+    transformNode.GetMatrixTransformToParent(matrix)
+    self.assertTrue(numpy.allclose(logic.arrayFromVTKMatrix(matrix), expected, atol=1e-3))
+    try:
+      registerPointSets(markers, points + 100.0, expected, maxDistance=20.0)
+      self.fail('registerPointSets must reject point sets without pairs within maxDistance')
+    except ValueError:
+      pass
+    slicer.mrmlScene.RemoveNode(transformNode)
+    self.delayDisplay('Test passed!')
+
+  def test_MarkerDetection(self):
+    """ Markers must be found as the centroids of bright blobs, in chunks and within a region of the volume.
+    """
+
+    self.delayDisplay("Starting the marker detection test")
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(80, 70, 40)
+    if vtk.VTK_MAJOR_VERSION <= 5:
+      imageData.SetScalarTypeToShort()
+      imageData.AllocateScalars()
+    else:
+      imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(40, 70, 80)
+    array[:] = numpy.random.RandomState(23).randint(0, 100, array.shape)
+    markers = [(10, 10, 5), (70, 12, 8), (65, 60, 30), (15, 55, 34)]
+    for (i, j, k) in markers:
+      array[k - 1:k + 2, j - 1:j + 2, i - 1:i + 2] = 1000
+    array[20, 35, 40] = 1000  # Noise below the minimum marker volume
+    imageData.Modified()
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    volumeNode.SetOrigin(-40.0, -35.0, 0.0)
+    volumeNode.SetSpacing(1.0, 1.0, 2.0)
+    slicer.mrmlScene.AddNode(volumeNode)
+
+    logic = NeedleGuideTemplateLogic()
+    markersNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(markersNode)
+    points = logic.detectTemplateMarkers(volumeNode, 500.0, markersNode=markersNode, nearTemplate=False)
+    expected = numpy.array(markers, dtype=numpy.float64) * [1.0, 1.0, 2.0] + [-40.0, -35.0, 0.0]
+    self.assertEqual(markersNode.GetNumberOfFiducials(), len(markers))
+    self.assertTrue(numpy.allclose(numpy.sort(points, axis=0), numpy.sort(expected, axis=0)))
+
+    ijkToRAS = numpy.diag([1.0, 1.0, 2.0, 1.0])
+    ijkToRAS[0:3, 3] = [-40.0, -35.0, 0.0]
+    (chunked, volumes) = detectMarkers(array, ijkToRAS, 500.0, minVolume=5.0, chunkSize=1000)
+    self.assertTrue(numpy.allclose(numpy.sort(chunked, axis=0), numpy.sort(expected, axis=0)))
+    self.assertTrue(numpy.allclose(volumes, 18.0))
+    region = computeRegion(ijkToRAS, (80, 70, 40), expected[0:1], 5.0)
+    (nearby, volumes) = detectMarkers(array, ijkToRAS, 500.0, minVolume=5.0, region=region)
+    self.assertTrue(numpy.allclose(nearby, expected[0:1]))
+    slicer.mrmlScene.RemoveNode(markersNode)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    self.delayDisplay('Test passed!')
+
+  def test_TargetTable(self):
+    """ The target table model must present the result store sorted and filtered without copying its rows.
+    """
+
+    self.delayDisplay("Starting the target table test")
+    results = TargetResults(capacity=2)
+    results.resize(4)
+    results.update(numpy.arange(4), label=['T-2', 'T-10', 'X-1', 'T-3'], hole=[3, 1, 1, 0],
+                   holeX=['C', 'A', 'A', 'B'], holeY=['1', '2', '2', '3'], tilt=[0.0, 5.0, 0.0, 0.0],
+                   depth=[10.0, 30.0, 20.0, 40.0], inRange=[True, False, True, True], blocked=False,
+                   position=numpy.arange(12.0).reshape(4, 3))
+    self.assertEqual(len(results.records), 4)
+
+    model = TargetTableModel(results)
+    view = qt.QTableView()
+    view.setModel(model)
+    model.refresh()
+    self.assertEqual(model.rowCount(), 4)
+    self.assertEqual(model.data(model.index(1, 1), qt.Qt.DisplayRole), '(A, 2) 5.0 deg')
+    self.assertEqual(model.data(model.index(1, 2), qt.Qt.DisplayRole), '(30.000)')
+
+    model.sort(2, qt.Qt.DescendingOrder)
+    self.assertEqual(list(model.order), [3, 1, 2, 0])
+    self.assertEqual(model.data(model.index(0, 0), qt.Qt.DisplayRole), 'T-3')
+    results.update([3], depth=5.0)
+    model.refresh([3])
+    self.assertEqual(list(model.order), [1, 2, 0, 3])
+    model.sort(1, qt.Qt.AscendingOrder)
+    self.assertEqual(list(model.order), [3, 2, 1, 0])
+
+    model.setFilter('t-', inRangeOnly=True)
+    self.assertEqual(sorted(model.order), [0, 3])
+    self.assertEqual(model.getTargetRow(5), -1)
+    model.setFilter('')
+    model.sort(-1)
+    self.assertEqual(list(model.order), [0, 1, 2, 3])
+    records = results.records
+    results.resize(3)
+    model.refresh([])
+    self.assertEqual(model.rowCount(), 3)
+    self.assertTrue(results.records is records)
+    self.delayDisplay('Test passed!')
+
+  def test_LongSession(self):
+    """ 10000 target edits and 100 template reloads through the widget must neither accumulate memory, nodes,
+    observers or table rows nor slow down the edits.
+    """
+
+    try:
+      import tracemalloc
+    except ImportError:
+      tracemalloc = None
+    self.delayDisplay("Starting the long session test")
+    modulePath = os.path.dirname(slicer.util.modulePath('NeedleGuideTemplate'))
+    path = os.path.join(modulePath, 'Config/ProstateTemplate.csv')
+    numberOfNodes = slicer.mrmlScene.GetNumberOfNodes()
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    targetsNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(targetsNode)
+    random = numpy.random.RandomState(25)
+    positions = random.uniform(-30.0, 30.0, (20, 3)) + [0.0, 0.0, 90.0]
+    for (i, position) in enumerate(positions):
+      targetsNode.AddFiducial(position[0], position[1], position[2], 'T-%d' % (i + 1))
+
+    widget = NeedleGuideTemplateWidget()
+    widget.setup()
+    widget.logic.geometryCache = None
+    # Edits of single targets update the table synchronously; reloads recompute all rows on the background worker
+    widget.BACKGROUND_TABLE_UPDATE_SIZE = len(positions) // 2
+
+    def waitForWorker():
+      # Delivers the background results (table rows and template meshes) like the worker's timer does
+      deadline = time.time() + 10.0
+      while widget.worker.activeTasks and time.time() < deadline:
+        time.sleep(0.01)
+        widget.worker.processResults()
+      self.assertEqual(widget.worker.activeTasks, {})
+
+    def editTargets(count):
+      # Moves one target at a time; the node event schedules the table update, which is run at once
+      times = []
+      for i in range(count):
+        start = time.time()
+        row = i % len(positions)
+        position = positions[row] + random.uniform(-1.0, 1.0, 3)
+        targetsNode.SetNthFiducialPosition(row, position[0], position[1], position[2])
+        self.assertTrue(widget.tableScheduler.pending)
+        widget.tableScheduler.flush()
+        times.append(time.time() - start)
+        self.assertTrue(numpy.allclose(widget.targetResults.records['position'][row], position))
+      return times
+
+    def reloadTemplate(count):
+      for i in range(count):
+        self.assertTrue(widget.loadTemplate(path))
+        widget.logic.setTransform(transformNode)
+        widget.tableScheduler.flush()
+        self.assertTrue(widget.worker.isPending('table'))
+        waitForWorker()
+
+    widget.targetFiducialsSelector.setCurrentNode(targetsNode)
+    widget.onFiducialsSelected()
+    waitForWorker()
+
+    # The first round fills caches and allocator pools; the baseline is taken after it
+    firstTimes = editTargets(1000)
+    reloadTemplate(10)
+    sessionNodes = slicer.mrmlScene.GetNumberOfNodes()
+    capacity = len(widget.targetResults.records)
+    if tracemalloc is not None:
+      tracemalloc.start()
+      baseline = tracemalloc.get_traced_memory()[0]
+    for i in range(9):
+      lastTimes = editTargets(1000)
+      reloadTemplate(10)
+    if tracemalloc is not None:
+      growth = tracemalloc.get_traced_memory()[0] - baseline
+      tracemalloc.stop()
+      self.assertTrue(growth < 1 << 20, 'memory grew by %d bytes' % growth)
+    # Without tracemalloc (Python 2) the stores that grow with the session are checked directly
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), sessionNodes)
+    self.assertEqual(len(widget.targetResults.records), capacity)
+    self.assertEqual(widget.targetResults.size, len(positions))
+    self.assertEqual(widget.tableModel.rowCount(), len(positions))
+    self.assertEqual(widget.worker.activeTasks, {})
+    self.assertTrue(numpy.median(lastTimes) < 2.0 * numpy.median(firstTimes) + 1e-4)
+
+    # A single observer of the template transform is left after all reloads
+    key = 'event.templateTransformModified'
+    count = instrumentation.statistics.get(key, [0])[0]
+    matrix = numpy.identity(4)
+    matrix[0, 3] = 5.0
+    transformNode.SetMatrixTransformToParent(widget.logic.vtkMatrixFromArray(matrix))
+    self.assertEqual(instrumentation.statistics.get(key, [0])[0], count + 1)
+
+    widget.cleanup()
+    widget.parent.deleteLater()
+    NeedleGuideTemplateLogic.removeNode(targetsNode.GetID())
+    NeedleGuideTemplateLogic.removeNode(transformNode.GetID())
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), numberOfNodes)
+    self.delayDisplay('Test passed!')
 
 class ProjectionWindow(qt.QWidget):
+  """Projection of the targets onto the hole grid of the template, with a crosshair on the selected hole.
+
+  The static frame and hole grid are rendered once into a pixmap, which is only redrawn after a resize or a template
+  change. Target and selection changes repaint just the regions they affect.
+  """
+
+  TOP_MARGIN = 50
+  MARKER_RADIUS = 4
+  CROSSHAIR_WIDTH = 2
 
-  horizontal = 0
-  vertical = 0
-  
   def __init__(self, parent=None):
     qt.QWidget.__init__(self, parent)
+    self.labelsX = []  ## Hole labels along the vertical axis of the grid
+    self.labelsY = []  ## Hole labels along the horizontal axis of the grid
+    self.rows = {}
+    self.columns = {}
+    self.gridPixmap = None  ## Cached rendering of the frame and hole grid (None if outdated)
+    self.targets = []  ## (labelX, labelY, inRange) of the nearest hole of every target
+    self.selection = None  ## (labelX, labelY) of the hole under the crosshair
     self.initUI()
     
   def initUI(self):
     self.setGeometry(0, 0, 300, 330)
     self.setWindowTitle('Crosshair')
-    
+
+  def setTemplate(self, index):
+    (self.labelsX, self.labelsY) = getHoleGrid(index)
+    self.rows = dict((label, i) for (i, label) in enumerate(self.labelsX))
+    self.columns = dict((label, i) for (i, label) in enumerate(self.labelsY))
+    self.gridPixmap = None
+    self.update()
+
+  def setTargets(self, targets):
+    dirty = qt.QRegion()
+    for i in range(max(len(targets), len(self.targets))):
+      old = self.targets[i] if i < len(self.targets) else None
+      new = targets[i] if i < len(targets) else None
+      if old != new:
+        for target in (old, new):
+          if target is not None:
+            dirty = self.addRect(dirty, self.getMarkerRect(target[0], target[1]))
+    self.targets = list(targets)
+    if not dirty.isEmpty():
+      self.update(dirty)
+
+  def setSelection(self, labelX, labelY):
+    if self.selection == (labelX, labelY):
+      return
+    dirty = qt.QRegion()
+    for selection in (self.selection, (labelX, labelY)):
+      if selection is not None:
+        for rect in self.getCrosshairRects(selection[0], selection[1]):
+          dirty = self.addRect(dirty, rect)
+    self.selection = (labelX, labelY)
+    if not dirty.isEmpty():
+      self.update(dirty)
+
+  @staticmethod
+  def addRect(region, rect):
+    if rect is None:
+      return region
+    return region.united(qt.QRegion(rect))
+
+  def getCellSize(self):
+    if not self.labelsX or not self.labelsY:
+      return 0.0
+    return min(float(self.width) / len(self.labelsY), float(self.height - self.TOP_MARGIN) / len(self.labelsX))
+
+  def getHoleCenter(self, labelX, labelY):
+    # Returns the (x, y) pixel position of a hole or None for holes that are not on the grid (e.g. '--')
+    if labelX not in self.rows or labelY not in self.columns:
+      return None
+    d = self.getCellSize()
+    return (self.columns[labelY] + 0.5) * d, self.TOP_MARGIN + (self.rows[labelX] + 0.5) * d
+
+  def getMarkerRect(self, labelX, labelY):
+    center = self.getHoleCenter(labelX, labelY)
+    if center is None:
+      return None
+    r = self.MARKER_RADIUS + 1
+    return qt.QRect(int(center[0]) - r, int(center[1]) - r, 2 * r + 2, 2 * r + 2)
+
+  def getCrosshairRects(self, labelX, labelY):
+    center = self.getHoleCenter(labelX, labelY)
+    if center is None:
+      return []
+    w = self.CROSSHAIR_WIDTH + 2
+    return [qt.QRect(0, int(center[1]) - w, self.width, 2 * w + 1),
+            qt.QRect(int(center[0]) - w, self.TOP_MARGIN, 2 * w + 1, self.height - self.TOP_MARGIN)]
+
+  def resizeEvent(self, e):
+    self.gridPixmap = None
+
   def paintEvent(self, e):
-        
+    if self.gridPixmap is None:
+      self.gridPixmap = self.renderGrid()
+    rect = e.rect()
     qp = qt.QPainter()
     qp.begin(self)
-    self.drawLines(qp)
+    qp.drawPixmap(rect, self.gridPixmap, rect)
+    self.drawTargets(qp, rect)
+    self.drawCrosshair(qp)
     qp.end()
-        
-  def setXY(self, x, y):
-    self.horizontal = x
-    self.vertical = y
 
-  def drawLines(self, qp):
+  def renderGrid(self):
+    (w, h) = (self.width, self.height)
+    pixmap = qt.QPixmap(w, h)
+    pixmap.fill(self.palette.color(qt.QPalette.Window))
+    qp = qt.QPainter()
+    qp.begin(pixmap)
 
-    pen = qt.QPen(qt.Qt.red, 2, qt.Qt.SolidLine)
-    
-    qp.setPen(pen)
-    qp.drawLine(0, self.horizontal, 300, self.horizontal)
-    
-    qp.setPen(pen)
-    qp.drawLine(self.vertical, 50, self.vertical, 330)
-  
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
-    qp.setPen(pen)
-    qp.drawLine(0, 50, 300, 50)
-    
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
-    qp.setPen(pen)
-    qp.drawLine(0, 50, 0, 90)
-    
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
-    qp.setPen(pen)
-    qp.drawLine(0, 330, 40, 330)
-    
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
-    qp.setPen(pen)
-    qp.drawLine(0, 290, 0, 330)
-    
-    #pen.setStyle(qt.Qt.DashLine)
-    #pen.setColor(qt.Qt.black)
-    #qp.setPen(pen)
-    #qp.drawLine(300, 0, 260, 0)
-    
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
-    qp.setPen(pen)
-    qp.drawLine(300, 50, 300, 90)
-    
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
+    # Dashed frame: top edge and the four corners of the template
+    pen = qt.QPen(qt.Qt.black, 2, qt.Qt.DashLine)
     qp.setPen(pen)
-    qp.drawLine(300, 290, 300, 330)
-    
-    pen.setStyle(qt.Qt.DashLine)
-    pen.setColor(qt.Qt.black)
-    qp.setPen(pen)
-    qp.drawLine(300, 330, 260, 330)
-    
+    top = self.TOP_MARGIN
+    (right, bottom) = (w - 1, h - 1)
+    qp.drawLine(0, top, right, top)
+    qp.drawLine(0, top, 0, top + 40)
+    qp.drawLine(0, bottom, 40, bottom)
+    qp.drawLine(0, bottom - 40, 0, bottom)
+    qp.drawLine(right, top, right, top + 40)
+    qp.drawLine(right, bottom - 40, right, bottom)
+    qp.drawLine(right, bottom, right - 40, bottom)
+
+    # Holes and the labels of the grid columns
+    qp.setPen(qt.QPen(qt.Qt.gray, 1, qt.Qt.SolidLine))
+    for labelX in self.labelsX:
+      for labelY in self.labelsY:
+        (x, y) = self.getHoleCenter(labelX, labelY)
+        qp.drawEllipse(qt.QPointF(x, y), 1.5, 1.5)
+    qp.setPen(qt.QPen(qt.Qt.black, 1, qt.Qt.SolidLine))
+    for labelY in self.labelsY:
+      (x, y) = self.getHoleCenter(self.labelsX[0], labelY)
+      qp.drawText(qt.QRectF(x - 15, top - 20, 30, 15), qt.Qt.AlignCenter, str(labelY))
+    qp.end()
+    return pixmap
+
+  def drawTargets(self, qp, rect):
+    r = self.MARKER_RADIUS
+    for (inRange, color) in ((True, qt.Qt.darkGreen), (False, qt.Qt.darkYellow)):
+      qp.setPen(qt.QPen(color, 1, qt.Qt.SolidLine))
+      qp.setBrush(qt.QBrush(color))
+      for (labelX, labelY, targetInRange) in self.targets:
+        if targetInRange != inRange:
+          continue
+        markerRect = self.getMarkerRect(labelX, labelY)
+        if markerRect is not None and markerRect.intersects(rect):
+          center = self.getHoleCenter(labelX, labelY)
+          qp.drawEllipse(qt.QPointF(center[0], center[1]), r, r)
+    qp.setBrush(qt.QBrush())
+
+  def drawCrosshair(self, qp):
+    if self.selection is None:
+      return
+    center = self.getHoleCenter(self.selection[0], self.selection[1])
+    if center is None:
+      return
+    qp.setPen(qt.QPen(qt.Qt.red, self.CROSSHAIR_WIDTH, qt.Qt.SolidLine))
+    qp.drawLine(qt.QPointF(0, center[1]), qt.QPointF(self.width, center[1]))
+    qp.drawLine(qt.QPointF(center[0], self.TOP_MARGIN), qt.QPointF(center[0], self.height))
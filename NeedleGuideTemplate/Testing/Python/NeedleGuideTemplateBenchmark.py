@@ -0,0 +1,350 @@
+"""Offline benchmarks of the NeedleGuideTemplate logic.
+
+Times template loading, model building, transform updates, nearest path searches and table refreshes on synthetic
+rectangular templates, and marker detection on a synthetic volume. Slicer, VTK, Qt and CTK are replaced by minimal
+stubs so that the benchmarks run in any Python with NumPy and only measure the module's own code (VTK array
+conversion and rendering are not included):
+
+  python NeedleGuideTemplateBenchmark.py --output results.json
+
+Every measurement is written as one JSON object with the benchmark name, the number of holes and targets and the
+best and median time in seconds over the repetitions, so results of different releases can be compared directly.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import numpy
+
+MODULE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+DEFAULT_HOLES = [210, 1000, 10000, 100000]
+DEFAULT_TARGETS = [1, 100, 10000]
+MARKER_VOLUME_SHAPE = (200, 512, 512)
+
+
+#
+# Stubs of the Slicer environment
+#
+
+class Stub(object):
+  """Accepts any call and attribute access."""
+
+  def __init__(self, *args, **kwargs):
+    pass
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return Stub()
+
+  def __call__(self, *args, **kwargs):
+    return Stub()
+
+
+class MatrixStub(Stub):
+
+  def __init__(self):
+    self.elements = numpy.identity(4)
+
+  def Identity(self):
+    self.elements = numpy.identity(4)
+
+  def GetElement(self, i, j):
+    return self.elements[i, j]
+
+
+class IdTypeArrayStub(Stub):
+
+  def GetDataTypeSize(self):
+    return numpy.dtype(numpy.intp).itemsize
+
+
+class TransformNodeStub(Stub):
+
+  def __init__(self):
+    self.matrix = numpy.identity(4)
+
+  def GetMatrixTransformToWorld(self, matrix):
+    matrix.elements = self.matrix.copy()
+
+
+class NodeStub(Stub):
+
+  def __init__(self):
+    self.id = None
+    self.transformNode = None
+
+  def GetID(self):
+    return self.id
+
+  def GetParentTransformNode(self):
+    return self.transformNode
+
+  def GetDisplayNode(self):
+    return None
+
+
+class SceneStub(Stub):
+
+  def __init__(self):
+    self.nodes = {}
+
+  def AddNode(self, node):
+    node.id = 'vtkMRMLNode%d' % (len(self.nodes) + 1)
+    self.nodes[node.id] = node
+    return node
+
+  def GetNodeByID(self, nodeID):
+    return self.nodes.get(nodeID)
+
+  def Clear(self, *args):
+    self.nodes = {}
+
+
+class TimerStub(Stub):
+  """Never fires, so scheduled recomputes only run when they are flushed."""
+
+  def isActive(self):
+    return False
+
+
+class MarkupsStub(Stub):
+
+  def __init__(self, positions):
+    self.positions = positions
+    self.labels = ['T-%d' % (i + 1) for i in range(len(positions))]
+
+  def GetNumberOfFiducials(self):
+    return len(self.positions)
+
+  def GetNthFiducialPosition(self, i, pos):
+    pos[0], pos[1], pos[2] = self.positions[i]
+
+  def GetNthFiducialLabel(self, i):
+    return self.labels[i]
+
+
+def installStubs(temporaryPath):
+  """Installs stub slicer, vtk, qt and ctk modules and imports the module under test."""
+  slicer = types.ModuleType('slicer')
+  slicer.mrmlScene = SceneStub()
+  slicer.app = Stub()
+  slicer.app.temporaryPath = temporaryPath
+  slicer.util = Stub()
+  slicer.vtkMRMLModelNode = NodeStub
+  slicer.vtkMRMLModelDisplayNode = NodeStub
+  slicer.vtkMRMLTransformableNode = Stub()
+  slicer.vtkMRMLTransformableNode.TransformModifiedEvent = 15000
+
+  scriptedLoadableModule = types.ModuleType('slicer.ScriptedLoadableModule')
+  for name in ['ScriptedLoadableModule', 'ScriptedLoadableModuleWidget', 'ScriptedLoadableModuleLogic',
+               'ScriptedLoadableModuleTest']:
+    setattr(scriptedLoadableModule, name, type(name, (object,), {'__init__': lambda self, parent=None: None}))
+  slicer.ScriptedLoadableModule = scriptedLoadableModule
+
+  vtk = types.ModuleType('vtk')
+  vtk.vtkMatrix4x4 = MatrixStub
+  vtk.vtkIdTypeArray = IdTypeArrayStub
+  vtk.vtkPolyData = vtk.vtkPoints = vtk.vtkCellArray = Stub
+  vtk.util = types.ModuleType('vtk.util')
+  vtk.util.numpy_support = types.ModuleType('vtk.util.numpy_support')
+  vtk.util.numpy_support.numpy_to_vtk = Stub()
+  vtk.util.numpy_support.numpy_to_vtkIdTypeArray = Stub()
+
+  qt = types.ModuleType('qt')
+  qt.QTimer = TimerStub
+  qt.QWidget = type('QWidget', (object,), {})
+  qt.QAbstractTableModel = Stub
+  ctk = types.ModuleType('ctk')
+
+  modules = {'slicer': slicer, 'slicer.ScriptedLoadableModule': scriptedLoadableModule, 'vtk': vtk,
+             'vtk.util': vtk.util, 'vtk.util.numpy_support': vtk.util.numpy_support, 'qt': qt, 'ctk': ctk}
+  sys.modules.update(modules)
+  import __main__
+  for name in ['vtk', 'qt', 'ctk', 'slicer']:
+    setattr(__main__, name, modules[name])
+
+  sys.path.insert(0, MODULE_PATH)
+  import NeedleGuideTemplate
+  return NeedleGuideTemplate
+
+
+#
+# Synthetic data
+#
+
+def writeSyntheticTemplate(path, nHoles, spacing=5.0, depth=150.0):
+  """Writes a template CSV with nHoles parallel paths on an approximately square grid."""
+  nColumns = int(numpy.ceil(numpy.sqrt(nHoles)))
+  with open(path, 'w') as f:
+    f.write('"Synthetic %d"\n' % nHoles)
+    for i in range(nHoles):
+      (row, column) = divmod(i, nColumns)
+      (x, y) = (column * spacing, row * spacing)
+      f.write('"H%d",%d,%.1f,%.1f,30,%.1f,%.1f,50,%.1f\n' % (column, row, x, y, x, y, depth))
+  return nColumns * spacing
+
+
+def makeTargets(nTargets, extent, random):
+  return numpy.column_stack([random.uniform(0, extent, (nTargets, 2)), random.uniform(40, 200, nTargets)])
+
+
+def makeTransforms(count, random):
+  transforms = []
+  for i in range(count):
+    angle = random.uniform(-0.2, 0.2)
+    matrix = numpy.identity(4)
+    matrix[0:2, 0:2] = [[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]]
+    matrix[0:3, 3] = random.uniform(-20, 20, 3)
+    transforms.append(matrix)
+  return transforms
+
+
+#
+# Benchmarks
+#
+
+def measure(function, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    function()
+    times.append(time.time() - start)
+  return min(times), float(numpy.median(times))
+
+
+def record(results, name, nHoles, nTargets, times, repeat, **extra):
+  results.append(dict({'benchmark': name, 'holes': nHoles, 'targets': nTargets, 'repeat': repeat,
+                       'best': times[0], 'median': times[1]}, **extra))
+  print('%-32s holes=%-7d targets=%-6d best=%.6fs median=%.6fs' % (name, nHoles, nTargets, times[0], times[1]))
+
+
+def benchmarkMarkerDetection(results, repeat, random):
+  # Marker detection on a typical intraprocedural volume with 8 markers of 5 x 5 x 3 voxels. The volume is local,
+  # so it is released before the template benchmarks run.
+  from Utils.markerdetection import detectMarkers
+  volume = random.randint(0, 400, MARKER_VOLUME_SHAPE).astype(numpy.int16)
+  for (k, j, i) in zip(*[random.randint(10, n - 10, 8) for n in MARKER_VOLUME_SHAPE]):
+    volume[k - 1:k + 2, j - 2:j + 3, i - 2:i + 3] = 1000
+  ijkToRAS = numpy.diag([0.5, 0.5, 1.0, 1.0])
+  record(results, 'detectMarkers', 0, 0, measure(lambda: detectMarkers(volume, ijkToRAS, 500, minVolume=5.0), repeat),
+         repeat, voxels=volume.size)
+
+
+def runBenchmarks(holeCounts, targetCounts, repeat, temporaryPath):
+  module = installStubs(temporaryPath)
+  from Utils.templateconfig import convertTemplateConfigFile, loadTemplateConfig
+  from Utils.templatemesh import LOD_AUTO, LOD_HIGH, LOD_LOW, LOD_LINES
+
+  random = numpy.random.RandomState(0)
+  results = []
+  benchmarkMarkerDetection(results, repeat, random)
+  for nHoles in holeCounts:
+    templatePath = os.path.join(temporaryPath, 'template%d.csv' % nHoles)
+    extent = writeSyntheticTemplate(templatePath, nHoles)
+    binaryPath = os.path.join(temporaryPath, 'template%d.npy' % nHoles)
+    convertTemplateConfigFile(templatePath, binaryPath)
+
+    logic = module.NeedleGuideTemplateLogic()
+    logic.geometryCache = None
+    record(results, 'loadTemplateConfig.csv', nHoles, 0, measure(lambda: loadTemplateConfig(templatePath), repeat),
+           repeat)
+    record(results, 'loadTemplateConfig.npy', nHoles, 0, measure(lambda: loadTemplateConfig(binaryPath), repeat),
+           repeat)
+    record(results, 'loadTemplateConfigFile', nHoles, 0,
+           measure(lambda: logic.loadTemplateConfigFile(templatePath), repeat), repeat)
+    record(results, 'createTemplateModel', nHoles, 0, measure(logic.createTemplateModel, repeat), repeat)
+    # Glyphs need a real VTK; their mesh generation is trivial and rendering is not measured here
+    for level in (LOD_HIGH, LOD_LOW, LOD_LINES):
+      logic.levelOfDetail = level
+      record(results, 'createTemplateModel.' + level, nHoles, 0, measure(logic.createTemplateModel, repeat), repeat,
+             triangles=logic.countTriangles(level))
+    logic.levelOfDetail = LOD_AUTO
+
+    transformNode = TransformNodeStub()
+    logic.tempModelNode.transformNode = transformNode
+    transforms = iter(makeTransforms(repeat, random))
+
+    def updateTemplateVectors():
+      transformNode.matrix = next(transforms)
+      logic.updateTemplateVectors()
+    record(results, 'updateTemplateVectors', nHoles, 0, measure(updateTemplateVectors, repeat), repeat)
+    record(results, 'updateTemplateVectors.unchanged', nHoles, 0, measure(logic.updateTemplateVectors, repeat),
+           repeat)
+
+    for nTargets in targetCounts:
+      targets = makeTargets(nTargets, extent, random)
+      record(results, 'computeNearestPaths', nHoles, nTargets,
+             measure(lambda: logic.computeNearestPaths(targets), repeat), repeat)
+      if nTargets <= 100:
+        record(results, 'computeNearestPath.loop', nHoles, nTargets,
+               measure(lambda: [logic.computeNearestPath(target) for target in targets], repeat), repeat)
+
+      widget = module.NeedleGuideTemplateWidget.__new__(module.NeedleGuideTemplateWidget)
+      widget.logic = logic
+      widget.worker = module.BackgroundWorker(numberOfThreads=0)
+      widget.BACKGROUND_TABLE_UPDATE_SIZE = nTargets  # Measure the computation itself instead of handing it off
+      widget.table = Stub()
+      widget.targetResults = module.TargetResults()
+      widget.tableModel = module.TargetTableModel(widget.targetResults)
+      widget.ex = None
+      widget.targetFiducialsNode = MarkupsStub(targets.copy())
+      widget.resetTableCache()
+
+      def refreshTable():
+        widget.resetTableCache()
+        widget.updateTable()
+      record(results, 'updateTable.full', nHoles, nTargets, measure(refreshTable, repeat), repeat)
+
+      def dragTarget():
+        widget.targetFiducialsNode.positions[0] += 0.5
+        widget.updateTable()
+      record(results, 'updateTable.dragOne', nHoles, nTargets, measure(dragTarget, repeat), repeat)
+
+      # Live tracking: a streamed transform updates paths and all target rows in one pipeline
+      widget.tableScheduler = module.RecomputeScheduler(widget.updateTable)
+      logic.pathsUpdatedCallback = widget.onPathsUpdated
+      logic.setLiveTracking(True)
+      frames = iter(makeTransforms(repeat, random))
+
+      def streamFrame():
+        transformNode.matrix = next(frames)
+        logic.onTemplateTransformUpdated(None, None)
+        logic.processTransformUpdate()
+      record(results, 'liveTracking.frame', nHoles, nTargets, measure(streamFrame, repeat), repeat)
+      logic.setLiveTracking(False)
+      logic.pathsUpdatedCallback = None
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Runs the NeedleGuideTemplate benchmarks.')
+  parser.add_argument('--holes', type=int, nargs='+', default=DEFAULT_HOLES, help='template sizes')
+  parser.add_argument('--targets', type=int, nargs='+', default=DEFAULT_TARGETS, help='numbers of targets')
+  parser.add_argument('--repeat', type=int, default=5, help='repetitions of every measurement')
+  parser.add_argument('--output', help='JSON file the results are written to')
+  args = parser.parse_args(argv)
+
+  temporaryPath = tempfile.mkdtemp()
+  try:
+    results = runBenchmarks(args.holes, args.targets, args.repeat, temporaryPath)
+  finally:
+    shutil.rmtree(temporaryPath, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'python': platform.python_version(), 'numpy': numpy.__version__, 'platform': platform.platform(),
+                 'results': results}, f, indent=2)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,194 @@
+"""Headless batch planning of needle guide template cases.
+
+Runs the nearest needle path search of NeedleGuideTemplateLogic for many cases without Slicer, Qt or VTK:
+
+  python -m Utils.batchplanning manifest.csv -o results.csv -j 8
+
+The manifest is a CSV file with the columns template, transform and targets (a header row is required, relative
+paths are resolved against the manifest's directory):
+
+  template   template configuration CSV file in the format of Config/ProstateTemplate.csv, optionally with
+             additional directions of angulated holes, or a binary template (.npy)
+  transform  text file with the 16 values of the 4 x 4 template-to-world matrix in row-major order, or empty for
+             the identity
+  targets    Slicer markups .fcsv file, or a CSV file with label, R, A, S rows
+
+All jobs are distributed over a process pool and the results are written as one CSV table with one row per target.
+A case that cannot be planned (unreadable template, transform or targets file) gets a single row with the error
+message in the error column; the other cases are still planned and the exit code is 1.
+"""
+
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import sys
+import numpy
+
+from Utils.pathsearch import buildPathIndex, computeNearestPaths
+from Utils.templateconfig import (loadTemplateFile, getHoleLabels, computePathTilts,
+                                  transformTemplatePaths)
+
+RESULT_COLUMNS = ['job', 'template', 'targets', 'target', 'R', 'A', 'S', 'holeX', 'holeY', 'angle', 'tilt', 'depth',
+                  'inRange', 'error']
+
+_templates = {}  # Parsed templates of the current worker process by path
+
+
+def _openCSV(path, mode='r'):
+  if sys.version_info[0] < 3:
+    return open(path, mode + 'b')
+  return open(path, mode, newline='')
+
+
+def readManifest(path):
+  """Returns a list of (template, transform, targets) paths. transform is None for the identity."""
+  directory = os.path.dirname(os.path.abspath(path))
+
+  def resolve(value):
+    value = (value or '').strip()
+    return os.path.join(directory, value) if value else None
+
+  with _openCSV(path) as f:
+    return [(resolve(row['template']), resolve(row.get('transform')), resolve(row['targets']))
+            for row in csv.DictReader(f)]
+
+
+def readTransformFile(path):
+  """Reads a 4 x 4 matrix from a text file with 16 whitespace or comma separated values."""
+  if path is None:
+    return numpy.identity(4)
+  with open(path, 'r') as f:
+    values = f.read().replace(',', ' ').split()
+  if len(values) != 16:
+    raise ValueError('%s: expected 16 matrix elements, found %d' % (path, len(values)))
+  return numpy.array([float(value) for value in values]).reshape(4, 4)
+
+
+def readTargetsFile(path):
+  """Returns (labels, positions) of the targets in a markups .fcsv or a label, R, A, S CSV file."""
+  markups = path.lower().endswith('.fcsv')
+  labels = []
+  positions = []
+  with _openCSV(path) as f:
+    for row in csv.reader(f):
+      if not row or row[0].startswith('#'):
+        continue
+      try:
+        position = [float(value) for value in row[1:4]]
+      except ValueError:
+        continue  # Header row
+      if len(position) != 3:
+        continue
+      labels.append(row[11] if markups and len(row) > 11 else row[0])
+      positions.append(position)
+  return labels, numpy.array(positions, dtype=numpy.float64).reshape(-1, 3)
+
+
+def loadTemplate(path):
+  """Returns (index, origins, vectors, maxDepths, holes, angles, tilts) of the needle paths of a template, parsed
+  once per process."""
+  if path not in _templates:
+    (name, index, config, directions, paths) = loadTemplateFile(path)
+    (origins, vectors, maxDepths, holes, angles) = paths
+    tilts = computePathTilts(vectors, holes, angles)
+    _templates[path] = (index, origins, vectors, maxDepths, holes, angles, tilts)
+  return _templates[path]
+
+
+def planJob(job):
+  """Computes the nearest paths for one (jobID, template, transform, targets) job and returns the result rows."""
+  (jobID, templatePath, transformPath, targetsPath) = job
+  (index, templateOrigins, templateVectors, maxDepths, holes, angles, tilts) = loadTemplate(templatePath)
+  (origins, vectors) = transformTemplatePaths(templateOrigins, templateVectors, readTransformFile(transformPath))
+  (labels, positions) = readTargetsFile(targetsPath)
+
+  pathIndex = buildPathIndex(origins, vectors, maxDepths)
+  if pathIndex is not None:
+    (paths, depths, inRange) = pathIndex.computeNearestPaths(positions)
+  else:
+    (paths, depths, inRange) = computeNearestPaths(origins, vectors, maxDepths, positions)
+
+  rows = []
+  for i in range(len(labels)):
+    path = paths[i]
+    (holeX, holeY) = getHoleLabels(index, holes[path] if path >= 0 else -1)
+    (angle, tilt) = (angles[path], '%.3f' % tilts[path]) if path >= 0 else (-1, '')
+    rows.append([jobID, templatePath, targetsPath, labels[i], '%.3f' % positions[i][0], '%.3f' % positions[i][1],
+                 '%.3f' % positions[i][2], holeX, holeY, angle, tilt, '%.3f' % depths[i], int(inRange[i]), ''])
+  return rows
+
+
+def planJobSafely(job):
+  """Returns (rows, error) of planJob; a job that fails gets one row with the error message and error is True."""
+  try:
+    return planJob(job), False
+  except Exception as e:
+    (jobID, templatePath, transformPath, targetsPath) = job
+    message = '%s: %s' % (type(e).__name__, e)
+    return [[jobID, templatePath, targetsPath] + [''] * (len(RESULT_COLUMNS) - 4) + [message]], True
+
+
+def runBatch(jobs, outputPath, processes=None, chunkSize=4):
+  """Plans all jobs on a pool of processes and writes the results in job order.
+
+  Returns (nRows, failedJobs) with the number of target rows and the IDs (manifest row indices) of the jobs that
+  failed. The table is written to a temporary file that replaces outputPath once all jobs are done, so an interrupted
+  run never leaves a truncated table behind.
+  """
+  jobs = [(jobID,) + tuple(job) for (jobID, job) in enumerate(jobs)]
+  nRows = 0
+  failedJobs = []
+  temporaryPath = outputPath + '.partial'
+  try:
+    with _openCSV(temporaryPath, 'w') as f:
+      writer = csv.writer(f)
+      writer.writerow(RESULT_COLUMNS)
+      if processes == 1:
+        results = (planJobSafely(job) for job in jobs)
+        pool = None
+      else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(planJobSafely, jobs, chunkSize)
+      try:
+        for (rows, failed) in results:
+          writer.writerows(rows)
+          if failed:
+            failedJobs.append(rows[0][0])
+            logging.getLogger('NeedleGuideTemplate').error('job %d failed: %s', rows[0][0], rows[0][-1])
+          else:
+            nRows += len(rows)
+      finally:
+        if pool is not None:
+          pool.close()
+          pool.join()
+    if os.path.exists(outputPath):
+      os.remove(outputPath)
+    os.rename(temporaryPath, outputPath)
+  finally:
+    if os.path.exists(temporaryPath):
+      os.remove(temporaryPath)
+  return nRows, failedJobs
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Identifies needle guide holes and depths for batches of cases.')
+  parser.add_argument('manifest', help='CSV file with template, transform and targets columns')
+  parser.add_argument('-o', '--output', required=True, help='CSV file the results are written to')
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='number of worker processes (default: number of CPUs)')
+  args = parser.parse_args(argv)
+
+  jobs = readManifest(args.manifest)
+  (nRows, failedJobs) = runBatch(jobs, args.output, args.jobs)
+  print('Planned %d targets of %d cases' % (nRows, len(jobs) - len(failedJobs)))
+  if failedJobs:
+    sys.stderr.write('%d cases failed (manifest lines %s)\n' % (len(failedJobs),
+                                                                ', '.join(str(jobID + 2) for jobID in failedJobs)))
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import logging
+import tempfile
+import numpy
+
+MESH_ARRAYS = ('points', 'normals', 'polys', 'numberOfCells')
+
+
+def hashFile(path, blockSize=1 << 16):
+  """Returns the SHA-1 hex digest of the content of the file at path."""
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    block = f.read(blockSize)
+    while block:
+      digest.update(block)
+      block = f.read(blockSize)
+  return digest.hexdigest()
+
+
+class GeometryCache(object):
+  """Size bounded on-disk cache of tube meshes as returned by Utils.templatemesh.createTubeMesh.
+
+  Entries are stored as .npz files named after a key that combines the content hash of the template configuration
+  with the mesh parameters, so that editing the configuration file automatically misses the old entries. When the
+  total size exceeds maxSize the least recently used entries are removed.
+  """
+
+  DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+  def __init__(self, directory, maxSize=DEFAULT_MAX_SIZE):
+    self.directory = directory
+    self.maxSize = maxSize
+
+  @staticmethod
+  def makeKey(contentHash, name, radius, numberOfSides):
+    parameters = '%s|%s|%r|%d' % (contentHash, name, float(radius), int(numberOfSides))
+    return hashlib.sha1(parameters.encode('utf-8')).hexdigest()
+
+  def getPath(self, key):
+    return os.path.join(self.directory, key + '.npz')
+
+  def load(self, key):
+    """Returns the cached (points, normals, polys, numberOfCells) for key or None on a miss."""
+    path = self.getPath(key)
+    if not os.path.isfile(path):
+      return None
+    try:
+      with numpy.load(path) as data:
+        mesh = tuple(data[name] for name in MESH_ARRAYS)
+    except Exception as e:
+      # Truncated or foreign files are dropped and regenerated
+      logging.getLogger('NeedleGuideTemplate').warning('Discarding geometry cache entry %s: %s', path, e)
+      self._remove(path)
+      return None
+    os.utime(path, None)
+    return mesh[:3] + (int(mesh[3]),)
+
+  def store(self, key, mesh):
+    """Writes mesh to the cache and evicts old entries if the cache grew beyond maxSize."""
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      # Write to a temporary file first so that concurrent readers never see a partial entry
+      (fd, temporaryPath) = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+      with os.fdopen(fd, 'wb') as f:
+        numpy.savez(f, **dict(zip(MESH_ARRAYS, mesh)))
+      if os.path.exists(self.getPath(key)):
+        os.remove(self.getPath(key))
+      os.rename(temporaryPath, self.getPath(key))
+    except (IOError, OSError) as e:
+      logging.getLogger('NeedleGuideTemplate').warning('Could not write geometry cache entry %s: %s', key, e)
+      return
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for fileName in os.listdir(self.directory):
+      if fileName.endswith('.npz'):
+        path = os.path.join(self.directory, fileName)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    totalSize = sum(entry[1] for entry in entries)
+    for (mtime, size, path) in sorted(entries):
+      if totalSize <= self.maxSize:
+        break
+      self._remove(path)
+      totalSize -= size
+
+  def clear(self):
+    if os.path.isdir(self.directory):
+      for fileName in os.listdir(self.directory):
+        if fileName.endswith('.npz'):
+          self._remove(os.path.join(self.directory, fileName))
+
+  @staticmethod
+  def _remove(path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
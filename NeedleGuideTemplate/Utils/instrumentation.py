@@ -0,0 +1,81 @@
+import csv
+import sys
+import time
+import functools
+
+STATISTICS_COLUMNS = ['name', 'count', 'total (ms)', 'mean (ms)', 'max (ms)']
+
+
+class Instrumentation(object):
+  """Collects counters and timing spans of the module's entry points.
+
+  Counters count occurrences such as received events. Spans additionally accumulate the time spent in a block:
+
+    with instrumentation.span('updateTable'):
+      ...
+
+  Recording costs two clock reads and a dictionary update, so it is always enabled.
+  """
+
+  def __init__(self):
+    self.statistics = {}  ## name -> [count, total seconds, max seconds]
+
+  def count(self, name, n=1):
+    entry = self.statistics.setdefault(name, [0, 0.0, 0.0])
+    entry[0] += n
+
+  def addTime(self, name, seconds):
+    entry = self.statistics.setdefault(name, [0, 0.0, 0.0])
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds)
+
+  def span(self, name):
+    return _Span(self, name)
+
+  def reset(self):
+    self.statistics = {}
+
+  def getRows(self):
+    """Returns one [name, count, total, mean, max] row per counter or span, times in milliseconds."""
+    rows = []
+    for name in sorted(self.statistics):
+      (count, total, maximum) = self.statistics[name]
+      rows.append([name, count, total * 1000.0, total * 1000.0 / count if count else 0.0, maximum * 1000.0])
+    return rows
+
+  def exportCSV(self, path):
+    with (open(path, 'wb') if sys.version_info[0] < 3 else open(path, 'w', newline='')) as f:
+      writer = csv.writer(f)
+      writer.writerow(STATISTICS_COLUMNS)
+      for row in self.getRows():
+        writer.writerow(row[0:2] + ['%.3f' % value for value in row[2:]])
+
+
+class _Span(object):
+
+  def __init__(self, instrumentation, name):
+    self.instrumentation = instrumentation
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.instrumentation.addTime(self.name, time.time() - self.start)
+    return False
+
+
+instrumentation = Instrumentation()
+
+
+def timed(name):
+  """Decorator recording every call of the decorated function as a span of the module instrumentation."""
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with instrumentation.span(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
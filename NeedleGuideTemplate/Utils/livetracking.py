@@ -0,0 +1,83 @@
+import time
+import collections
+import qt
+
+
+class LatencyMonitor(object):
+  """Measures the latency of streamed frames from their arrival to the end of their processing.
+
+  frameReceived() is called for every incoming frame and frameProcessed() once the latest state has been processed.
+  Frames that arrive while a frame is pending are merged into it and counted as dropped; the latency is measured
+  from the oldest merged frame, so it includes the time the pipeline lagged behind the stream.
+  """
+
+  def __init__(self, historySize=100):
+    self.latencies = collections.deque(maxlen=historySize)  ## Seconds of the most recent processed frames
+    self.pendingSince = None
+    self.pendingFrames = 0
+    self.receivedFrames = 0
+    self.processedFrames = 0
+    self.droppedFrames = 0
+
+  def reset(self):
+    self.__init__(self.latencies.maxlen)
+
+  def frameReceived(self, now=None):
+    if self.pendingSince is None:
+      self.pendingSince = time.time() if now is None else now
+    self.pendingFrames += 1
+    self.receivedFrames += 1
+
+  def frameProcessed(self, now=None):
+    """Returns the latency of the processed frame in seconds, or None if no frame was pending."""
+    if self.pendingSince is None:
+      return None
+    latency = (time.time() if now is None else now) - self.pendingSince
+    self.latencies.append(latency)
+    self.processedFrames += 1
+    self.droppedFrames += self.pendingFrames - 1
+    self.pendingSince = None
+    self.pendingFrames = 0
+    return latency
+
+  def getSummary(self):
+    """Returns (mean, maximum) latency in milliseconds over the recent frames, or (0, 0) without frames."""
+    if not self.latencies:
+      return 0.0, 0.0
+    return 1000.0 * sum(self.latencies) / len(self.latencies), 1000.0 * max(self.latencies)
+
+
+class TransformReplay(object):
+  """Stand-in for a tracking stream: passes recorded 4 x 4 matrices to setMatrix at a fixed rate.
+
+  setMatrix(matrix) typically writes the matrix into the transform node that positions the template, which then
+  emits the same events as a transform received over OpenIGTLink.
+  """
+
+  def __init__(self, setMatrix, matrices, rate=60.0, loop=True):
+    self.setMatrix = setMatrix
+    self.matrices = matrices
+    self.loop = loop
+    self.position = 0
+    self.timer = qt.QTimer()
+    self.timer.setInterval(int(round(1000.0 / rate)))
+    self.timer.connect('timeout()', self.step)
+
+  @property
+  def running(self):
+    return self.timer.isActive()
+
+  def start(self):
+    self.timer.start()
+
+  def stop(self):
+    self.timer.stop()
+
+  def step(self):
+    if self.position >= len(self.matrices):
+      if not self.loop or not self.matrices:
+        self.stop()
+        return
+      self.position = 0
+    self.setMatrix(self.matrices[self.position])
+    self.position += 1
@@ -0,0 +1,123 @@
+import numpy
+
+# Number of voxels thresholded at once
+DEFAULT_CHUNK_SIZE = 1 << 22
+
+# Thresholds selecting more voxels than this are rejected: markers are small and the components of so many voxels
+# would take too much memory and time
+MAX_FOREGROUND_VOXELS = 1 << 22
+
+
+def thresholdVolume(volume, lower, upper=None, region=None, chunkSize=DEFAULT_CHUNK_SIZE):
+  """Returns the (K, J, I) voxel coordinates of all voxels of a volume with lower <= value (<= upper).
+
+  volume is the (K, J, I) array of the image and region optional ((i0, j0, k0), (i1, j1, k1)) voxel bounds, the upper
+  bounds excluded, that limit the search. The volume is processed in slabs of whole slices of about chunkSize voxels.
+  Returns a 3 x N array of coordinates sorted in memory order. Raises ValueError if more than MAX_FOREGROUND_VOXELS
+  voxels are selected.
+  """
+  (nK, nJ, nI) = volume.shape
+  if region is None:
+    region = ((0, 0, 0), (nI, nJ, nK))
+  (i0, j0, k0) = [max(0, int(value)) for value in region[0]]
+  (i1, j1, k1) = [min(n, int(value)) for (n, value) in zip((nI, nJ, nK), region[1])]
+  if i1 <= i0 or j1 <= j0 or k1 <= k0:
+    return numpy.zeros((3, 0), dtype=numpy.intp)
+
+  slabSize = max(1, chunkSize // ((i1 - i0) * (j1 - j0)))
+  slabs = []
+  total = 0
+  for k in range(k0, k1, slabSize):
+    slab = volume[k:min(k + slabSize, k1), j0:j1, i0:i1]
+    mask = slab >= lower
+    if upper is not None:
+      mask &= slab <= upper
+    (sk, sj, si) = numpy.nonzero(mask)
+    total += sk.size
+    if total > MAX_FOREGROUND_VOXELS:
+      raise ValueError('the threshold selects more than %d voxels' % MAX_FOREGROUND_VOXELS)
+    slabs.append(numpy.array([sk + k, sj + j0, si + i0]))
+  return numpy.concatenate(slabs, axis=1) if slabs else numpy.zeros((3, 0), dtype=numpy.intp)
+
+
+def labelComponents(voxels):
+  """Labels the 6-connected components of a sparse set of voxels.
+
+  voxels is the 3 x N (K, J, I) array returned by thresholdVolume. Neighbors are found by binary search in the
+  linear voxel indices and the components by alternately hooking the larger onto the smaller label of every pair of
+  neighbors and compressing the label chains, all on arrays. Returns (labels, count) with component labels
+  0 .. count - 1 for every voxel.
+  """
+  nVoxels = voxels.shape[1]
+  if nVoxels == 0:
+    return numpy.zeros(0, dtype=numpy.intp), 0
+  upper = voxels.max(axis=1) + 2
+  strides = numpy.array([upper[1] * upper[2], upper[2], 1])
+  indices = strides.dot(voxels)
+
+  (firsts, seconds) = ([], [])
+  for axis in range(3):
+    neighbors = indices + strides[axis]
+    positions = numpy.minimum(numpy.searchsorted(indices, neighbors), nVoxels - 1)
+    found = numpy.nonzero(indices[positions] == neighbors)[0]
+    firsts.append(found)
+    seconds.append(positions[found])
+  firsts = numpy.concatenate(firsts)
+  seconds = numpy.concatenate(seconds)
+
+  labels = numpy.arange(nVoxels)
+  while True:
+    (a, b) = (labels[firsts], labels[seconds])
+    different = a != b
+    if not numpy.any(different):
+      break
+    numpy.minimum.at(labels, numpy.maximum(a, b)[different], numpy.minimum(a, b)[different])
+    while True:
+      compressed = labels[labels]
+      if numpy.array_equal(compressed, labels):
+        break
+      labels = compressed
+  (roots, labels) = numpy.unique(labels, return_inverse=True)
+  return labels, roots.size
+
+
+def detectMarkers(volume, ijkToRAS, lower, upper=None, minVolume=0.0, maxVolume=None, region=None,
+                  chunkSize=DEFAULT_CHUNK_SIZE):
+  """Finds bright markers in a volume as the centroids of connected components of thresholded voxels.
+
+  volume is the (K, J, I) array of the image and ijkToRAS its 4 x 4 voxel to world matrix. Components whose volume in
+  mm^3 lies outside [minVolume, maxVolume] are discarded, which removes noise specks and large bright structures.
+  region limits the search like in thresholdVolume. Returns (points, volumes) with the M x 3 RAS centroids and the
+  volumes of the markers, largest first.
+  """
+  ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+  voxels = thresholdVolume(volume, lower, upper, region, chunkSize)
+  (labels, count) = labelComponents(voxels)
+  voxelVolume = abs(numpy.linalg.det(ijkToRAS[0:3, 0:3]))
+  volumes = numpy.bincount(labels, minlength=count) * voxelVolume
+  centroids = numpy.column_stack([numpy.bincount(labels, voxels[axis], minlength=count) for axis in (2, 1, 0)])
+  centroids /= numpy.maximum(volumes / voxelVolume, 1)[:, numpy.newaxis]
+
+  keep = volumes >= minVolume
+  if maxVolume is not None:
+    keep &= volumes <= maxVolume
+  order = numpy.nonzero(keep)[0][numpy.argsort(-volumes[keep], kind='mergesort')]
+  points = centroids[order].dot(ijkToRAS[0:3, 0:3].T) + ijkToRAS[0:3, 3]
+  return points.reshape(-1, 3), volumes[order]
+
+
+def computeRegion(ijkToRAS, dimensions, points, margin):
+  """Returns the voxel bounds ((i0, j0, k0), (i1, j1, k1)) of the bounding box of RAS points grown by margin mm.
+
+  The bounds are clipped to a grid of the given (I, J, K) dimensions.
+  """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  rasToIJK = numpy.linalg.inv(numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4))
+  (lower, upper) = (points.min(axis=0) - margin, points.max(axis=0) + margin)
+  corners = numpy.array([[x, y, z] for x in (lower[0], upper[0]) for y in (lower[1], upper[1])
+                         for z in (lower[2], upper[2])])
+  ijk = corners.dot(rasToIJK[0:3, 0:3].T) + rasToIJK[0:3, 3]
+  dimensions = numpy.asarray(dimensions, dtype=numpy.intp)
+  start = numpy.clip(numpy.floor(ijk.min(axis=0)).astype(numpy.intp), 0, dimensions)
+  stop = numpy.clip(numpy.ceil(ijk.max(axis=0)).astype(numpy.intp) + 1, 0, dimensions)
+  return tuple(int(value) for value in start), tuple(int(value) for value in stop)
@@ -0,0 +1,228 @@
+import numpy
+
+from Utils.pathsearch import asPathArray, projectOntoPaths, DEFAULT_CHUNK_SIZE
+
+# Upper bound on the number of ray samples evaluated in one broadcast
+DEFAULT_SAMPLE_CHUNK_SIZE = 1 << 20
+
+# Number of next-nearest paths that are checked per round for targets whose nearest paths are blocked
+CANDIDATES_PER_ROUND = 8
+
+# Rounds that select their candidates by partial sorting; targets still blocked after them rank all paths at once
+PARTITION_ROUNDS = 4
+
+
+class ObstacleMap(object):
+  """Detects needle paths that cross critical structures of a label map.
+
+  labels is the (K, J, I) array of the label map, rasToIJK the 4 x 4 matrix from world to voxel coordinates and
+  obstacleLabels the label values that block a path (None blocks every non-zero label). Paths are sampled every
+  step millimeters.
+  """
+
+  def __init__(self, labels, rasToIJK, obstacleLabels=None, step=1.0):
+    self.labels = labels
+    self.rasToIJK = numpy.asarray(rasToIJK, dtype=numpy.float64).reshape(4, 4)
+    self.obstacleLabels = None if obstacleLabels is None else numpy.asarray(list(obstacleLabels))
+    self.step = step
+    self.upper = numpy.array(labels.shape[::-1])
+    self.dilatedMask = None
+
+  def isObstacle(self, values):
+    """Returns whether label values belong to an obstacle."""
+    if self.obstacleLabels is None:
+      return values != 0
+    return numpy.isin(values, self.obstacleLabels)
+
+  def getDilatedMask(self):
+    """Returns the (K, J, I) mask of voxels that are an obstacle or touch one, including diagonally.
+
+    The mask is computed once, one axis at a time.
+    """
+    if self.dilatedMask is None:
+      mask = self.isObstacle(self.labels)
+      for axis in range(3):
+        dilated = mask.copy()
+        (lower, upper) = ([slice(None)] * 3, [slice(None)] * 3)
+        (lower[axis], upper[axis]) = (slice(0, -1), slice(1, None))
+        dilated[tuple(lower)] |= mask[tuple(upper)]
+        dilated[tuple(upper)] |= mask[tuple(lower)]
+        mask = dilated
+      self.dilatedMask = mask
+    return self.dilatedMask
+
+  def isBlocked(self, origins, vectors, depths, chunkSize=DEFAULT_SAMPLE_CHUNK_SIZE):
+    """Returns for every path from origins along vectors to depths whether it crosses an obstacle.
+
+    origins and vectors are N x 3 arrays and depths has length N. All paths are sampled at once in IJK space, each
+    one at evenly spaced points at most step apart that do not depend on the other paths.
+    """
+    origins = asPathArray(origins)
+    vectors = asPathArray(vectors)
+    depths = numpy.maximum(numpy.asarray(depths, dtype=numpy.float64).reshape(-1), 0.0)
+    blocked = numpy.zeros(depths.shape[0], dtype=bool)
+    if depths.size == 0:
+      return blocked
+
+    # Paths in IJK coordinates: start + t * direction with t in [0, 1]
+    starts = origins.dot(self.rasToIJK[0:3, 0:3].T) + self.rasToIJK[0:3, 3]
+    directions = (vectors * depths[:, numpy.newaxis]).dot(self.rasToIJK[0:3, 0:3].T)
+    intervals = numpy.maximum(numpy.ceil(depths / self.step), 1.0)
+    samples = numpy.arange(int(intervals.max()) + 1)
+
+    step = max(1, chunkSize // samples.size)
+    for start in range(0, depths.shape[0], step):
+      stop = min(start + step, depths.shape[0])
+      # Paths with fewer samples repeat their end point
+      t = numpy.minimum(samples[numpy.newaxis, :] / intervals[start:stop, numpy.newaxis], 1.0)
+      ijk = numpy.rint(starts[start:stop, numpy.newaxis, :] +
+                       t[:, :, numpy.newaxis] * directions[start:stop, numpy.newaxis, :]).astype(numpy.intp)
+      inside = numpy.all((ijk >= 0) & (ijk < self.upper), axis=2)
+      ijk[~inside] = 0
+      hit = self.isObstacle(self.labels[ijk[..., 2], ijk[..., 1], ijk[..., 0]])
+      blocked[start:stop] = numpy.any(hit & inside, axis=1)
+    return blocked
+
+  def computeClearDepths(self, origins, vectors, chunkSize=DEFAULT_SAMPLE_CHUNK_SIZE):
+    """Returns for every path the depth below which isBlocked is guaranteed to be False.
+
+    Paths are sampled less than one voxel apart along every axis until they leave the label map, and sampled voxels
+    are looked up in the dilated obstacle mask: every voxel isBlocked may sample between two such samples is a
+    neighbor of the voxel of the first. The depth is infinite for paths that never come near an obstacle.
+    """
+    origins = asPathArray(origins)
+    vectors = asPathArray(vectors)
+    clearDepths = numpy.full(origins.shape[0], numpy.inf)
+    if origins.shape[0] == 0:
+      return clearDepths
+    mask = self.getDilatedMask()
+
+    starts = origins.dot(self.rasToIJK[0:3, 0:3].T) + self.rasToIJK[0:3, 3]
+    directions = vectors.dot(self.rasToIJK[0:3, 0:3].T)
+    spacing = 0.5 / numpy.abs(directions).max()
+    # Depth at which each path leaves the map for good: past it every sample rounds to a voxel outside of the map
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      exits = numpy.where(directions > 0, (self.upper - starts) / directions,
+                          numpy.where(directions < 0, (-1.0 - starts) / directions, numpy.inf))
+    counts = numpy.ceil(numpy.maximum(exits.min(axis=1), 0.0) / spacing).astype(numpy.intp) + 1
+    t = spacing * numpy.arange(counts.max())
+
+    step = max(1, chunkSize // t.size)
+    for start in range(0, origins.shape[0], step):
+      stop = min(start + step, origins.shape[0])
+      ijk = numpy.rint(starts[start:stop, numpy.newaxis, :] +
+                       t[numpy.newaxis, :, numpy.newaxis] * directions[start:stop, numpy.newaxis, :]).astype(numpy.intp)
+      # Samples just outside of the map may still round to their neighbors inside of it
+      near = numpy.all((ijk >= -1) & (ijk <= self.upper), axis=2)
+      near &= numpy.arange(t.size) < counts[start:stop, numpy.newaxis]
+      ijk = numpy.clip(ijk, 0, self.upper - 1)
+      hit = mask[ijk[..., 2], ijk[..., 1], ijk[..., 0]] & near
+      found = numpy.any(hit, axis=1)
+      clearDepths[start + numpy.nonzero(found)[0]] = t[numpy.argmax(hit[found], axis=1)]
+    return clearDepths
+
+
+def computeNearestClearPaths(origins, vectors, maxDepths, targets, obstacleMap, chunkSize=DEFAULT_CHUNK_SIZE):
+  """Identifies the nearest needle path of every target whose way from the path origin to the target depth is clear.
+
+  Candidates are checked in order of increasing distance, CANDIDATES_PER_ROUND at a time for all remaining targets
+  at once. The first PARTITION_ROUNDS rounds only partially sort the distances of the remaining targets. Returns
+  (indices, depths, inRange, blocked) like computeNearestPaths; targets without any clear path get their nearest
+  path with blocked set to True.
+  """
+  origins = asPathArray(origins)
+  vectors = asPathArray(vectors)
+  maxDepths = numpy.asarray(maxDepths, dtype=numpy.float64).reshape(-1)
+  targets = asPathArray(targets)
+  nTargets = targets.shape[0]
+  nPaths = origins.shape[0]
+  indices = numpy.full(nTargets, -1, dtype=numpy.intp)
+  depths = numpy.zeros(nTargets, dtype=numpy.float64)
+  blocked = numpy.zeros(nTargets, dtype=bool)
+  if nTargets == 0 or nPaths == 0:
+    return indices, depths, numpy.zeros(nTargets, dtype=bool), blocked
+
+  step = max(1, chunkSize // nPaths)
+  for start in range(0, nTargets, step):
+    stop = min(start + step, nTargets)
+    aproj, mag2 = projectOntoPaths(targets[start:stop, numpy.newaxis, :] - origins[numpy.newaxis, :, :], vectors)
+    rows = numpy.arange(stop - start)
+    nearest = numpy.argmin(mag2, axis=1)
+    indices[start:stop] = nearest
+    depths[start:stop] = aproj[rows, nearest]
+    blocked[start:stop] = True
+
+    pending = rows
+    order = None
+    for (iteration, first) in enumerate(range(0, nPaths, CANDIDATES_PER_ROUND)):
+      if pending.size == 0:
+        break
+      if iteration < PARTITION_ROUNDS:
+        candidates = selectRankedPaths(mag2[pending], first, CANDIDATES_PER_ROUND)
+      else:
+        if order is None:
+          # Stable sort so that equally distant paths are tried in index order, as in the nearest path search
+          order = numpy.zeros(mag2.shape, dtype=numpy.intp)
+          order[pending] = numpy.argsort(mag2[pending], axis=1, kind='mergesort')
+        candidates = order[pending, first:first + CANDIDATES_PER_ROUND]
+      candidateDepths = aproj[pending[:, numpy.newaxis], candidates]
+      candidateBlocked = obstacleMap.isBlocked(origins[candidates.ravel()], vectors[candidates.ravel()],
+                                               candidateDepths.ravel()).reshape(candidates.shape)
+      clear = ~candidateBlocked
+      found = numpy.any(clear, axis=1)
+      column = numpy.argmax(clear, axis=1)[found]
+      resolved = pending[found]
+      indices[start + resolved] = candidates[found, column]
+      depths[start + resolved] = candidateDepths[found, column]
+      blocked[start + resolved] = False
+      pending = pending[~found]
+
+  inRange = (depths > 0) & (depths < maxDepths[indices])
+  return indices, depths, inRange, blocked
+
+
+def resolveBlockedPaths(origins, vectors, maxDepths, targets, indices, depths, obstacleMap, clearDepths=None):
+  """Turns the result of the nearest path search into that of computeNearestClearPaths.
+
+  indices and depths are the nearest paths of the targets as returned by computeNearestPaths. Only the nearest path
+  of every target is checked for obstacles, and only targets where it is blocked are searched again with
+  computeNearestClearPaths. clearDepths (see ObstacleMap.computeClearDepths) skips the check for targets closer to
+  the path origin than the first obstacle. Returns (indices, depths, inRange, blocked).
+  """
+  maxDepths = numpy.asarray(maxDepths, dtype=numpy.float64).reshape(-1)
+  targets = asPathArray(targets)
+  indices = numpy.array(indices, dtype=numpy.intp)
+  depths = numpy.array(depths, dtype=numpy.float64)
+  blocked = numpy.zeros(indices.shape, dtype=bool)
+  found = numpy.nonzero(indices >= 0)[0]
+  checked = found
+  if clearDepths is not None:
+    checked = checked[numpy.maximum(depths[checked], 0.0) >= clearDepths[indices[checked]]]
+  paths = indices[checked]
+  rows = checked[obstacleMap.isBlocked(asPathArray(origins)[paths], asPathArray(vectors)[paths], depths[checked])]
+  if rows.size:
+    clear = computeNearestClearPaths(origins, vectors, maxDepths, targets[rows], obstacleMap)
+    (indices[rows], depths[rows], blocked[rows]) = (clear[0], clear[1], clear[3])
+  inRange = numpy.zeros(indices.shape, dtype=bool)
+  inRange[found] = (depths[found] > 0) & (depths[found] < maxDepths[indices[found]])
+  return indices, depths, inRange, blocked
+
+
+def selectRankedPaths(mag2, first, count):
+  """Returns the paths ranked first .. first + count - 1 by distance for every row of squared distances mag2.
+
+  Equally distant paths rank in index order like in a stable sort. Only the nearest first + count paths are selected
+  by partial sorting and then sorted; rows where the last of them is tied with paths left out are sorted in full.
+  """
+  nPaths = mag2.shape[1]
+  stop = min(first + count, nPaths)
+  if stop == nPaths:
+    return numpy.argsort(mag2, axis=1, kind='mergesort')[:, first:stop]
+  selected = numpy.argpartition(mag2, stop - 1, axis=1)[:, 0:stop]
+  rows = numpy.arange(mag2.shape[0])[:, numpy.newaxis]
+  selectedMag2 = mag2[rows, selected]
+  ranked = selected[rows, numpy.lexsort((selected, selectedMag2), axis=1)[:, first:stop]]
+  tied = numpy.sum(mag2 <= selectedMag2.max(axis=1)[:, numpy.newaxis], axis=1) > stop
+  if numpy.any(tied):
+    ranked[tied] = numpy.argsort(mag2[tied], axis=1, kind='mergesort')[:, first:stop]
+  return ranked
@@ -0,0 +1,376 @@
+import numpy
+
+# Upper bound on the number of target x hole pairs evaluated in one broadcast. Keeps the temporary
+# N x H x 3 arrays at a few tens of MB regardless of the number of targets or holes.
+DEFAULT_CHUNK_SIZE = 1 << 18
+
+# Templates with fewer holes than this are searched by brute force unless they form a regular grid
+TREE_INDEX_MIN_HOLES = 256
+
+
+def asPathArray(values, columns=3):
+  """Returns values as a contiguous float64 array with shape (n, columns)."""
+  array = numpy.ascontiguousarray(values, dtype=numpy.float64)
+  return array.reshape(-1, columns)
+
+
+def projectOntoPaths(op, vectors):
+  """Returns the projection of op onto vectors and the squared perpendicular distance.
+
+  op holds target - origin differences with shape (..., 3) and vectors broadcasts against it. The components are
+  combined explicitly so that a given target/hole pair yields bitwise identical results however it is batched.
+  """
+  aproj = op[..., 0] * vectors[..., 0] + op[..., 1] * vectors[..., 1] + op[..., 2] * vectors[..., 2]
+  perp = op - aproj[..., numpy.newaxis] * vectors
+  mag2 = perp[..., 0] * perp[..., 0] + perp[..., 1] * perp[..., 1] + perp[..., 2] * perp[..., 2]
+  return aproj, mag2
+
+
+def computeNearestPaths(origins, vectors, maxDepths, targets, chunkSize=DEFAULT_CHUNK_SIZE):
+  """Identifies the nearest needle path for every target.
+
+  origins and vectors are H x 3 arrays describing the needle paths, maxDepths holds the maximum insertion depth
+  of each path and targets is an N x 3 array of positions. Returns (indices, depths, inRange) as arrays of length N.
+  indices is -1 and inRange is False for all targets if the template has no holes. Ties are resolved in favor of
+  the lowest hole index.
+  """
+  origins = asPathArray(origins)
+  vectors = asPathArray(vectors)
+  maxDepths = numpy.asarray(maxDepths, dtype=numpy.float64).reshape(-1)
+  targets = asPathArray(targets)
+
+  nTargets = targets.shape[0]
+  nHoles = origins.shape[0]
+  indices = numpy.full(nTargets, -1, dtype=numpy.intp)
+  depths = numpy.zeros(nTargets, dtype=numpy.float64)
+  inRange = numpy.zeros(nTargets, dtype=bool)
+  if nTargets == 0 or nHoles == 0:
+    return indices, depths, inRange
+
+  step = max(1, chunkSize // nHoles)
+  for start in range(0, nTargets, step):
+    stop = min(start + step, nTargets)
+    op = targets[start:stop, numpy.newaxis, :] - origins[numpy.newaxis, :, :]
+    aproj, mag2 = projectOntoPaths(op, vectors)
+    nearest = numpy.argmin(mag2, axis=1)
+    indices[start:stop] = nearest
+    depths[start:stop] = aproj[numpy.arange(stop - start), nearest]
+
+  inRange[:] = (depths > 0) & (depths < maxDepths[indices])
+  return indices, depths, inRange
+
+
+def computeCandidatePaths(origins, vectors, maxDepths, targets, count, chunkSize=DEFAULT_CHUNK_SIZE):
+  """Identifies the count nearest needle paths for every target, best first.
+
+  Returns (indices, depths, inRange, distances) as N x count arrays. Candidates are ranked by perpendicular
+  distance, then paths reaching the target within their maximum depth before those that do not, then by path index.
+  Only the count nearest paths of each target are selected with a partial sort, so the cost grows linearly with the
+  number of paths. Columns beyond the number of paths have index -1.
+  """
+  origins = asPathArray(origins)
+  vectors = asPathArray(vectors)
+  maxDepths = numpy.asarray(maxDepths, dtype=numpy.float64).reshape(-1)
+  targets = asPathArray(targets)
+
+  nTargets = targets.shape[0]
+  nHoles = origins.shape[0]
+  indices = numpy.full((nTargets, count), -1, dtype=numpy.intp)
+  depths = numpy.zeros((nTargets, count), dtype=numpy.float64)
+  inRange = numpy.zeros((nTargets, count), dtype=bool)
+  distances = numpy.full((nTargets, count), numpy.inf)
+  nCandidates = min(count, nHoles)
+  if nTargets == 0 or nCandidates == 0:
+    return indices, depths, inRange, distances
+
+  step = max(1, chunkSize // nHoles)
+  for start in range(0, nTargets, step):
+    stop = min(start + step, nTargets)
+    op = targets[start:stop, numpy.newaxis, :] - origins[numpy.newaxis, :, :]
+    aproj, mag2 = projectOntoPaths(op, vectors)
+    rows = numpy.arange(stop - start)
+    if nCandidates == nHoles:
+      selected = numpy.tile(numpy.arange(nHoles), (rows.size, 1))
+    else:
+      selected = numpy.argpartition(mag2, nCandidates - 1, axis=1)[:, 0:nCandidates]
+      # Targets with paths tied to their count-th nearest one rank all paths, so the secondary criteria decide
+      bound = mag2[rows[:, numpy.newaxis], selected].max(axis=1)
+      tied = numpy.sum(mag2 <= bound[:, numpy.newaxis], axis=1) > nCandidates
+      rows = rows[~tied]
+      selected = selected[~tied]
+      tiedRows = numpy.nonzero(tied)[0]
+      if tiedRows.size:
+        _rankCandidates(aproj[tiedRows], mag2[tiedRows], numpy.tile(numpy.arange(nHoles), (tiedRows.size, 1)),
+                        maxDepths, start + tiedRows, indices, depths, inRange, distances)
+    if rows.size:
+      _rankCandidates(aproj[rows], mag2[rows], selected, maxDepths, start + rows, indices, depths, inRange, distances)
+  return indices, depths, inRange, distances
+
+
+def _rankCandidates(aproj, mag2, selected, maxDepths, targetRows, indices, depths, inRange, distances):
+  # Sorts the selected paths of every row and writes the best ones to targetRows of the result arrays
+  rows = numpy.arange(selected.shape[0])[:, numpy.newaxis]
+  candidateMag2 = mag2[rows, selected]
+  candidateDepths = aproj[rows, selected]
+  candidateInRange = (candidateDepths > 0) & (candidateDepths < maxDepths[selected])
+  order = numpy.lexsort((selected, ~candidateInRange, candidateMag2), axis=1)[:, 0:indices.shape[1]]
+  n = order.shape[1]
+  indices[targetRows, 0:n] = selected[rows, order]
+  depths[targetRows, 0:n] = candidateDepths[rows, order]
+  inRange[targetRows, 0:n] = candidateInRange[rows, order]
+  distances[targetRows, 0:n] = numpy.sqrt(candidateMag2[rows, order])
+
+
+def buildPathIndex(origins, vectors, maxDepths):
+  """Builds a spatial index answering nearest needle path queries for the given paths.
+
+  Returns a GridPathIndex if all paths are parallel and pierce a complete rectangular lattice, a TreePathIndex for
+  other templates with unit direction vectors and at least TREE_INDEX_MIN_HOLES holes, and None if brute force
+  search with computeNearestPaths is the better choice.
+  """
+  origins = asPathArray(origins)
+  vectors = asPathArray(vectors)
+  maxDepths = numpy.asarray(maxDepths, dtype=numpy.float64).reshape(-1)
+  if origins.shape[0] < 2:
+    return None
+  if numpy.abs(numpy.sqrt(numpy.sum(vectors * vectors, axis=1)) - 1.0).max() > 1e-6:
+    return None
+  index = GridPathIndex.fromPaths(origins, vectors, maxDepths)
+  if index is None and origins.shape[0] >= TREE_INDEX_MIN_HOLES:
+    index = TreePathIndex.fromPaths(origins, vectors, maxDepths)
+  return index
+
+
+class PathIndex(object):
+  """Base class of the nearest needle path indices.
+
+  Subclasses only select candidate holes for each target with getCandidates(targets), which returns an N x C array
+  of hole indices containing the nearest hole of every target (entries of -1 are ignored). The candidates are then
+  evaluated with the same arithmetic as computeNearestPaths so that both return identical results.
+  """
+
+  CHUNK_SIZE = 4096
+
+  def __init__(self, origins, vectors, maxDepths):
+    self.origins = origins
+    self.vectors = vectors
+    self.maxDepths = maxDepths
+
+  def computeNearestPaths(self, targets):
+    targets = asPathArray(targets)
+    indices = numpy.full(targets.shape[0], -1, dtype=numpy.intp)
+    depths = numpy.zeros(targets.shape[0], dtype=numpy.float64)
+    for start in range(0, targets.shape[0], self.CHUNK_SIZE):
+      stop = min(start + self.CHUNK_SIZE, targets.shape[0])
+      candidates = self.getCandidates(targets[start:stop])
+      self._selectNearest(targets[start:stop], candidates, indices[start:stop], depths[start:stop])
+    inRange = (indices >= 0) & (depths > 0) & (depths < self.maxDepths[indices])
+    return indices, depths, inRange
+
+  def _selectNearest(self, targets, candidates, indices, depths):
+    valid = candidates >= 0
+    safe = numpy.where(valid, candidates, 0)
+    op = targets[:, numpy.newaxis, :] - self.origins[safe]
+    aproj, mag2 = projectOntoPaths(op, self.vectors[safe])
+    mag2 = numpy.where(valid, mag2, numpy.inf)
+    minMag2 = mag2.min(axis=1)
+    # Among equally distant candidates the lowest hole index wins, as in the brute force search
+    tied = valid & (mag2 == minMag2[:, numpy.newaxis])
+    indices[:] = numpy.where(tied, candidates, numpy.iinfo(numpy.intp).max).min(axis=1)
+    column = numpy.argmax(tied & (candidates == indices[:, numpy.newaxis]), axis=1)
+    depths[:] = aproj[numpy.arange(targets.shape[0]), column]
+
+
+class GridPathIndex(PathIndex):
+  """O(1) lookup for templates whose parallel paths pierce a complete rectangular grid of holes."""
+
+  NEIGHBORHOOD = numpy.array([(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)])
+
+  def __init__(self, origins, vectors, maxDepths, base, axes, spacing, cells):
+    PathIndex.__init__(self, origins, vectors, maxDepths)
+    self.base = base
+    self.axes = axes
+    self.spacing = spacing
+    self.cells = cells
+
+  @classmethod
+  def fromPaths(cls, origins, vectors, maxDepths, tolerance=1e-6):
+    direction = vectors[0]
+    if numpy.abs(vectors - direction).max() > 1e-9:
+      return None
+
+    # Template-local in-plane coordinates: first axis towards the nearest neighbor of the first hole
+    offsets = origins - origins[0]
+    offsets -= numpy.outer(offsets.dot(direction), direction)
+    distances = numpy.sqrt(numpy.sum(offsets * offsets, axis=1))
+    distances[0] = numpy.inf
+    neighbor = numpy.argmin(distances)
+    if not distances[neighbor] > 0 or not numpy.isfinite(distances[neighbor]):
+      return None
+    axis0 = offsets[neighbor] / distances[neighbor]
+    axis1 = numpy.cross(direction, axis0)
+    axes = numpy.array([axis0, axis1])
+    local = offsets.dot(axes.T)
+
+    spacing = numpy.empty(2)
+    for k in range(2):
+      values = numpy.sort(local[:, k])
+      gaps = numpy.diff(values)
+      gaps = gaps[gaps > tolerance * distances[neighbor]]
+      spacing[k] = gaps.min() if gaps.size else distances[neighbor]
+
+    lattice = numpy.rint(local / spacing)
+    if numpy.abs(local - lattice * spacing).max() > tolerance * spacing.min():
+      return None
+    lattice = (lattice - lattice.min(axis=0)).astype(numpy.intp)
+    shape = tuple(lattice.max(axis=0) + 1)
+    if shape[0] * shape[1] != origins.shape[0]:
+      return None
+    cells = numpy.full(shape, -1, dtype=numpy.intp)
+    cells[lattice[:, 0], lattice[:, 1]] = numpy.arange(origins.shape[0])
+    if (cells < 0).any():
+      return None
+
+    base = origins[0] - (lattice[0] * spacing).dot(axes)
+    return cls(origins, vectors, maxDepths, base, axes, spacing, cells)
+
+  def getCandidates(self, targets):
+    local = (targets - self.base).dot(self.axes.T) / self.spacing
+    upper = numpy.array(self.cells.shape) - 1
+    nearest = numpy.clip(numpy.rint(local), 0, upper).astype(numpy.intp)
+    neighbors = numpy.clip(nearest[:, numpy.newaxis, :] + self.NEIGHBORHOOD, 0, upper)
+    return self.cells[neighbors[:, :, 0], neighbors[:, :, 1]]
+
+
+class TreePathIndex(PathIndex):
+  """KD-tree lookup for templates with non-parallel paths.
+
+  Every path is represented by the point where it crosses a reference plane perpendicular to the mean direction.
+  A target at height h above that plane is compared against the crossing points shifted by the mean drift of the
+  paths, which bounds the true distance from below and above by the spread of the path directions. The paths in the
+  leaf containing the target give an upper bound on the distance, and a ball query then collects every path that may
+  be closer.
+  """
+
+  def __init__(self, origins, vectors, maxDepths, center, normal, crossings, drift, spread, minCosine):
+    PathIndex.__init__(self, origins, vectors, maxDepths)
+    self.center = center
+    self.normal = normal
+    self.drift = drift
+    self.spread = spread
+    self.minCosine = minCosine
+    self.tree = KDTree(crossings)
+
+  @classmethod
+  def fromPaths(cls, origins, vectors, maxDepths):
+    normal = vectors.sum(axis=0)
+    length = numpy.sqrt(normal.dot(normal))
+    if not length > 0:
+      return None
+    normal /= length
+    cosines = vectors.dot(normal)
+    minCosine = cosines.min()
+    if minCosine < 0.1:
+      return None
+    center = origins.mean(axis=0)
+    crossings = origins - ((origins - center).dot(normal) / cosines)[:, numpy.newaxis] * vectors
+    slopes = vectors / cosines[:, numpy.newaxis] - normal
+    drift = slopes.mean(axis=0)
+    spread = numpy.sqrt(numpy.sum((slopes - drift) ** 2, axis=1)).max()
+    return cls(origins, vectors, maxDepths, center, normal, crossings, drift, spread, minCosine)
+
+  def getCandidates(self, targets):
+    heights = (targets - self.center).dot(self.normal)
+    shifted = targets - numpy.outer(heights, self.normal + self.drift)
+
+    # Any path in the leaf containing the shifted target bounds the distance to the nearest path from above
+    leaves = self.tree.findLeaves(shifted)
+    leafHoles = self.tree.getLeafMembers(leaves)
+    valid = leafHoles >= 0
+    safe = numpy.where(valid, leafHoles, 0)
+    mag2 = projectOntoPaths(targets[:, numpy.newaxis, :] - self.origins[safe], self.vectors[safe])[1]
+    bound = numpy.sqrt(numpy.where(valid, mag2, numpy.inf).min(axis=1))
+
+    radii = (bound / self.minCosine + numpy.abs(heights) * self.spread) * (1.0 + 1e-9) + 1e-9
+    return self.tree.queryBall(shifted, radii)
+
+
+class KDTree(object):
+  """Array based KD-tree answering fixed radius queries for many query points at once."""
+
+  LEAF_SIZE = 16
+
+  def __init__(self, points):
+    self.points = asPathArray(points)
+    self.order = numpy.arange(self.points.shape[0])
+    nodes = []
+    self._build(nodes, 0, self.points.shape[0])
+    (self.lower, self.upper, self.start, self.stop, self.children, self.splitAxis, self.splitValue) = \
+      [numpy.array(column) for column in zip(*nodes)]
+
+  def _build(self, nodes, start, stop):
+    nodeID = len(nodes)
+    points = self.points[self.order[start:stop]]
+    nodes.append([points.min(axis=0), points.max(axis=0), start, stop, (-1, -1), 0, 0.0])
+    if stop - start <= self.LEAF_SIZE:
+      return nodeID
+    axis = numpy.argmax(nodes[nodeID][1] - nodes[nodeID][0])
+    self.order[start:stop] = self.order[start:stop][numpy.argsort(points[:, axis], kind='mergesort')]
+    half = start + (stop - start) // 2
+    nodes[nodeID][5] = axis
+    nodes[nodeID][6] = self.points[self.order[half], axis]
+    nodes[nodeID][4] = (self._build(nodes, start, half), self._build(nodes, half, stop))
+    return nodeID
+
+  def findLeaves(self, points):
+    """Returns the leaf node a descent from the root ends in for every point."""
+    nodes = numpy.zeros(points.shape[0], dtype=numpy.intp)
+    inner = numpy.nonzero(self.children[nodes, 0] >= 0)[0]
+    while inner.size:
+      node = nodes[inner]
+      right = points[inner, self.splitAxis[node]] >= self.splitValue[node]
+      nodes[inner] = self.children[node, right.astype(numpy.intp)]
+      inner = inner[self.children[nodes[inner], 0] >= 0]
+    return nodes
+
+  def getLeafMembers(self, leaves):
+    """Returns the point indices of the given leaves as rows padded with -1."""
+    offsets = numpy.arange(self.LEAF_SIZE)
+    positions = self.start[leaves, numpy.newaxis] + offsets
+    valid = positions < self.stop[leaves, numpy.newaxis]
+    return numpy.where(valid, self.order[numpy.minimum(positions, self.order.size - 1)], -1)
+
+  def queryBall(self, points, radii):
+    """Returns the indices of all points within radii of the query points as rows padded with -1."""
+    radii2 = radii * radii
+    queries = numpy.arange(points.shape[0])
+    nodes = numpy.zeros(points.shape[0], dtype=numpy.intp)
+    leafQueries = []
+    leafNodes = []
+    while queries.size:
+      gap = numpy.maximum(numpy.maximum(self.lower[nodes] - points[queries], points[queries] - self.upper[nodes]), 0.0)
+      hit = numpy.sum(gap * gap, axis=1) <= radii2[queries]
+      queries, nodes = queries[hit], nodes[hit]
+      leaf = self.children[nodes, 0] < 0
+      leafQueries.append(queries[leaf])
+      leafNodes.append(nodes[leaf])
+      queries = numpy.repeat(queries[~leaf], 2)
+      nodes = self.children[nodes[~leaf]].reshape(-1)
+
+    queries = numpy.concatenate(leafQueries)
+    members = self.getLeafMembers(numpy.concatenate(leafNodes))
+    queries = numpy.repeat(queries, self.LEAF_SIZE)
+    members = members.reshape(-1)
+    keep = members >= 0
+    queries, members = queries[keep], members[keep]
+    diff = self.points[members] - points[queries]
+    keep = numpy.sum(diff * diff, axis=1) <= radii2[queries]
+    queries, members = queries[keep], members[keep]
+
+    order = numpy.lexsort((members, queries))
+    queries, members = queries[order], members[order]
+    counts = numpy.bincount(queries, minlength=points.shape[0])
+    result = numpy.full((points.shape[0], max(1, counts.max())), -1, dtype=numpy.intp)
+    columns = numpy.arange(queries.size) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    result[queries, columns] = members
+    return result
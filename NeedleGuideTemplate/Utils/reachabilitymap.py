@@ -0,0 +1,68 @@
+import numpy
+
+# Number of voxels whose RAS coordinates are generated and searched at once
+DEFAULT_CHUNK_SIZE = 1 << 18
+
+
+class ReachabilityMap(object):
+  """Nearest hole, insertion depth and in-range flag for every voxel of an image grid.
+
+  The arrays have the shape (K, J, I) of the grid as stored by vtkImageData. holes is -1 where no template is loaded.
+  Once computed, lookup() answers nearest path queries for arbitrary positions with a single array access.
+  """
+
+  def __init__(self, ijkToRAS, holes, depths, inRange):
+    self.ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+    self.rasToIJK = numpy.linalg.inv(self.ijkToRAS)
+    self.holes = holes
+    self.depths = depths
+    self.inRange = inRange
+
+  @property
+  def dimensions(self):
+    return self.holes.shape[::-1]
+
+  @classmethod
+  def compute(cls, ijkToRAS, dimensions, search, chunkSize=DEFAULT_CHUNK_SIZE, progress=None):
+    """Evaluates search for the RAS position of every voxel of a grid with the given (I, J, K) dimensions.
+
+    search takes an N x 3 array of positions and returns (indices, depths, inRange) like
+    NeedleGuideTemplateLogic.computeNearestPaths. The three output arrays are allocated once and filled one chunk
+    of chunkSize voxels at a time, so the temporary memory does not depend on the grid size. progress is called with
+    the completed fraction after every chunk.
+    """
+    ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+    (nI, nJ, nK) = [int(n) for n in dimensions]
+    nVoxels = nI * nJ * nK
+    holes = numpy.empty(nVoxels, dtype=numpy.int32)
+    depths = numpy.empty(nVoxels, dtype=numpy.float32)
+    inRange = numpy.empty(nVoxels, dtype=numpy.uint8)
+
+    for start in range(0, nVoxels, chunkSize):
+      stop = min(start + chunkSize, nVoxels)
+      voxels = numpy.arange(start, stop)
+      (k, rest) = (voxels // (nI * nJ), voxels % (nI * nJ))
+      (j, i) = (rest // nI, rest % nI)
+      positions = (numpy.outer(i, ijkToRAS[0:3, 0]) + numpy.outer(j, ijkToRAS[0:3, 1]) +
+                   numpy.outer(k, ijkToRAS[0:3, 2]) + ijkToRAS[0:3, 3])
+      (holes[start:stop], depths[start:stop], inRange[start:stop]) = search(positions)
+      if progress is not None:
+        progress(float(stop) / nVoxels)
+
+    shape = (nK, nJ, nI)
+    return cls(ijkToRAS, holes.reshape(shape), depths.reshape(shape), inRange.reshape(shape))
+
+  def lookup(self, positions):
+    """Returns (indices, depths, inRange, inside) of the voxels nearest to an N x 3 array of RAS positions.
+
+    inside is False for positions outside of the grid; their indices are -1 and inRange is False.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    ijk = numpy.rint(positions.dot(self.rasToIJK[0:3, 0:3].T) + self.rasToIJK[0:3, 3]).astype(numpy.intp)
+    inside = numpy.all((ijk >= 0) & (ijk < self.dimensions), axis=1)
+    ijk[~inside] = 0
+    (i, j, k) = (ijk[:, 0], ijk[:, 1], ijk[:, 2])
+    indices = numpy.where(inside, self.holes[k, j, i], -1)
+    depths = numpy.where(inside, self.depths[k, j, i], 0.0)
+    inRange = inside & (self.inRange[k, j, i] > 0)
+    return indices, depths, inRange, inside
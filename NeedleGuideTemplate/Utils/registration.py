@@ -0,0 +1,102 @@
+import numpy
+
+from Utils.pathsearch import asPathArray, KDTree
+
+# Iterative closest point stops after this many iterations or once the RMS error changes by less than the tolerance
+ICP_MAX_ITERATIONS = 50
+ICP_TOLERANCE = 1e-6
+
+
+def registerCorrespondingPoints(source, target):
+  """Returns the 4 x 4 rigid transform that maps source points onto corresponding target points.
+
+  Closed-form least squares solution (Arun/Umeyama): the rotation comes from the SVD of the cross-covariance of the
+  centered point sets, with the sign of the last singular vector flipped if necessary so that it is no reflection.
+  At least three non-collinear pairs are needed for a unique solution.
+  """
+  source = asPathArray(source)
+  target = asPathArray(target)
+  if source.shape != target.shape or source.shape[0] == 0:
+    raise ValueError('registration needs the same non-zero number of source and target points')
+  sourceCenter = source.mean(axis=0)
+  targetCenter = target.mean(axis=0)
+  covariance = (source - sourceCenter).T.dot(target - targetCenter)
+  (u, singularValues, vt) = numpy.linalg.svd(covariance)
+  correction = numpy.identity(3)
+  correction[2, 2] = numpy.sign(numpy.linalg.det(vt.T.dot(u.T))) or 1.0
+  rotation = vt.T.dot(correction).dot(u.T)
+  matrix = numpy.identity(4)
+  matrix[0:3, 0:3] = rotation
+  matrix[0:3, 3] = targetCenter - rotation.dot(sourceCenter)
+  return matrix
+
+
+def computeRegistrationError(source, target, matrix):
+  """Returns the RMS distance in mm between the transformed source points and their target points."""
+  source = asPathArray(source)
+  target = asPathArray(target)
+  matrix = numpy.asarray(matrix, dtype=numpy.float64).reshape(4, 4)
+  residuals = source.dot(matrix[0:3, 0:3].T) + matrix[0:3, 3] - target
+  return float(numpy.sqrt(numpy.mean(numpy.sum(residuals * residuals, axis=1)))) if len(source) else 0.0
+
+
+def findNearestPoints(tree, points):
+  """Returns the index and distance of the nearest tree point of every query point.
+
+  The members of the leaf containing a query point bound the distance to its nearest neighbor from above; a ball
+  query with that bound then collects every point that may be closer.
+  """
+  leafMembers = tree.getLeafMembers(tree.findLeaves(points))
+  valid = leafMembers >= 0
+  safe = numpy.where(valid, leafMembers, 0)
+  distances2 = numpy.sum((tree.points[safe] - points[:, numpy.newaxis, :]) ** 2, axis=2)
+  bound = numpy.sqrt(numpy.where(valid, distances2, numpy.inf).min(axis=1))
+
+  candidates = tree.queryBall(points, bound * (1.0 + 1e-9) + 1e-9)
+  valid = candidates >= 0
+  safe = numpy.where(valid, candidates, 0)
+  distances2 = numpy.where(valid, numpy.sum((tree.points[safe] - points[:, numpy.newaxis, :]) ** 2, axis=2),
+                           numpy.inf)
+  column = numpy.argmin(distances2, axis=1)
+  rows = numpy.arange(points.shape[0])
+  return safe[rows, column], numpy.sqrt(distances2[rows, column])
+
+
+def registerPointSets(source, target, initial=None, maxDistance=None, maxIterations=ICP_MAX_ITERATIONS,
+                      tolerance=ICP_TOLERANCE):
+  """Registers source points to target points without known correspondences by iterative closest point.
+
+  Every iteration pairs each transformed source point with its nearest target point, found in a KD-tree over the
+  target points that is built once, and solves for the rigid transform with registerCorrespondingPoints. Pairs
+  further apart than maxDistance are ignored, so spurious target points do not pull the solution. initial is the
+  starting transform (a translation between the centroids if None). Returns (matrix, rmsError, iterations). Raises
+  ValueError if fewer than three source points have a target point within maxDistance at the start.
+  """
+  source = asPathArray(source)
+  target = asPathArray(target)
+  if source.shape[0] == 0 or target.shape[0] == 0:
+    raise ValueError('registration needs source and target points')
+  if initial is None:
+    matrix = numpy.identity(4)
+    matrix[0:3, 3] = target.mean(axis=0) - source.mean(axis=0)
+  else:
+    matrix = numpy.array(initial, dtype=numpy.float64).reshape(4, 4)
+
+  tree = KDTree(target)
+  previousError = numpy.inf
+  error = numpy.inf
+  iterations = 0
+  for iterations in range(1, maxIterations + 1):
+    moved = source.dot(matrix[0:3, 0:3].T) + matrix[0:3, 3]
+    (nearest, distances) = findNearestPoints(tree, moved)
+    used = distances <= maxDistance if maxDistance is not None else numpy.ones(len(distances), dtype=bool)
+    if numpy.count_nonzero(used) < 3:
+      if iterations == 1:
+        raise ValueError('fewer than 3 point pairs are within the maximum distance')
+      break
+    matrix = registerCorrespondingPoints(source[used], target[nearest[used]])
+    error = computeRegistrationError(source[used], target[nearest[used]], matrix)
+    if abs(previousError - error) < tolerance:
+      break
+    previousError = error
+  return matrix, error, iterations
@@ -0,0 +1,55 @@
+import time
+import qt
+
+
+class RecomputeScheduler(object):
+  """Collapses bursts of requests into calls of callback at no more than maxRate per second.
+
+  schedule() can be called from observer callbacks as often as events arrive. The callback runs from the Qt event
+  loop once the minimum interval since its previous run has elapsed. Requests that arrive while the callback is
+  pending are merged into that call, and requests that arrive while it runs schedule another call, so the final
+  state is always processed.
+  """
+
+  DEFAULT_MAX_RATE = 30.0
+
+  def __init__(self, callback, maxRate=DEFAULT_MAX_RATE):
+    self.callback = callback
+    self.maxRate = maxRate
+    self.lastRun = None
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.onTimeout)
+
+  @property
+  def pending(self):
+    return self.timer.isActive()
+
+  @property
+  def interval(self):
+    # Minimum time between two calls in seconds; 0 runs the callback on the next pass of the event loop
+    return 1.0 / self.maxRate if self.maxRate and self.maxRate > 0 else 0.0
+
+  def setMaximumRate(self, maxRate):
+    self.maxRate = maxRate
+
+  def schedule(self):
+    if self.pending:
+      return
+    delay = 0.0
+    if self.lastRun is not None:
+      delay = max(0.0, self.interval - (time.time() - self.lastRun))
+    self.timer.start(int(round(delay * 1000)))
+
+  def flush(self):
+    """Runs a pending call immediately."""
+    if self.pending:
+      self.timer.stop()
+      self.onTimeout()
+
+  def cancel(self):
+    self.timer.stop()
+
+  def onTimeout(self):
+    self.lastRun = time.time()
+    self.callback()
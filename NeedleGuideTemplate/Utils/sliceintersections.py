@@ -0,0 +1,23 @@
+import numpy
+
+
+def intersectSegmentsWithPlane(starts, ends, sliceToRAS):
+  """Intersects line segments with the plane of a slice view.
+
+  starts and ends are N x 3 arrays of segment end points and sliceToRAS is the 4 x 4 matrix of the slice node, whose
+  third column is the plane normal and fourth column a point on the plane. Returns (indices, points) with the indices
+  of the segments crossing the plane and the M x 3 crossing points. Segments lying within the plane are skipped.
+  """
+  starts = numpy.asarray(starts, dtype=numpy.float64).reshape(-1, 3)
+  ends = numpy.asarray(ends, dtype=numpy.float64).reshape(-1, 3)
+  sliceToRAS = numpy.asarray(sliceToRAS, dtype=numpy.float64).reshape(4, 4)
+  normal = sliceToRAS[0:3, 2]
+  origin = sliceToRAS[0:3, 3]
+
+  startDistances = (starts - origin).dot(normal)
+  endDistances = (ends - origin).dot(normal)
+  crossing = (startDistances * endDistances <= 0.0) & (startDistances != endDistances)
+  indices = numpy.nonzero(crossing)[0]
+  t = startDistances[indices] / (startDistances[indices] - endDistances[indices])
+  points = starts[indices] + t[:, numpy.newaxis] * (ends[indices] - starts[indices])
+  return indices, points
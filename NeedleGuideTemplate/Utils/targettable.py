@@ -0,0 +1,193 @@
+import numpy
+import qt
+
+TARGET_COLUMNS = ['Name', 'Hole', 'Depth (mm)', 'Path', 'Position (RAS)']
+
+# One record per target: the hole of its nearest path (index into the template and labels), the tilt in degrees of
+# the path against the nominal direction of the hole, the insertion depth, whether the path reaches the target and
+# crosses an obstacle, and the RAS position of the target
+TARGET_DTYPE = numpy.dtype([('label', object), ('hole', numpy.intp), ('holeX', object), ('holeY', object),
+                            ('tilt', numpy.float64), ('depth', numpy.float64), ('inRange', bool), ('blocked', bool),
+                            ('position', numpy.float64, (3,))])
+
+
+def formatTargetCell(record, column, showPath=True):
+  """Returns the text of one TARGET_COLUMNS cell of a TARGET_DTYPE record."""
+  if column == 0:
+    return record['label']
+  if column == 1:
+    text = '(%s, %s)' % (record['holeX'], record['holeY'])
+    if record['tilt'] > 0:
+      text += ' %.1f deg' % record['tilt']
+    return text
+  if column == 2:
+    return ('%.3f' if record['inRange'] else '(%.3f)') % record['depth']
+  if column == 3:
+    if not showPath:
+      return ''
+    return 'blocked' if record['blocked'] else 'clear'
+  position = record['position']
+  return '(%.3f, %.3f, %.3f)' % (position[0], position[1], position[2])
+
+
+def rankStrings(values):
+  """Returns the rank of every string of an object array in lexicographic order (equal strings, equal rank)."""
+  return numpy.unique(numpy.asarray(values).astype('U'), return_inverse=True)[1].reshape(-1)
+
+
+class TargetResults(object):
+  """Columnar store of the target table with one TARGET_DTYPE record per target.
+
+  The record array grows geometrically, so adding targets does not reallocate it every time, and rows are updated
+  by column for all changed targets at once.
+  """
+
+  def __init__(self, capacity=16):
+    self.records = numpy.zeros(capacity, dtype=TARGET_DTYPE)
+    self.size = 0
+
+  @property
+  def rows(self):
+    return self.records[:self.size]
+
+  def resize(self, size):
+    if size > len(self.records):
+      records = numpy.zeros(max(size, 2 * len(self.records)), dtype=TARGET_DTYPE)
+      records[:self.size] = self.records[:self.size]
+      self.records = records
+    if size > self.size:
+      # Rows of a pending background update are shown as unassigned until their results arrive
+      self.records[self.size:size] = numpy.zeros(1, dtype=TARGET_DTYPE)
+      for name in ('label', 'holeX', 'holeY'):
+        self.records[name][self.size:size] = '' if name == 'label' else '--'
+      self.records['hole'][self.size:size] = -1
+    else:
+      # Removed rows must not keep their objects alive
+      self.records[size:self.size] = numpy.zeros(1, dtype=TARGET_DTYPE)
+    self.size = size
+
+  def update(self, rows, **columns):
+    """Assigns the given columns (name=values) of the given rows."""
+    for (name, values) in columns.items():
+      self.records[name][rows] = values
+
+  def getSortKeys(self, column, rows):
+    """Returns the numpy.lexsort keys (primary key last) that order the records of rows by a TARGET_COLUMNS column."""
+    records = self.records[rows]
+    if column == 0:
+      return (rankStrings(records['label']),)
+    if column == 1:
+      return (records['tilt'], records['hole'])
+    if column == 2:
+      return (records['depth'],)
+    if column == 3:
+      return (records['blocked'],)
+    position = records['position']
+    return (position[:, 2], position[:, 1], position[:, 0])
+
+  def getOrder(self, sortColumn=-1, descending=False, filterText='', inRangeOnly=False):
+    """Returns the rows in display order: those passing the filter, sorted by sortColumn (-1: target order).
+
+    filterText selects targets whose label contains it, ignoring case, and inRangeOnly those that can be reached.
+    Ties keep the target order.
+    """
+    order = numpy.arange(self.size)
+    if inRangeOnly:
+      order = order[self.records['inRange'][order]]
+    if filterText:
+      labels = numpy.char.lower(self.records['label'][order].astype('U'))
+      order = order[numpy.char.find(labels, filterText.lower()) >= 0]
+    if sortColumn >= 0 and order.size:
+      if descending:
+        # Reversing the ascending order of the reversed rows keeps ties in target order
+        order = order[::-1]
+        order = order[numpy.lexsort(self.getSortKeys(sortColumn, order))][::-1]
+      else:
+        order = order[numpy.lexsort(self.getSortKeys(sortColumn, order))]
+    return order
+
+
+class TargetTableModel(qt.QAbstractTableModel):
+  """Table model presenting a TargetResults store to a QTableView.
+
+  Cells are formatted on demand, so the view only touches the rows it shows. Sorting and filtering reorder an index
+  array into the store instead of the rows themselves. Call refresh() after the store was updated.
+  """
+
+  def __init__(self, results, parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.results = results
+    self.order = numpy.zeros(0, dtype=numpy.intp)  ## Store row of every view row
+    self.numberOfTargets = 0  ## results.size the view rows were laid out for
+    self.sortColumn = -1
+    self.descending = False
+    self.filterText = ''
+    self.inRangeOnly = False
+    self.showPath = False  ## Fill the Path column (only meaningful with an obstacle map)
+
+  def rowCount(self, parent=None):
+    return 0 if parent is not None and parent.isValid() else len(self.order)
+
+  def columnCount(self, parent=None):
+    return 0 if parent is not None and parent.isValid() else len(TARGET_COLUMNS)
+
+  def data(self, index, role=None):
+    if role != qt.Qt.DisplayRole or not index.isValid() or index.row() >= len(self.order):
+      return None
+    return formatTargetCell(self.results.records[self.order[index.row()]], index.column(), self.showPath)
+
+  def headerData(self, section, orientation, role=None):
+    if role != qt.Qt.DisplayRole:
+      return None
+    if orientation == qt.Qt.Horizontal:
+      return TARGET_COLUMNS[section]
+    # Rows are numbered like the targets, whatever the order
+    return str(self.order[section] + 1) if section < len(self.order) else None
+
+  def sort(self, column, order=None):
+    self.sortColumn = column
+    self.descending = order == qt.Qt.DescendingOrder
+    self.updateLayout()
+
+  def setFilter(self, text, inRangeOnly=False):
+    self.filterText = text
+    self.inRangeOnly = inRangeOnly
+    self.updateLayout()
+
+  def isOrdered(self):
+    return self.sortColumn >= 0 or bool(self.filterText) or self.inRangeOnly
+
+  def getTargetRow(self, viewRow):
+    """Returns the store row shown in viewRow, or -1."""
+    return int(self.order[viewRow]) if 0 <= viewRow < len(self.order) else -1
+
+  def refresh(self, changedRows=None):
+    """Updates the view after the store changed; changedRows are the store rows with new values (None: all)."""
+    if changedRows is None or self.results.size != self.numberOfTargets:
+      self.beginResetModel()
+      self.order = self.results.getOrder(self.sortColumn, self.descending, self.filterText, self.inRangeOnly)
+      self.numberOfTargets = self.results.size
+      self.endResetModel()
+    elif len(changedRows) == 0:
+      return
+    elif self.isOrdered():
+      self.updateLayout()
+    else:
+      # View rows are store rows: repaint the span of the changed rows
+      self.dataChanged(self.index(int(numpy.min(changedRows)), 0),
+                       self.index(int(numpy.max(changedRows)), len(TARGET_COLUMNS) - 1))
+
+  def updateLayout(self):
+    # Reorders the view rows; selected and current cells stay on their targets
+    self.layoutAboutToBeChanged()
+    previous = [index for index in self.persistentIndexList() if index.row() < len(self.order)]
+    targets = [self.order[index.row()] for index in previous]
+    self.order = self.results.getOrder(self.sortColumn, self.descending, self.filterText, self.inRangeOnly)
+    self.numberOfTargets = self.results.size
+    viewRows = numpy.full(self.results.size, -1, dtype=numpy.intp)
+    viewRows[self.order] = numpy.arange(len(self.order))
+    current = [self.index(int(viewRows[target]), index.column())
+               if target < self.results.size and viewRows[target] >= 0 else qt.QModelIndex()
+               for (target, index) in zip(targets, previous)]
+    self.changePersistentIndexList(previous, current)
+    self.layoutChanged()
@@ -0,0 +1,230 @@
+import csv
+import os
+import sys
+import numpy
+
+# Record of one hole in binary template files: two fixed-width hole labels, the seven floats of a CSV row (entry
+# point, second point on the path, maximum depth) and the needle path of the hole as computed by computeTemplatePaths
+# (homogeneous origin and unit direction), so that the path arrays are views of the file as well. Files are plain
+# .npy arrays of this type.
+TEMPLATE_LABEL_LENGTH = 8
+TEMPLATE_DTYPE = numpy.dtype([('index', 'S%d' % TEMPLATE_LABEL_LENGTH, (2,)), ('config', '<f8', (7,)),
+                              ('origin', '<f8', (4,)), ('vector', '<f8', (4,))])
+BINARY_TEMPLATE_EXTENSION = '.npy'
+
+# First cell of the CSV rows that describe fiducial markers instead of holes: "FIDUCIAL",label,x,y,z
+FIDUCIAL_ROW_TAG = 'FIDUCIAL'
+
+
+def readTemplateConfigFile(path):
+  """Parses a template configuration CSV file.
+
+  The first row holds the template name and every following row one hole: the two hole labels, the entry point
+  (x, y, z), a second point on the path (x, y, z) and the maximum insertion depth. Holes of angulated templates may
+  append any number of (dx, dy, dz) triplets, each an additional allowed direction of the needle from the entry
+  point. Returns (name, index, config, directions) where index is a list of [labelX, labelY], config a list of the
+  seven floats of every hole and directions a list of the additional directions of every hole. Fiducial marker rows
+  (see readFiducialConfigFile) are skipped. Raises csv.Error if the file cannot be parsed.
+  """
+  name = ''
+  index = []
+  config = []
+  directions = []
+  header = False
+  with open(path, 'rb' if sys.version_info[0] < 3 else 'r') as f:
+    reader = csv.reader(f)
+    for row in reader:
+      if header and row and row[0].strip().upper() == FIDUCIAL_ROW_TAG:
+        continue
+      if header:
+        try:
+          index.append(row[0:2])
+          config.append([float(value) for value in row[2:9]])
+          values = [float(value) for value in row[9:] if value.strip()]
+          if len(values) % 3:
+            raise ValueError('additional directions must be given as (dx, dy, dz) triplets')
+          directions.append([values[i:i + 3] for i in range(0, len(values), 3)])
+        except (ValueError, IndexError) as e:
+          raise csv.Error('line %d: %s' % (reader.line_num, e))
+      else:
+        name = row[0]
+        header = True
+  return name, index, config, directions
+
+
+def readFiducialConfigFile(path):
+  """Returns (labels, points) of the fiducial markers of a template configuration CSV file.
+
+  Markers are rows of the form "FIDUCIAL",label,x,y,z anywhere after the name row, with the marker position in the
+  template coordinate system of the holes. points is an M x 3 array (M = 0 if the template has no markers). Raises
+  csv.Error if a marker row cannot be parsed.
+  """
+  labels = []
+  points = []
+  with open(path, 'rb' if sys.version_info[0] < 3 else 'r') as f:
+    reader = csv.reader(f)
+    next(reader, None)
+    for row in reader:
+      if row and row[0].strip().upper() == FIDUCIAL_ROW_TAG:
+        try:
+          points.append([float(value) for value in row[2:5]])
+          if len(points[-1]) != 3:
+            raise ValueError('a fiducial needs x, y and z coordinates')
+        except ValueError as e:
+          raise csv.Error('line %d: %s' % (reader.line_num, e))
+        labels.append(row[1] if len(row) > 1 else '')
+  return labels, numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+
+
+def loadFiducialConfig(path):
+  """Returns (labels, points) of the fiducial markers of a template file; binary templates have no markers."""
+  if path.lower().endswith(BINARY_TEMPLATE_EXTENSION):
+    return [], numpy.zeros((0, 3))
+  return readFiducialConfigFile(path)
+
+
+def mapBinaryTemplateFile(path):
+  """Memory maps a binary template file read-only and returns its TEMPLATE_DTYPE records."""
+  data = numpy.load(path, mmap_mode='r')
+  if data.dtype != TEMPLATE_DTYPE or data.ndim != 1:
+    raise ValueError('%s is not a binary template file of this version (convert the CSV file again)' % path)
+  return data
+
+
+def loadBinaryTemplateConfigFile(path):
+  """Memory maps a binary template file and returns (name, index, config, directions).
+
+  index (H x 2 byte strings) and config (H x 7 floats) are read-only views of the mapped file. The template name is
+  the file name without extension. Binary templates have one direction per hole, so directions is None.
+  """
+  data = mapBinaryTemplateFile(path)
+  name = os.path.splitext(os.path.basename(path))[0]
+  return name, data['index'], data['config'], None
+
+
+def loadTemplateConfig(path):
+  """Returns (name, index, config, directions) of a CSV or binary template file, chosen by the file extension."""
+  if path.lower().endswith(BINARY_TEMPLATE_EXTENSION):
+    return loadBinaryTemplateConfigFile(path)
+  return readTemplateConfigFile(path)
+
+
+def loadTemplateFile(path):
+  """Returns (name, index, config, directions, paths) of a CSV or binary template file.
+
+  The first four are those of loadTemplateConfig and paths is (origins, vectors, maxDepths, holes, angles) like
+  computeTemplatePaths. Binary templates store their paths, and origins, vectors and maxDepths are read-only views of
+  the same mapping as index and config; the paths of CSV templates are computed.
+  """
+  if not path.lower().endswith(BINARY_TEMPLATE_EXTENSION):
+    (name, index, config, directions) = readTemplateConfigFile(path)
+    return name, index, config, directions, computeTemplatePaths(config, directions)
+  data = mapBinaryTemplateFile(path)
+  name = os.path.splitext(os.path.basename(path))[0]
+  holes = numpy.arange(data.shape[0])
+  paths = (data['origin'], data['vector'], data['config'][:, 6], holes, numpy.zeros_like(holes))
+  return name, data['index'], data['config'], None, paths
+
+
+def convertTemplateConfigFile(csvPath, binaryPath):
+  """Converts a template configuration CSV file into the binary template format."""
+  (name, index, config, directions) = readTemplateConfigFile(csvPath)
+  if any(directions):
+    raise ValueError('angulated templates cannot be stored in the binary template format')
+  data = numpy.zeros(len(config), dtype=TEMPLATE_DTYPE)
+  for (i, labels) in enumerate(index):
+    for (j, label) in enumerate(labels):
+      label = label.encode('utf-8') if not isinstance(label, bytes) else label
+      if len(label) > TEMPLATE_LABEL_LENGTH:
+        raise ValueError('hole label %r is longer than %d bytes' % (label, TEMPLATE_LABEL_LENGTH))
+      data['index'][i, j] = label
+  data['config'] = numpy.asarray(config, dtype=numpy.float64).reshape(-1, 7)
+  (data['origin'], data['vector']) = computeTemplatePaths(data['config'])[0:2]
+  numpy.save(binaryPath, data)
+
+
+def getHoleLabels(index, i):
+  """Returns the (labelX, labelY) strings of hole i of a template index, or ('--', '--') if i is negative."""
+  if i < 0:
+    return '--', '--'
+  return tuple(label.decode('utf-8') if isinstance(label, bytes) and bytes is not str else label
+               for label in index[i][0:2])
+
+
+def getHoleGrid(index):
+  """Returns (labelsX, labelsY), the distinct hole labels of a template index in the order of their first use.
+
+  The labels span the rows and columns of the printed hole grid of the template.
+  """
+  (labelsX, labelsY) = ([], [])
+  (seenX, seenY) = (set(), set())
+  for i in range(len(index)):
+    (labelX, labelY) = getHoleLabels(index, i)
+    if labelX not in seenX:
+      seenX.add(labelX)
+      labelsX.append(labelX)
+    if labelY not in seenY:
+      seenY.add(labelY)
+      labelsY.append(labelY)
+  return labelsX, labelsY
+
+
+def computeTemplatePaths(config, directions=None):
+  """Returns (origins, vectors, maxDepths, holes, angles) of the needle paths of a template configuration.
+
+  Every hole contributes its nominal path followed by one path per additional direction in directions. origins and
+  vectors are P x 4 homogeneous coordinates of the entry points (w=1) and unit path directions (w=0), maxDepths the
+  maximum depth, holes the hole index and angles the direction index within the hole (0 for the nominal path) of
+  every path.
+  """
+  config = numpy.asarray(config, dtype=numpy.float64).reshape(-1, 7)
+  nHoles = config.shape[0]
+  p1 = config[:, 0:3]
+  v = config[:, 3:6] - p1
+  n = v / numpy.sqrt(numpy.sum(v * v, axis=1))[:, numpy.newaxis]
+
+  counts = numpy.ones(nHoles, dtype=numpy.intp)
+  if directions:
+    counts += [len(holeDirections) for holeDirections in directions]
+  holes = numpy.repeat(numpy.arange(nHoles), counts)
+  starts = numpy.cumsum(counts) - counts
+  angles = numpy.arange(holes.size) - starts[holes]
+
+  pathVectors = n[holes]
+  if holes.size > nHoles:
+    extra = numpy.array([direction for holeDirections in directions for direction in holeDirections],
+                        dtype=numpy.float64).reshape(-1, 3)
+    extra /= numpy.sqrt(numpy.sum(extra * extra, axis=1))[:, numpy.newaxis]
+    pathVectors[angles > 0] = extra
+
+  origins = numpy.column_stack([p1[holes], numpy.ones(holes.size)])
+  vectors = numpy.column_stack([pathVectors, numpy.zeros(holes.size)])
+  return origins, vectors, config[holes, 6], holes, angles
+
+
+def computePathTilts(vectors, holes, angles):
+  """Returns the angle in degrees between every path and the nominal path of its hole (exactly 0 for the latter)."""
+  vectors = numpy.asarray(vectors)[:, 0:3]
+  nominal = vectors[numpy.nonzero(angles == 0)[0][holes]]
+  cosines = numpy.clip(numpy.sum(vectors * nominal, axis=1), -1.0, 1.0)
+  cosines[angles == 0] = 1.0
+  return numpy.degrees(numpy.arccos(cosines))
+
+
+def transformTemplatePaths(origins, vectors, matrix):
+  """Applies a 4 x 4 matrix to H x 4 homogeneous path origins and directions and returns H x 3 arrays.
+
+  Directions are re-normalized after the transformation.
+  """
+  matrix = numpy.asarray(matrix, dtype=numpy.float64).reshape(4, 4)
+  transformedOrigins = numpy.ascontiguousarray(origins.dot(matrix.T)[:, 0:3])
+  transformedVectors = numpy.ascontiguousarray(vectors.dot(matrix.T)[:, 0:3])
+  lengths = numpy.sqrt(numpy.sum(transformedVectors * transformedVectors, axis=1))
+  transformedVectors /= numpy.where(lengths > 0, lengths, 1.0)[:, numpy.newaxis]
+  return transformedOrigins, transformedVectors
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    sys.exit('usage: python -m Utils.templateconfig TEMPLATE.csv TEMPLATE.npy')
+  convertTemplateConfigFile(sys.argv[1], sys.argv[2])
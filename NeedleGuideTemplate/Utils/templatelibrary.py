@@ -0,0 +1,118 @@
+import os
+import logging
+import numpy
+
+from Utils.pathsearch import asPathArray, projectOntoPaths, DEFAULT_CHUNK_SIZE
+from Utils.templateconfig import loadTemplateFile, transformTemplatePaths
+
+TEMPLATE_FILE_EXTENSIONS = ('.csv', '.npy')
+
+EVALUATION_COLUMNS = ['Template', 'Holes', 'In Range', 'Coverage (%)', 'Mean Lateral Error (mm)']
+
+
+class LibraryTemplate(object):
+  """Parsed template configuration and needle paths of one file of a TemplateLibrary."""
+
+  def __init__(self, path, modificationTime):
+    self.path = path
+    self.modificationTime = modificationTime
+    (self.name, self.index, config, directions, paths) = loadTemplateFile(path)
+    self.numberOfHoles = len(self.index)
+    (self.origins, self.vectors, self.maxDepths, self.holes, self.angles) = paths
+
+
+class TemplateLibrary(object):
+  """All template configurations of a directory.
+
+  Files are discovered on every call of getPaths(), but each one is only parsed when it is first used and kept in
+  memory until it is modified on disk.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.templates = {}  ## path -> LibraryTemplate
+
+  def getPaths(self):
+    if not os.path.isdir(self.directory):
+      return []
+    return [os.path.join(self.directory, fileName) for fileName in sorted(os.listdir(self.directory))
+            if os.path.splitext(fileName)[1].lower() in TEMPLATE_FILE_EXTENSIONS]
+
+  def getTemplate(self, path):
+    """Returns the LibraryTemplate of path, or None if the file cannot be parsed."""
+    try:
+      modificationTime = os.path.getmtime(path)
+    except OSError:
+      self.templates.pop(path, None)
+      return None
+    template = self.templates.get(path)
+    if template is None or template.modificationTime != modificationTime:
+      try:
+        template = LibraryTemplate(path, modificationTime)
+      except Exception as e:
+        logging.getLogger('NeedleGuideTemplate').warning('Skipping template %s: %s', path, e)
+        self.templates.pop(path, None)
+        return None
+      self.templates[path] = template
+    return template
+
+  def getTemplates(self):
+    paths = self.getPaths()
+    # Files removed from the directory are dropped from the cache
+    for path in set(self.templates) - set(paths):
+      del self.templates[path]
+    return [template for template in (self.getTemplate(path) for path in paths) if template is not None]
+
+  def evaluate(self, targets, matrix=None, chunkSize=DEFAULT_CHUNK_SIZE):
+    """Evaluates the targets against every template of the library in one pass over the paths of all templates.
+
+    matrix places the templates in world coordinates like the template transform (identity if None). Returns one
+    (template, inRange, lateralErrors) tuple per template, where inRange flags the targets whose nearest path of the
+    template reaches them within its maximum depth and lateralErrors holds their distances to that path.
+    """
+    templates = self.getTemplates()
+    targets = asPathArray(targets)
+    if matrix is None:
+      matrix = numpy.identity(4)
+    if not templates:
+      return []
+
+    (origins, vectors) = transformTemplatePaths(numpy.concatenate([template.origins for template in templates]),
+                                                numpy.concatenate([template.vectors for template in templates]),
+                                                matrix)
+    maxDepths = numpy.concatenate([template.maxDepths for template in templates])
+    counts = [len(template.origins) for template in templates]
+    bounds = numpy.concatenate([[0], numpy.cumsum(counts)])
+
+    nTargets = targets.shape[0]
+    inRange = numpy.zeros((len(templates), nTargets), dtype=bool)
+    lateralErrors = numpy.full((len(templates), nTargets), numpy.inf)
+    step = max(1, chunkSize // max(1, origins.shape[0]))
+    for start in range(0, nTargets, step):
+      stop = min(start + step, nTargets)
+      rows = numpy.arange(stop - start)
+      aproj, mag2 = projectOntoPaths(targets[start:stop, numpy.newaxis, :] - origins[numpy.newaxis, :, :], vectors)
+      for t in range(len(templates)):
+        if counts[t] == 0:
+          continue
+        nearest = bounds[t] + numpy.argmin(mag2[:, bounds[t]:bounds[t + 1]], axis=1)
+        depths = aproj[rows, nearest]
+        inRange[t, start:stop] = (depths > 0) & (depths < maxDepths[nearest])
+        lateralErrors[t, start:stop] = numpy.sqrt(mag2[rows, nearest])
+    return [(template, inRange[t], lateralErrors[t]) for (t, template) in enumerate(templates)]
+
+
+def summarizeEvaluation(results):
+  """Returns (path, row) with one EVALUATION_COLUMNS row per TemplateLibrary.evaluate result, best coverage first.
+
+  Templates with equal coverage are ordered by their mean lateral error.
+  """
+  rows = []
+  for (template, inRange, lateralErrors) in results:
+    nTargets = len(inRange)
+    coverage = 100.0 * numpy.count_nonzero(inRange) / nTargets if nTargets else 0.0
+    meanError = float(numpy.mean(lateralErrors)) if nTargets else 0.0
+    rows.append((template.path, [template.name, template.numberOfHoles, int(numpy.count_nonzero(inRange)), coverage,
+                                 meanError]))
+  rows.sort(key=lambda entry: (-entry[1][3], entry[1][4]))
+  return rows
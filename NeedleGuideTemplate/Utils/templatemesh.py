@@ -0,0 +1,135 @@
+import numpy
+
+# Levels of detail of the template and needle path models
+LOD_AUTO = 'auto'
+LOD_HIGH = 'high'
+LOD_LOW = 'low'
+LOD_LINES = 'lines'
+LOD_GLYPHS = 'glyphs'
+LEVELS_OF_DETAIL = (LOD_AUTO, LOD_HIGH, LOD_LOW, LOD_LINES, LOD_GLYPHS)
+
+# Number of sides of the tubes of the mesh based levels of detail and of the glyph source
+TUBE_SIDES = {LOD_HIGH: 18, LOD_LOW: 6, LOD_GLYPHS: 18}
+
+# Largest number of tubes LOD_AUTO shows at each level; larger templates are shown as lines
+AUTO_LOD_LIMITS = ((LOD_HIGH, 500), (LOD_LOW, 5000))
+
+
+def computeTubeFrames(directions):
+  """Returns two unit vectors per row of directions which together with the direction form an orthonormal frame."""
+  directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1, 3)
+  # Cross with the coordinate axis that is least aligned with the direction to avoid degenerate frames
+  helper = numpy.zeros_like(directions)
+  helper[numpy.arange(len(directions)), numpy.argmin(numpy.abs(directions), axis=1)] = 1.0
+  u = numpy.cross(directions, helper)
+  u /= numpy.sqrt(numpy.sum(u * u, axis=1))[:, numpy.newaxis]
+  w = numpy.cross(directions, u)
+  return u, w
+
+
+def createTubeMesh(startPoints, endPoints, radius, numberOfSides, capping=True):
+  """Generates the surface of capped tubes between all pairs of start and end points in one pass.
+
+  Returns (points, normals, polys, numberOfCells). points and normals are M x 3 arrays and polys is a flat cell
+  array in the legacy VTK layout (n, id_0, ..., id_n-1, n, ...) with quads along the tube walls and one polygon per
+  cap. All tubes have the same number of points and cells, so the geometry of tube i occupies a fixed slice of the
+  arrays.
+  """
+  startPoints = numpy.asarray(startPoints, dtype=numpy.float64).reshape(-1, 3)
+  endPoints = numpy.asarray(endPoints, dtype=numpy.float64).reshape(-1, 3)
+  nTubes = startPoints.shape[0]
+  sides = int(numberOfSides)
+
+  axes = endPoints - startPoints
+  lengths = numpy.sqrt(numpy.sum(axes * axes, axis=1))
+  directions = axes / numpy.where(lengths > 0, lengths, 1.0)[:, numpy.newaxis]
+  u, w = computeTubeFrames(directions)
+
+  angles = 2.0 * numpy.pi * numpy.arange(sides) / sides
+  radial = (numpy.cos(angles)[numpy.newaxis, :, numpy.newaxis] * u[:, numpy.newaxis, :] +
+            numpy.sin(angles)[numpy.newaxis, :, numpy.newaxis] * w[:, numpy.newaxis, :])  # H x S x 3
+  startRing = startPoints[:, numpy.newaxis, :] + radius * radial
+  endRing = endPoints[:, numpy.newaxis, :] + radius * radial
+
+  rings = [startRing, endRing]
+  ringNormals = [radial, radial]
+  if capping:
+    # Caps get their own points so that they are shaded flat
+    rings += [startRing, endRing]
+    ringNormals += [numpy.repeat(-directions[:, numpy.newaxis, :], sides, axis=1),
+                    numpy.repeat(directions[:, numpy.newaxis, :], sides, axis=1)]
+  pointsPerTube = len(rings) * sides
+  points = numpy.concatenate(rings, axis=1).reshape(-1, 3)
+  normals = numpy.concatenate(ringNormals, axis=1).reshape(-1, 3)
+
+  # Cell array of a single tube, offset by pointsPerTube for every tube
+  k = numpy.arange(sides)
+  kNext = (k + 1) % sides
+  walls = numpy.column_stack([numpy.full(sides, 4), k, kNext, sides + kNext, sides + k])
+  cells = [walls.reshape(-1)]
+  if capping:
+    cells.append(numpy.concatenate([[sides], 2 * sides + k[::-1]]))
+    cells.append(numpy.concatenate([[sides], 3 * sides + k]))
+  template = numpy.concatenate(cells)
+  isPointID = numpy.ones(template.size, dtype=bool)
+  isPointID[numpy.arange(sides) * 5] = False
+  if capping:
+    isPointID[5 * sides] = False
+    isPointID[5 * sides + sides + 1] = False
+  offsets = numpy.arange(nTubes)[:, numpy.newaxis] * pointsPerTube * isPointID
+  polys = (template[numpy.newaxis, :] + offsets).reshape(-1).astype(numpy.int64)
+  numberOfCells = nTubes * (sides + (2 if capping else 0))
+  return points, normals, polys, numberOfCells
+
+
+def selectLevelOfDetail(levelOfDetail, numberOfTubes):
+  """Resolves LOD_AUTO into a level of detail for the number of tubes; other levels are returned unchanged."""
+  if levelOfDetail != LOD_AUTO:
+    return levelOfDetail
+  for (level, limit) in AUTO_LOD_LIMITS:
+    if numberOfTubes <= limit:
+      return level
+  return LOD_LINES
+
+
+def countTriangles(levelOfDetail, numberOfTubes):
+  """Returns the number of triangles rendered per frame for numberOfTubes tubes at a resolved level of detail.
+
+  Quads and caps are counted as triangulated by the renderer. Glyphs render the full tube once per instance, but
+  only a single tube is uploaded to the GPU.
+  """
+  if levelOfDetail not in TUBE_SIDES:
+    return 0
+  sides = TUBE_SIDES[levelOfDetail]
+  return numberOfTubes * (2 * sides + 2 * (sides - 2))
+
+
+def createLineMesh(startPoints, endPoints):
+  """Generates one line segment between every pair of start and end points.
+
+  Returns (points, lines, numberOfCells) with the 2N x 3 points and a flat line cell array in the legacy VTK layout
+  (2, id_0, id_1, 2, ...).
+  """
+  startPoints = numpy.asarray(startPoints, dtype=numpy.float64).reshape(-1, 3)
+  endPoints = numpy.asarray(endPoints, dtype=numpy.float64).reshape(-1, 3)
+  nLines = startPoints.shape[0]
+  points = numpy.column_stack([startPoints, endPoints]).reshape(-1, 3)
+  ids = numpy.arange(2 * nLines, dtype=numpy.int64).reshape(-1, 2)
+  lines = numpy.column_stack([numpy.full(nLines, 2, dtype=numpy.int64), ids]).reshape(-1)
+  return points, lines, nLines
+
+
+def computeGlyphArrays(startPoints, endPoints, radius):
+  """Returns (centers, directions, scales) that place a glyph on every segment between start and end points.
+
+  The glyph is a cylinder of diameter and height 1 along the x axis; scales holds the (length, diameter, diameter)
+  of every instance for scaling by vector components.
+  """
+  startPoints = numpy.asarray(startPoints, dtype=numpy.float64).reshape(-1, 3)
+  endPoints = numpy.asarray(endPoints, dtype=numpy.float64).reshape(-1, 3)
+  axes = endPoints - startPoints
+  lengths = numpy.sqrt(numpy.sum(axes * axes, axis=1))
+  directions = axes / numpy.where(lengths > 0, lengths, 1.0)[:, numpy.newaxis]
+  diameters = numpy.full(lengths.shape, 2.0 * radius)
+  scales = numpy.column_stack([lengths, diameters, diameters])
+  return 0.5 * (startPoints + endPoints), directions, scales
@@ -0,0 +1,137 @@
+import logging
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+import qt
+
+
+class TaskCancelled(Exception):
+  """Raised inside a background task that was cancelled to abort its computation."""
+
+
+class BackgroundTask(object):
+  """Handle of a computation submitted to a BackgroundWorker."""
+
+  def __init__(self, key, function, onDone, onError, title):
+    self.key = key
+    self.function = function
+    self.onDone = onDone
+    self.onError = onError
+    self.title = title
+    self.progress = 0.0
+    self.cancelled = False
+    self.finished = False
+
+  def setProgress(self, fraction):
+    """Reports the progress from the worker thread and aborts the computation if the task was cancelled."""
+    if self.cancelled:
+      raise TaskCancelled()
+    self.progress = fraction
+
+  def cancel(self):
+    self.cancelled = True
+
+
+class BackgroundWorker(object):
+  """Runs pure NumPy computations on a pool of threads and hands their results back to the main thread.
+
+  Every task has a key, and submitting a task cancels the pending task with the same key, so results of outdated
+  inputs are never delivered. Tasks are cancelled cooperatively: the function receives its task and aborts at the
+  next setProgress() call. The callbacks and progress listeners are called from a QTimer on the main thread and may
+  therefore modify MRML nodes and widgets.
+  """
+
+  POLL_INTERVAL = 50  # ms
+
+  def __init__(self, numberOfThreads=2):
+    self.queue = queue.Queue()
+    self.results = queue.Queue()
+    self.activeTasks = {}  ## Latest task of every key that has not been delivered yet
+    self.progressListeners = []
+    self.threads = []
+    for i in range(numberOfThreads):
+      thread = threading.Thread(target=self._run)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.POLL_INTERVAL)
+    self.timer.connect('timeout()', self.processResults)
+
+  def addProgressListener(self, listener):
+    """listener(task) is called whenever a task is submitted, makes progress, finishes or is cancelled."""
+    self.progressListeners.append(listener)
+
+  def submit(self, key, function, onDone, onError=None, title=None):
+    """Runs function(task) in a worker thread and then onDone(result) or onError(exception) on the main thread."""
+    self.cancel(key)
+    task = BackgroundTask(key, function, onDone, onError, title)
+    self.activeTasks[key] = task
+    self.queue.put(task)
+    if not self.timer.isActive():
+      self.timer.start()
+    self._notify(task)
+    return task
+
+  def isPending(self, key):
+    return key in self.activeTasks
+
+  def cancel(self, key):
+    task = self.activeTasks.pop(key, None)
+    if task is not None:
+      task.cancel()
+      self._notify(task)
+
+  def cancelAll(self):
+    for key in list(self.activeTasks):
+      self.cancel(key)
+
+  def shutdown(self):
+    self.cancelAll()
+    self.timer.stop()
+    for thread in self.threads:
+      self.queue.put(None)
+
+  def processResults(self):
+    while True:
+      try:
+        (task, result, error) = self.results.get_nowait()
+      except queue.Empty:
+        break
+      if task.cancelled or self.activeTasks.get(task.key) is not task:
+        continue
+      del self.activeTasks[task.key]
+      task.finished = True
+      task.progress = 1.0
+      self._notify(task)
+      if error is None:
+        task.onDone(result)
+      elif task.onError is not None:
+        task.onError(error)
+      else:
+        logging.getLogger('NeedleGuideTemplate').error('Background task %s failed: %s', task.key, error)
+
+    for task in list(self.activeTasks.values()):
+      self._notify(task)
+    if not self.activeTasks:
+      self.timer.stop()
+
+  def _notify(self, task):
+    for listener in self.progressListeners:
+      listener(task)
+
+  def _run(self):
+    while True:
+      task = self.queue.get()
+      if task is None:
+        return
+      if task.cancelled:
+        continue
+      try:
+        self.results.put((task, task.function(task), None))
+      except TaskCancelled:
+        pass
+      except Exception as e:
+        self.results.put((task, None, e))